@@ -0,0 +1,735 @@
+"""Micro benchmarks for snek-evm.
+
+    python bench.py dispatch                    # time per opcode with the current vm.py
+    python bench.py dispatch --baseline REV     # compare against vm.py at git revision REV
+    python bench.py engines                     # time the workload contracts on every engine
+    python bench.py superinstructions           # dispatches saved by superinstructions on the interpreter
+    python bench.py dispatcher --functions 100  # selector dispatcher walk against its jump table
+    python bench.py storage --slots 1000000     # memory of hex string storage dicts against Storage
+    python bench.py keccak                      # keccak memo hit rates and timings
+    python bench.py create2 --salts 100000      # CREATE2 addresses per second, python loop against keccak_batch
+    python bench.py backends                    # erc20 calls on the dict and sqlite state backends
+    python bench.py state-root --slots 100000   # incremental state root after a block against a full rebuild
+    python bench.py batch                       # execute_batch throughput against a loop of execute_transaction
+    python bench.py parallel --workers 1,2,4    # parallel block execution on an erc20 and a high conflict block
+    python bench.py simulate --workers 1,2,4    # simulate_many throughput of erc20 transfer variants
+    python bench.py prefork --holders 20000     # prefork worker startup against building a warm EVM
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import keccak_batch
+import parallel
+import vm
+from prefork import PreforkClient, PreforkServer
+from sqlite_backend import SQLiteBackend
+
+
+ADDRESS = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+EOA = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+
+# one unit per opcode, every unit leaves the stack as it found it.
+# a unit is either bytecode or a function of its own offset for units that jump
+OPCODE_UNITS = [
+    ("ADD", "6003600301" + "50"),
+    ("MUL", "6003600302" + "50"),
+    ("SUB", "6003600303" + "50"),
+    ("DIV", "6003600304" + "50"),
+    ("MOD", "6003600306" + "50"),
+    ("ADDMOD", "60036003600308" + "50"),
+    ("EXP", "600360030a" + "50"),
+    ("LT", "6003600310" + "50"),
+    ("GT", "6003600311" + "50"),
+    ("EQ", "6003600314" + "50"),
+    ("ISZERO", "600315" + "50"),
+    ("AND", "6003600316" + "50"),
+    ("OR", "6003600317" + "50"),
+    ("XOR", "6003600318" + "50"),
+    ("NOT", "600319" + "50"),
+    ("BYTE", "600360031a" + "50"),
+    ("SHL", "600360031b" + "50"),
+    ("SHR", "600360031c" + "50"),
+    ("SHA3", "6020600020" + "50"),
+    ("ADDRESS", "30" + "50"),
+    ("ORIGIN", "32" + "50"),
+    ("CALLER", "33" + "50"),
+    ("CALLVALUE", "34" + "50"),
+    ("CALLDATALOAD", "600035" + "50"),
+    ("CALLDATASIZE", "36" + "50"),
+    ("CODESIZE", "38" + "50"),
+    ("RETURNDATASIZE", "3d" + "50"),
+    ("GASLIMIT", "45" + "50"),
+    ("CHAINID", "46" + "50"),
+    ("BASEFEE", "48" + "50"),
+    ("POP", "6003" + "50"),
+    ("MLOAD", "600051" + "50"),
+    ("MSTORE", "6003600052"),
+    ("MSTORE8", "6003600053"),
+    ("SLOAD", "600054" + "50"),
+    ("SSTORE", "6003600055"),
+    ("JUMP", lambda offset: "61" + format(offset + 4, "04x") + "56" + "5b"),
+    ("JUMPI", "6000600057"),
+    ("PC", "58" + "50"),
+    ("MSIZE", "59" + "50"),
+    ("JUMPDEST", "5b"),
+    ("PUSH1", "6003" + "50"),
+    ("PUSH32", "7f" + "03" * 32 + "50"),
+    ("DUP1", "600380" + "5050"),
+    ("DUP16", "6003" * 16 + "8f" + "50" * 17),
+    ("SWAP1", "6003600390" + "5050"),
+    ("SWAP16", "6003" * 17 + "9f" + "50" * 17),
+]
+
+
+OPCODES = {
+    "STOP": 0x00, "ADD": 0x01, "MUL": 0x02, "SUB": 0x03, "DIV": 0x04, "MOD": 0x06, "ADDMOD": 0x08, "MULMOD": 0x09,
+    "EXP": 0x0a, "LT": 0x10, "GT": 0x11, "EQ": 0x14, "ISZERO": 0x15, "AND": 0x16, "OR": 0x17, "XOR": 0x18,
+    "NOT": 0x19, "BYTE": 0x1a, "SHL": 0x1b, "SHR": 0x1c, "SHA3": 0x20, "ADDRESS": 0x30, "ORIGIN": 0x32,
+    "CALLER": 0x33, "CALLVALUE": 0x34, "CALLDATALOAD": 0x35, "CALLDATASIZE": 0x36, "CALLDATACOPY": 0x37,
+    "CODESIZE": 0x38, "CODECOPY": 0x39, "EXTCODESIZE": 0x3b, "EXTCODECOPY": 0x3c, "RETURNDATASIZE": 0x3d,
+    "RETURNDATACOPY": 0x3e, "GASLIMIT": 0x45, "CHAINID": 0x46, "BASEFEE": 0x48, "POP": 0x50, "MLOAD": 0x51,
+    "MSTORE": 0x52, "MSTORE8": 0x53, "SLOAD": 0x54, "SSTORE": 0x55, "JUMP": 0x56, "JUMPI": 0x57, "PC": 0x58,
+    "MSIZE": 0x59, "GAS": 0x5a, "JUMPDEST": 0x5b, "PUSH0": 0x5f, "CREATE": 0xf0, "CALL": 0xf1, "RETURN": 0xf3,
+    "CREATE2": 0xf5, "STATICCALL": 0xfa, "REVERT": 0xfd, "INVALID": 0xfe,
+    **{f"PUSH{n}": 0x5f + n for n in range(1, 33)},
+    **{f"DUP{n}": 0x7f + n for n in range(1, 17)},
+    **{f"SWAP{n}": 0x8f + n for n in range(1, 17)},
+    **{f"LOG{n}": 0xa0 + n for n in range(5)},
+}
+
+
+def assemble(source):
+    """Assemble whitespace separated mnemonics into bytecode.
+
+    "name:" marks a label and "@name" as a PUSH argument pushes its program counter.
+    """
+    tokens = source.split()
+
+    # first pass finds the label program counters, every PUSH argument has a fixed size
+    labels = {}
+    program_counter = 0
+    for token in tokens:
+        if token.endswith(":"):
+            labels[token[:-1]] = program_counter
+        elif token in OPCODES:
+            program_counter += 1
+            if token.startswith("PUSH") and token != "PUSH0":
+                program_counter += OPCODES[token] - 0x5f
+
+    code = bytearray()
+    push_size = 0
+    for token in tokens:
+        if token.endswith(":"):
+            continue
+        if push_size:
+            value = labels[token[1:]] if token.startswith("@") else int(token, 0)
+            code += value.to_bytes(push_size, "big")
+            push_size = 0
+            continue
+
+        opcode = OPCODES[token]
+        code.append(opcode)
+        if 0x60 <= opcode <= 0x7f:
+            push_size = opcode - 0x5f
+    return code.hex()
+
+
+# contracts timed by the engines benchmark, each loops over the same body a fixed number of times
+LOOP = """
+    PUSH2 {iterations}
+    loop: JUMPDEST
+    DUP1 ISZERO PUSH2 @end JUMPI
+    {body}
+    PUSH1 1 SWAP1 SUB
+    PUSH2 @loop JUMP
+    end: JUMPDEST STOP
+"""
+
+WORKLOADS = [
+    ("loop", ""),
+    ("arithmetic", "DUP1 DUP1 MUL PUSH1 7 ADD PUSH1 3 AND DUP2 XOR PUSH1 2 SHL DUP2 LT POP"),
+    ("stack", "DUP1 DUP1 DUP1 SWAP2 SWAP1 DUP3 SWAP3 POP POP POP POP"),
+    ("memory", "DUP1 DUP1 PUSH1 31 AND PUSH1 5 SHL MSTORE PUSH1 0x40 MLOAD POP"),
+    ("storage", "DUP1 DUP1 PUSH1 15 AND SSTORE PUSH1 3 SLOAD POP"),
+    ("keccak", "DUP1 PUSH1 0 MSTORE PUSH1 0x20 PUSH1 0 SHA3 POP"),
+]
+
+
+# an ERC20 laid out the way solc lays out a contract, selector dispatcher, calldata validation and storage mappings
+ADDRESS_MASK = "0xffffffffffffffffffffffffffffffffffffffff"
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+# keccak of the address on top of the stack and slot 0, where its balance is kept
+BALANCE_SLOT = "PUSH1 0x00 MSTORE PUSH1 0x00 PUSH1 0x20 MSTORE PUSH1 0x40 PUSH1 0x00 SHA3"
+# reverts unless the word on top of the stack is an address
+VALIDATE_ADDRESS = "DUP1 DUP1 PUSH20 {mask} AND EQ PUSH2 @{label} JUMPI PUSH1 0x00 DUP1 REVERT {label}: JUMPDEST"
+
+ERC20 = f"""
+    PUSH1 0x80 PUSH1 0x40 MSTORE
+    CALLVALUE DUP1 ISZERO PUSH2 @nonpayable JUMPI
+    PUSH1 0x00 DUP1 REVERT
+    nonpayable: JUMPDEST POP
+    PUSH1 0x04 CALLDATASIZE LT PUSH2 @revert JUMPI
+    PUSH1 0x00 CALLDATALOAD PUSH1 0xe0 SHR
+    DUP1 PUSH4 0x18160ddd EQ PUSH2 @total_supply JUMPI
+    DUP1 PUSH4 0x40c10f19 EQ PUSH2 @mint JUMPI
+    DUP1 PUSH4 0x70a08231 EQ PUSH2 @balance_of JUMPI
+    DUP1 PUSH4 0xa9059cbb EQ PUSH2 @transfer JUMPI
+    revert: JUMPDEST
+    PUSH1 0x00 DUP1 REVERT
+
+    total_supply: JUMPDEST
+    PUSH1 0x01 SLOAD PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN
+
+    balance_of: JUMPDEST
+    PUSH1 0x04 CALLDATALOAD
+    {VALIDATE_ADDRESS.format(mask=ADDRESS_MASK, label="balance_of_valid")}
+    {BALANCE_SLOT} SLOAD PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN
+
+    mint: JUMPDEST
+    PUSH1 0x24 CALLDATALOAD PUSH1 0x04 CALLDATALOAD
+    {VALIDATE_ADDRESS.format(mask=ADDRESS_MASK, label="mint_valid")}
+    {BALANCE_SLOT} DUP1 SLOAD DUP3 ADD SWAP1 SSTORE
+    PUSH1 0x01 SLOAD ADD PUSH1 0x01 SSTORE
+    STOP
+
+    transfer: JUMPDEST
+    PUSH1 0x24 CALLDATALOAD PUSH1 0x04 CALLDATALOAD
+    {VALIDATE_ADDRESS.format(mask=ADDRESS_MASK, label="transfer_valid")}
+    CALLER {BALANCE_SLOT}
+    DUP1 SLOAD DUP4 DUP2 LT PUSH2 @revert JUMPI
+    DUP4 SWAP1 SUB SWAP1 SSTORE
+    DUP1 {BALANCE_SLOT} DUP1 SLOAD DUP4 ADD SWAP1 SSTORE
+    DUP2 PUSH1 0x00 MSTORE
+    CALLER PUSH32 {TRANSFER_TOPIC} PUSH1 0x20 PUSH1 0x00 LOG3
+    PUSH1 0x01 PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN
+"""
+
+ERC20_TOTAL_SUPPLY = "18160ddd"
+ERC20_MINT = "40c10f19"
+ERC20_BALANCE_OF = "70a08231"
+ERC20_TRANSFER = "a9059cbb"
+
+
+def calldata(selector, *words):
+    return "0x" + selector + "".join(format(int(word, 16) if isinstance(word, str) else word, "064x") for word in words)
+
+
+def erc20_calls(num_of_transfers):
+    # mints to EOA then sends num_of_transfers transfers from it to ADDRESS and reads both balances
+    calls = [calldata(ERC20_MINT, EOA, 10**24)]
+    calls += [calldata(ERC20_TRANSFER, ADDRESS, 1000 + index) for index in range(num_of_transfers)]
+    calls += [calldata(ERC20_BALANCE_OF, EOA), calldata(ERC20_BALANCE_OF, ADDRESS), calldata(ERC20_TOTAL_SUPPLY)]
+    return calls
+
+
+def build_bytecode(unit, repetitions):
+    if isinstance(unit, str):
+        return unit * repetitions
+
+    bytecode = ""
+    for _ in range(repetitions):
+        bytecode += unit(len(bytecode) // 2)
+    return bytecode
+
+
+def load_vm_module(revision):
+    source = subprocess.run(["git", "show", f"{revision}:vm.py"], check=True, capture_output=True, text=True).stdout
+    path = os.path.join(tempfile.mkdtemp(), "vm_baseline.py")
+    with open(path, "w") as f:
+        f.write(source)
+
+    spec = importlib.util.spec_from_file_location("vm_baseline", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def time_bytecode(module, bytecode, runs):
+    evm = module.EVM()
+    evm.create_contract(bytecode=bytecode, address=ADDRESS)
+
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        evm.execute_transaction(address=ADDRESS, transaction_metadata=module.TransactionMetadata(from_address=EOA))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_dispatch(args):
+    modules = [("current", vm)]
+    if args.baseline:
+        modules.insert(0, (args.baseline, load_vm_module(args.baseline)))
+
+    header = f"{'opcode':<16}" + "".join(f"{name + ' ns/unit':>22}" for name, _ in modules)
+    if args.baseline:
+        header += f"{'speedup':>10}"
+    print(header)
+
+    for name, unit in OPCODE_UNITS:
+        bytecode = build_bytecode(unit, args.repetitions)
+        timings = [time_bytecode(module, bytecode, args.runs) / args.repetitions * 1e9 for _, module in modules]
+
+        row = f"{name:<16}" + "".join(f"{timing:>22.0f}" for timing in timings)
+        if args.baseline:
+            row += f"{timings[0] / timings[-1]:>9.2f}x"
+        print(row)
+
+
+def bench_engines(args):
+    engines = list(vm.ENGINES)
+    print(f"{'workload':<16}" + "".join(f"{engine + ' ms':>18}" for engine in engines))
+
+    for name, body in WORKLOADS:
+        bytecode = assemble(LOOP.format(iterations=args.iterations, body=body))
+        timings = []
+        for engine in engines:
+            # jit_threshold=0 compiles on the first run, the other engines ignore it
+            evm = vm.EVM(engine=engine, jit_threshold=0, metering=not args.no_metering)
+            evm.create_contract(bytecode=bytecode, address=ADDRESS)
+
+            best = float("inf")
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                operation = evm.execute_transaction(address=ADDRESS, transaction_metadata=vm.TransactionMetadata(from_address=EOA))
+                best = min(best, time.perf_counter() - start)
+            assert operation.status == vm.OperationStatus.SUCCESS, (name, engine)
+            timings.append(best * 1e3)
+
+        print(f"{name:<16}" + "".join(f"{timing:>18.2f}" for timing in timings))
+
+
+def run_calls(bytecode, calls, fused, count=False):
+    # runs calls against a fresh contract, returns (seconds, dispatches)
+    evm = vm.EVM(code_analysis_cache=vm.CodeAnalysisCache())
+    contract = evm.create_contract(bytecode=bytecode, address=ADDRESS)
+    code_analysis = evm.code_analysis_cache.get(contract)
+    if not fused:
+        code_analysis.handlers = [vm.HANDLERS[opcode] for opcode in code_analysis.code]
+
+    dispatches = 0
+    if count:
+        def counted(handler):
+            def count_dispatch(operation, stack, program_counter):
+                nonlocal dispatches
+                dispatches += 1
+                return handler(operation, stack, program_counter)
+            return count_dispatch
+        code_analysis.handlers = [counted(handler) for handler in code_analysis.handlers]
+
+    start = time.perf_counter()
+    for data in calls:
+        operation = evm.execute_transaction(address=ADDRESS, transaction_metadata=vm.TransactionMetadata(from_address=EOA, data=data))
+        assert operation.status == vm.OperationStatus.SUCCESS, data
+    return time.perf_counter() - start, dispatches
+
+
+def bench_superinstructions(args):
+    contracts = [(name, assemble(LOOP.format(iterations=args.iterations, body=body)), ["0x"]) for name, body in WORKLOADS]
+    contracts.append(("erc20", assemble(ERC20), erc20_calls(args.iterations // 10)))
+
+    print(f"{'contract':<16}{'fused':>8}{'opcodes':>12}{'dispatches':>12}{'reduction':>11}{'plain ms':>12}{'fused ms':>12}")
+    for name, bytecode, calls in contracts:
+        _, opcodes = run_calls(bytecode, calls, fused=False, count=True)
+        _, dispatches = run_calls(bytecode, calls, fused=True, count=True)
+        plain = min(run_calls(bytecode, calls, fused=False)[0] for _ in range(args.runs))
+        fused = min(run_calls(bytecode, calls, fused=True)[0] for _ in range(args.runs))
+        num_of_superinstructions = len(vm.CodeAnalysis(bytes.fromhex(bytecode)).superinstructions)
+
+        print(f"{name:<16}{num_of_superinstructions:>8}{opcodes:>12}{dispatches:>12}{1 - dispatches / opcodes:>10.1%}"
+              f"{plain * 1e3:>12.2f}{fused * 1e3:>12.2f}")
+
+
+def dispatcher_contract(num_of_functions):
+    # solc style dispatcher over num_of_functions functions that each return their own index
+    selectors = [format(0x10000000 + index * 0x01010101, "08x") for index in range(num_of_functions)]
+    source = "PUSH1 0x00 CALLDATALOAD PUSH1 0xe0 SHR\n"
+    source += "".join(f"DUP1 PUSH4 0x{selector} EQ PUSH2 @function_{index} JUMPI\n" for index, selector in enumerate(selectors))
+    source += "PUSH1 0x00 DUP1 REVERT\n"
+    source += "".join(
+        f"function_{index}: JUMPDEST PUSH2 {index} PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN\n" for index in range(num_of_functions)
+    )
+    return assemble(source), selectors
+
+
+def bench_dispatcher(args):
+    bytecode, selectors = dispatcher_contract(args.functions)
+    calls = ["0x" + selectors[index % len(selectors)] for index in range(args.calls)]
+
+    def run(use_table):
+        evm = vm.EVM(code_analysis_cache=vm.CodeAnalysisCache())
+        contract = evm.create_contract(bytecode=bytecode, address=ADDRESS)
+        code_analysis = evm.code_analysis_cache.get(contract)
+        if not use_table:
+            for program_counter in code_analysis.selector_dispatchers:
+                code_analysis.handlers[program_counter] = vm.HANDLERS[code_analysis.code[program_counter]]
+
+        start = time.perf_counter()
+        for index, data in enumerate(calls):
+            operation = evm.execute_transaction(address=ADDRESS, transaction_metadata=vm.TransactionMetadata(from_address=EOA, data=data))
+            assert int.from_bytes(operation.return_bytes, "big") == index % len(selectors)
+        return time.perf_counter() - start
+
+    walk = min(run(use_table=False) for _ in range(args.runs))
+    table = min(run(use_table=True) for _ in range(args.runs))
+    print(f"{args.functions} functions, {args.calls} calls spread evenly over them")
+    print(f"linear walk    {walk / args.calls * 1e6:>10.1f} us/call")
+    print(f"jump table     {table / args.calls * 1e6:>10.1f} us/call    {walk / table:.2f}x")
+
+
+def synthetic_state(num_of_slots, slots_per_contract):
+    # every contract has a few state variables in slots 0..15 and a balances mapping in keccak hashed slots, kept
+    # as (key, value) bytes so every representation measured allocates its own ints and strings
+    state = []
+    for contract_index in range(num_of_slots // slots_per_contract):
+        slots = [(slot.to_bytes(32, "big"), (contract_index * 1000 + slot + 1).to_bytes(32, "big")) for slot in range(16)]
+        for holder in range(slots_per_contract - 16):
+            key = vm.keccak.new(digest_bits=256, data=(contract_index * slots_per_contract + holder).to_bytes(64, "big")).digest()
+            slots.append((key, ((holder + 1) * 10**18).to_bytes(32, "big")))
+        state.append(slots)
+    return state
+
+
+def measure(build):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    built = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, size
+
+
+def bench_storage(args):
+    state = synthetic_state(args.slots, args.slots_per_contract)
+    # the representation before Storage, unnormalized hex strings for keys and values
+    def slots_of(slots):
+        return ((int.from_bytes(key, "big"), int.from_bytes(value, "big")) for key, value in slots)
+
+    _, hex_size = measure(lambda: [{hex(key)[2:]: hex(value)[2:] for key, value in slots_of(slots)} for slots in state])
+    _, int_size = measure(lambda: [dict(slots_of(slots)) for slots in state])
+    _, storage_size = measure(lambda: [vm.Storage(slots_of(slots)) for slots in state])
+
+    print(f"{args.slots} slots in {len(state)} contracts")
+    for name, size in [("hex string dict", hex_size), ("int dict", int_size), ("Storage", storage_size)]:
+        print(f"{name:<16}{size / 2**20:>10.1f} MiB{size / args.slots:>10.1f} bytes/slot")
+
+
+def bench_keccak(args):
+    # max sizes of 0 evict every digest as soon as it's stored, the same work without the memo
+    bytecode = assemble(ERC20)
+    calls = erc20_calls(args.transfers)
+    init_code = "60" * args.init_code_size
+
+    print(f"{'workload':<24}{'hit rate':>10}{'no memo ms':>14}{'memo ms':>12}")
+    for name, run in [
+        (f"erc20 {len(calls)} calls", lambda keccak_cache: run_erc20(bytecode, calls, keccak_cache)),
+        (f"create2 {args.salts} salts", lambda keccak_cache: [
+            vm.get_create2_contract_address(EOA, salt, init_code, keccak_cache=keccak_cache) for salt in range(args.salts)
+        ]),
+    ]:
+        timings = []
+        for max_size in [0, 65536]:
+            best = float("inf")
+            for _ in range(args.runs):
+                keccak_cache = vm.KeccakCache(max_size=max_size, max_code_hashes=min(max_size, 256))
+                start = time.perf_counter()
+                run(keccak_cache)
+                best = min(best, time.perf_counter() - start)
+            timings.append(best * 1e3)
+        print(f"{name:<24}{keccak_cache.hit_rate:>10.1%}{timings[0]:>14.2f}{timings[1]:>12.2f}")
+
+
+def run_erc20(bytecode, calls, keccak_cache):
+    evm = vm.EVM(keccak_cache=keccak_cache)
+    evm.create_contract(bytecode=bytecode, address=ADDRESS)
+    for data in calls:
+        evm.execute_transaction(address=ADDRESS, transaction_metadata=vm.TransactionMetadata(from_address=EOA, data=data))
+
+
+def bench_create2(args):
+    init_code = "60" * args.init_code_size
+    salts = range(args.salts)
+
+    timings = []
+    for name, keccak_cache in [("python loop, no memo", vm.KeccakCache(max_size=0, max_code_hashes=0)), ("python loop", vm.KECCAK_CACHE)]:
+        start = time.perf_counter()
+        addresses = [vm.get_create2_contract_address(EOA, salt, init_code, keccak_cache=keccak_cache) for salt in salts]
+        timings.append((name, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    batch_addresses = keccak_batch.to_addresses(keccak_batch.create2_addresses(EOA, init_code, salts))
+    timings.append(("keccak_batch", time.perf_counter() - start))
+    assert addresses == batch_addresses
+
+    print(f"{args.salts} salts")
+    for name, timing in timings:
+        print(f"{name:<24}{args.salts / timing:>12.0f} addresses/s{timings[0][1] / timing:>8.2f}x")
+
+
+def bench_backends(args):
+    bytecode = assemble(ERC20)
+    calls = erc20_calls(args.transfers)
+    directory = tempfile.mkdtemp()
+
+    print(f"{'backend':<28}{'us/call':>10}")
+    for name, state, commit_per_transaction in [
+        ("dict", None, True),
+        ("sqlite, commit per call", SQLiteBackend(os.path.join(directory, "transaction.db")), True),
+        ("sqlite, commit per block", SQLiteBackend(os.path.join(directory, "block.db")), False),
+    ]:
+        evm = vm.EVM(state=state, commit_per_transaction=commit_per_transaction)
+        evm.create_contract(bytecode=bytecode, address=ADDRESS)
+
+        start = time.perf_counter()
+        for index, data in enumerate(calls):
+            operation = evm.execute_transaction(address=ADDRESS, transaction_metadata=vm.TransactionMetadata(from_address=EOA, data=data))
+            assert operation.status == vm.OperationStatus.SUCCESS, data
+            if not commit_per_transaction and index % args.block_size == args.block_size - 1:
+                evm.commit()
+        evm.commit()
+        print(f"{name:<28}{(time.perf_counter() - start) / len(calls) * 1e6:>10.1f}")
+
+
+def bench_state_root(args):
+    evm = vm.EVM()
+    for contract_index, slots in enumerate(synthetic_state(args.slots, args.slots_per_contract)):
+        contract = evm.create_contract(bytecode="00", address=vm.to_address(contract_index + 1))
+        for key, value in slots:
+            contract.storage[int.from_bytes(key, "big")] = int.from_bytes(value, "big")
+    evm.create_contract(bytecode=assemble(ERC20), address=ADDRESS)
+
+    start = time.perf_counter()
+    evm.state_root()
+    build = time.perf_counter() - start
+
+    # a block of transfers to new holders, every transfer writes a balance slot nobody had before
+    calls = [calldata(ERC20_MINT, EOA, 10**24)]
+    calls += [calldata(ERC20_TRANSFER, vm.to_address(10**9 + index), 1000) for index in range(args.transfers)]
+    for data in calls:
+        evm.execute_transaction(address=ADDRESS, transaction_metadata=vm.TransactionMetadata(from_address=EOA, data=data))
+    touched = sum(1 if slots is None else len(slots) + 1 for slots in evm.touched_accounts.values())
+    start = time.perf_counter()
+    state_root = evm.state_root()
+    incremental = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert evm.state_root(rebuild=True) == state_root
+    rebuild = time.perf_counter() - start
+
+    print(f"{args.slots} slots, block of {len(calls)} erc20 calls touching {touched} keys")
+    print(f"{'first build':<24}{build * 1e3:>10.1f} ms")
+    print(f"{'incremental':<24}{incremental * 1e3:>10.1f} ms")
+    print(f"{'full rebuild':<24}{rebuild * 1e3:>10.1f} ms    {rebuild / incremental:.0f}x")
+
+
+def bench_batch(args):
+    bytecode = assemble(ERC20)
+    transactions = [(ADDRESS, vm.TransactionMetadata(from_address=EOA, data=data)) for data in erc20_calls(args.transfers)]
+    directory = tempfile.mkdtemp()
+
+    print(f"{len(transactions)} erc20 calls")
+    print(f"{'mode':<36}{'tx/s':>10}{'Mgas/s':>10}")
+    for name, state, all_or_nothing in [
+        ("loop of execute_transaction, dict", None, None),
+        ("execute_batch, dict", None, False),
+        ("loop of execute_transaction, sqlite", SQLiteBackend(os.path.join(directory, "loop.db")), None),
+        ("execute_batch, sqlite", SQLiteBackend(os.path.join(directory, "batch.db")), False),
+        ("execute_batch all or nothing, sqlite", SQLiteBackend(os.path.join(directory, "all.db")), True),
+    ]:
+        evm = vm.EVM(state=state)
+        evm.create_contract(bytecode=bytecode, address=ADDRESS)
+        if all_or_nothing is None:
+            start = time.perf_counter()
+            operations = [evm.execute_transaction(address, transaction_metadata) for address, transaction_metadata in transactions]
+            elapsed = time.perf_counter() - start
+            gas_used = sum(operation.gas_used for operation in operations)
+        else:
+            batch = evm.execute_batch(transactions, all_or_nothing=all_or_nothing)
+            start = time.perf_counter()
+            operations = batch.run()
+            # the all or nothing commit happens once the batch is done and isn't part of batch.elapsed
+            elapsed = time.perf_counter() - start
+            gas_used = batch.gas_used
+        assert all(operation.status == vm.OperationStatus.SUCCESS for operation in operations)
+        print(f"{name:<36}{len(transactions) / elapsed:>10.0f}{gas_used / elapsed / 1e6:>10.2f}")
+
+
+def erc20_holders(num_of_holders):
+    # EVM with the erc20 at ADDRESS and a balance for every holder
+    evm = vm.EVM()
+    evm.create_contract(bytecode=assemble(ERC20), address=ADDRESS)
+    holders = [vm.to_address(10**6 + index) for index in range(num_of_holders)]
+    for holder in holders:
+        evm.execute_transaction(address=ADDRESS, transaction_metadata=vm.TransactionMetadata(from_address=EOA, data=calldata(ERC20_MINT, holder, 10**24)))
+    return evm, holders
+
+
+def bench_parallel(args):
+    _, holders = erc20_holders(args.transactions)
+    blocks = [
+        # every holder sends to a new address, no two transactions touch the same slot
+        ("erc20", [
+            (ADDRESS, vm.TransactionMetadata(from_address=holder, data=calldata(ERC20_TRANSFER, vm.to_address(10**7 + index), 1000)))
+            for index, holder in enumerate(holders)
+        ]),
+        # one holder sends every transfer, every transaction reads the balance the one before it wrote
+        ("high conflict", [
+            (ADDRESS, vm.TransactionMetadata(from_address=holders[0], data=calldata(ERC20_TRANSFER, vm.to_address(10**7 + index), 1000)))
+            for index in range(len(holders))
+        ]),
+    ]
+
+    print(f"{args.transactions} transactions per block, {os.cpu_count()} cpus")
+    print(f"{'block':<16}{'workers':>8}{'ms':>10}{'speedup':>10}{'re-executed':>14}")
+    for name, transactions in blocks:
+        evm, _ = erc20_holders(args.transactions)
+        start = time.perf_counter()
+        serial_results = parallel.execute_serial(evm, transactions)
+        serial = time.perf_counter() - start
+        serial_state_root = evm.state_root()
+        print(f"{name:<16}{'serial':>8}{serial * 1e3:>10.1f}{1:>10.2f}{0:>14}")
+
+        for workers in args.workers:
+            evm, _ = erc20_holders(args.transactions)
+            start = time.perf_counter()
+            results = parallel.execute_block(evm, transactions, workers=workers)
+            elapsed = time.perf_counter() - start
+            assert results == serial_results and evm.state_root() == serial_state_root
+            reexecuted = sum(result.reexecuted for result in results)
+            print(f"{name:<16}{workers:>8}{elapsed * 1e3:>10.1f}{serial / elapsed:>10.2f}{reexecuted:>14}")
+
+
+def bench_simulate(args):
+    evm, holders = erc20_holders(1)
+    calldatas = [calldata(ERC20_TRANSFER, ADDRESS, amount) for amount in range(1, args.variants + 1)]
+
+    print(f"{args.variants} transfer variants, {os.cpu_count()} cpus")
+    print(f"{'workers':<10}{'variants/s':>12}{'speedup':>10}")
+    baseline = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        for result in evm.simulate_many(ADDRESS, calldatas, holders[0], workers=workers):
+            assert result.status == vm.OperationStatus.SUCCESS
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"{workers:<10}{args.variants / elapsed:>12.0f}{baseline / elapsed:>10.2f}")
+
+
+def bench_prefork(args):
+    start = time.perf_counter()
+    evm, holders = erc20_holders(args.holders)
+    evm.precompile()
+    build = time.perf_counter() - start
+
+    path = os.path.join(tempfile.mkdtemp(), "evm.sock")
+    with PreforkServer(evm, path, workers=args.workers) as server:
+        start = time.perf_counter()
+        client = PreforkClient(path)
+        client.call(ADDRESS, holders[0], calldata(ERC20_BALANCE_OF, holders[0]))
+        first_response = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for index in range(args.requests):
+            response = client.call(ADDRESS, holders[index % len(holders)], calldata(ERC20_TRANSFER, ADDRESS, 1000))
+            assert response["status"] == "SUCCESS"
+        requests = time.perf_counter() - start
+        client.close()
+
+    print(f"{args.holders} erc20 holders, {args.workers} workers")
+    print(f"{'build and warm the EVM':<28}{build * 1e3:>10.1f} ms")
+    print(f"{'fork every worker':<28}{server.startup * 1e3:>10.1f} ms")
+    print(f"{'first response':<28}{first_response * 1e3:>10.1f} ms")
+    print(f"{'transfer requests':<28}{args.requests / requests:>10.0f} /s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    dispatch_parser = subparsers.add_parser("dispatch", help="per opcode dispatch timing")
+    dispatch_parser.add_argument("--baseline", help="git revision of vm.py to compare against")
+    dispatch_parser.add_argument("--repetitions", type=int, default=500)
+    dispatch_parser.add_argument("--runs", type=int, default=20)
+    dispatch_parser.set_defaults(func=bench_dispatch)
+
+    engines_parser = subparsers.add_parser("engines", help="workload timing on every engine")
+    engines_parser.add_argument("--iterations", type=int, default=2000)
+    engines_parser.add_argument("--runs", type=int, default=5)
+    engines_parser.add_argument("--no-metering", action="store_true", help="run without charging gas")
+    engines_parser.set_defaults(func=bench_engines)
+
+    superinstructions_parser = subparsers.add_parser("superinstructions", help="dispatches saved by superinstructions")
+    superinstructions_parser.add_argument("--iterations", type=int, default=2000)
+    superinstructions_parser.add_argument("--runs", type=int, default=5)
+    superinstructions_parser.set_defaults(func=bench_superinstructions)
+
+    dispatcher_parser = subparsers.add_parser("dispatcher", help="selector dispatcher walk against the jump table")
+    dispatcher_parser.add_argument("--functions", type=int, default=100)
+    dispatcher_parser.add_argument("--calls", type=int, default=2000)
+    dispatcher_parser.add_argument("--runs", type=int, default=5)
+    dispatcher_parser.set_defaults(func=bench_dispatcher)
+
+    storage_parser = subparsers.add_parser("storage", help="memory used by a synthetic state")
+    storage_parser.add_argument("--slots", type=int, default=1_000_000)
+    storage_parser.add_argument("--slots-per-contract", type=int, default=1000)
+    storage_parser.set_defaults(func=bench_storage)
+
+    keccak_parser = subparsers.add_parser("keccak", help="keccak memo hit rates")
+    keccak_parser.add_argument("--transfers", type=int, default=500)
+    keccak_parser.add_argument("--salts", type=int, default=20000)
+    keccak_parser.add_argument("--init-code-size", type=int, default=4096)
+    keccak_parser.add_argument("--runs", type=int, default=5)
+    keccak_parser.set_defaults(func=bench_keccak)
+
+    create2_parser = subparsers.add_parser("create2", help="batched CREATE2 address derivation")
+    create2_parser.add_argument("--salts", type=int, default=100_000)
+    create2_parser.add_argument("--init-code-size", type=int, default=4096)
+    create2_parser.set_defaults(func=bench_create2)
+
+    backends_parser = subparsers.add_parser("backends", help="state backend timing")
+    backends_parser.add_argument("--transfers", type=int, default=2000)
+    backends_parser.add_argument("--block-size", type=int, default=200)
+    backends_parser.set_defaults(func=bench_backends)
+
+    state_root_parser = subparsers.add_parser("state-root", help="incremental state root timing")
+    state_root_parser.add_argument("--slots", type=int, default=100_000)
+    state_root_parser.add_argument("--slots-per-contract", type=int, default=1000)
+    state_root_parser.add_argument("--transfers", type=int, default=200)
+    state_root_parser.set_defaults(func=bench_state_root)
+
+    batch_parser = subparsers.add_parser("batch", help="batched transaction throughput")
+    batch_parser.add_argument("--transfers", type=int, default=2000)
+    batch_parser.set_defaults(func=bench_batch)
+
+    parallel_parser = subparsers.add_parser("parallel", help="parallel block execution speedup")
+    parallel_parser.add_argument("--transactions", type=int, default=2000)
+    parallel_parser.add_argument(
+        "--workers", type=lambda workers: [int(count) for count in workers.split(",")], default=[2, 4, 8], help="comma separated worker counts"
+    )
+    parallel_parser.set_defaults(func=bench_parallel)
+
+    simulate_parser = subparsers.add_parser("simulate", help="simulate_many throughput")
+    simulate_parser.add_argument("--variants", type=int, default=20000)
+    simulate_parser.add_argument(
+        "--workers", type=lambda workers: [int(count) for count in workers.split(",")], default=[1, 2, 4], help="comma separated worker counts"
+    )
+    simulate_parser.set_defaults(func=bench_simulate)
+
+    prefork_parser = subparsers.add_parser("prefork", help="prefork server startup and throughput")
+    prefork_parser.add_argument("--holders", type=int, default=20000)
+    prefork_parser.add_argument("--workers", type=int, default=4)
+    prefork_parser.add_argument("--requests", type=int, default=2000)
+    prefork_parser.set_defaults(func=bench_prefork)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+import numpy as np
+
+
+# Batch Keccak-256
+#
+# Runs the Keccak-f[1600] permutation over many messages at once. The state is kept as 25 rows of uint64 lanes
+# with one column per message, so every step of a round is a single numpy operation over the whole batch.
+# Digests are identical to keccak.new(digest_bits=256, data=message).digest() from pycryptodome.
+
+# bytes absorbed per permutation for a 256 bit digest
+RATE = 136
+# messages permuted together, larger batches fall out of the cpu cache and get slower per message
+CHUNK_SIZE = 2048
+
+ROUND_CONSTANTS = np.array([
+    0x0000000000000001, 0x0000000000008082, 0x800000000000808a, 0x8000000080008000,
+    0x000000000000808b, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+    0x000000000000008a, 0x0000000000000088, 0x0000000080008009, 0x000000008000000a,
+    0x000000008000808b, 0x800000000000008b, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800a, 0x800000008000000a,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008,
+], dtype=np.uint64)
+
+# rotation of the lane at x, y
+ROTATIONS = [
+    [0, 36, 3, 41, 18],
+    [1, 44, 10, 45, 2],
+    [62, 6, 43, 15, 61],
+    [28, 55, 25, 21, 56],
+    [27, 20, 39, 8, 14],
+]
+
+# rho and pi as a gather, lane x + 5y moves to y + 5(2x + 3y) after its rotation. Each row of the result is
+# gathered with its first two lanes repeated at the end so chi can read x + 1 and x + 2 as plain slices
+PI_SOURCES = np.zeros((5, 7), dtype=np.intp)
+RHO_SHIFTS = np.zeros((5, 7, 1), dtype=np.uint64)
+for _x in range(5):
+    for _y in range(5):
+        _x_destination, _y_destination = _y, (2 * _x + 3 * _y) % 5
+        for _x_wrapped in {_x_destination, _x_destination + 5}:
+            if _x_wrapped < 7:
+                PI_SOURCES[_y_destination, _x_wrapped] = _x + 5 * _y
+                RHO_SHIFTS[_y_destination, _x_wrapped] = ROTATIONS[_x][_y]
+PI_SOURCES = PI_SOURCES.reshape(35)
+RHO_LEFT = RHO_SHIFTS.reshape(35, 1)
+# numpy shifts by 64 give 0, so the lane that isn't rotated still comes out unchanged
+RHO_RIGHT = np.uint64(64) - RHO_LEFT
+ONE = np.uint64(1)
+SIXTY_THREE = np.uint64(63)
+
+
+def keccak_f1600(state):
+    # state is (25, number of messages) uint64 with lane x + 5y in row x + 5y, permuted in place
+    num_of_messages = state.shape[1]
+    planes = state.reshape(5, 5, num_of_messages)
+    # theta columns with C[4] before and C[0] after so x - 1 and x + 1 are slices
+    columns = np.empty((7, num_of_messages), dtype=np.uint64)
+    gathered = np.empty((35, num_of_messages), dtype=np.uint64)
+    lanes = np.empty((35, num_of_messages), dtype=np.uint64)
+    wrapped = lanes.reshape(5, 7, num_of_messages)
+    # numpy shifts by a full array of counts much faster than by a broadcast column
+    rho_left = np.repeat(RHO_LEFT, num_of_messages, axis=1)
+    rho_right = np.repeat(RHO_RIGHT, num_of_messages, axis=1)
+
+    for round_constant in ROUND_CONSTANTS:
+        # theta
+        np.bitwise_xor.reduce(planes, axis=0, out=columns[1:6])
+        columns[0] = columns[5]
+        columns[6] = columns[1]
+        parity = (columns[2:7] << ONE) | (columns[2:7] >> SIXTY_THREE)
+        parity ^= columns[0:5]
+        planes ^= parity
+
+        # rho and pi
+        np.take(state, PI_SOURCES, axis=0, out=gathered)
+        np.left_shift(gathered, rho_left, out=lanes)
+        gathered >>= rho_right
+        lanes |= gathered
+
+        # chi
+        chi = ~wrapped[:, 1:6]
+        chi &= wrapped[:, 2:7]
+        chi ^= wrapped[:, 0:5]
+        planes[:] = chi
+
+        # iota
+        state[0] ^= round_constant
+    return state
+
+
+def to_messages(messages):
+    # 2d uint8 array with one message per row, every message has to be the same length
+    if not isinstance(messages, np.ndarray):
+        messages = list(messages)
+    # reshape can't infer the row length of an empty batch
+    if not len(messages):
+        return np.empty((0, 0), dtype=np.uint8)
+    if isinstance(messages, np.ndarray):
+        return messages.astype(np.uint8, copy=False).reshape(len(messages), -1)
+    if len({len(message) for message in messages}) > 1:
+        raise Exception("Batched messages must all be the same length")
+    return np.frombuffer(b"".join(messages), dtype=np.uint8).reshape(len(messages), -1)
+
+
+def keccak256_batch(messages):
+    # (number of messages, 32) uint8 array of digests
+    messages = to_messages(messages)
+    num_of_messages, length = messages.shape
+    if not num_of_messages:
+        return np.empty((0, 32), dtype=np.uint8)
+
+    # keccak padding, 0x01 after the message and 0x80 on the last byte of the last block
+    num_of_blocks = length // RATE + 1
+    padded = np.zeros((num_of_messages, num_of_blocks * RATE), dtype=np.uint8)
+    padded[:, :length] = messages
+    padded[:, length] ^= 0x01
+    padded[:, -1] ^= 0x80
+    words = padded.view("<u8").reshape(num_of_messages, num_of_blocks, RATE // 8)
+
+    digests = np.empty((num_of_messages, 4), dtype="<u8")
+    for chunk_start in range(0, num_of_messages, CHUNK_SIZE):
+        chunk = words[chunk_start:chunk_start+CHUNK_SIZE]
+        state = np.zeros((25, len(chunk)), dtype=np.uint64)
+        for block in range(num_of_blocks):
+            state[:RATE // 8] ^= chunk[:, block].T
+            keccak_f1600(state)
+        digests[chunk_start:chunk_start+CHUNK_SIZE] = state[:4].T
+    return digests.view(np.uint8)
+
+
+def to_words(values):
+    # (number of values, 32) uint8 array of big endian 256-bit words
+    return np.frombuffer(b"".join(value.to_bytes(32, "big") for value in values), dtype=np.uint8).reshape(-1, 32)
+
+
+def mapping_slots(keys, slot):
+    # storage slots of keys in the solidity mapping at slot, keccak256(key . slot)
+    keys = to_words(keys)
+    messages = np.empty((len(keys), 64), dtype=np.uint8)
+    messages[:, :32] = keys
+    messages[:, 32:] = to_words([slot])
+    return keccak256_batch(messages)
+
+
+def create2_addresses(origin_address, initialisation_code, salts):
+    # (number of salts, 20) uint8 array, the batch version of get_create2_contract_address
+    if not isinstance(salts, np.ndarray):
+        salts = to_words(salts)
+    init_code_hash = keccak256_batch([bytes.fromhex(initialisation_code)])[0]
+
+    messages = np.empty((len(salts), 85), dtype=np.uint8)
+    messages[:, 0] = 0xff
+    messages[:, 1:21] = np.frombuffer(bytes.fromhex(origin_address[2:]), dtype=np.uint8)
+    messages[:, 21:53] = salts
+    messages[:, 53:] = init_code_hash
+    return keccak256_batch(messages)[:, 12:]
+
+
+def to_addresses(addresses):
+    # 0x prefixed hex strings of a (number of addresses, 20) uint8 array
+    hex_addresses = addresses.tobytes().hex()
+    return ["0x" + hex_addresses[index:index+40] for index in range(0, len(hex_addresses), 40)]
+
+
+def find_create2_salt(origin_address, initialisation_code, predicate, start=0, count=2**20, batch_size=4096):
+    # first salt in [start, start + count) whose CREATE2 address satisfies predicate, as (salt, address) or None
+    for batch_start in range(start, start + count, batch_size):
+        salts = range(batch_start, min(batch_start + batch_size, start + count))
+        addresses = to_addresses(create2_addresses(origin_address, initialisation_code, salts))
+        for salt, address in zip(salts, addresses):
+            if predicate(address):
+                return salt, address
+    return None
@@ -0,0 +1,131 @@
+"""Load generator for the JSON-RPC server in rpc.py.
+
+    python loadgen.py                           # serve an erc20 and a slow contract, report p50/p99 per method
+    python loadgen.py --slow-calls 0            # only fast calls and transfers
+    python loadgen.py --no-server --port 8545   # load a server that is already running
+
+Every connection sends its requests one after the other, a mix of eth_call balanceOf, eth_sendTransaction
+transfers and eth_calls of a contract that loops for a long time.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import sys
+import time
+
+import bench
+import rpc
+import vm
+
+
+SLOW_ADDRESS = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+
+
+def slow_contract(iterations):
+    # PUSH3 iterations JUMPDEST PUSH1 0x01 SWAP1 SUB DUP1 PUSH1 0x04 JUMPI STOP
+    return "62" + format(iterations, "06x") + "5b600190038060045700"
+
+
+def run_server(port, holders, slow_iterations):
+    evm, _ = bench.erc20_holders(holders)
+    evm.create_contract(bytecode=slow_contract(slow_iterations), address=SLOW_ADDRESS)
+    asyncio.run(rpc.serve_forever(evm, "127.0.0.1", port, slice_steps=1000))
+
+
+async def post(reader, writer, payload):
+    body = json.dumps(payload).encode()
+    writer.write(f"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+async def connection(port, args, holders, latencies, deadline, seed):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    random_numbers = random.Random(seed)
+    request_id = 0
+    while time.perf_counter() < deadline:
+        holder = holders[random_numbers.randrange(len(holders))]
+        draw = random_numbers.random()
+        if draw < args.slow_calls:
+            method, params = "eth_call (slow)", [{"to": SLOW_ADDRESS, "from": holder}, "latest"]
+        elif draw < args.slow_calls + args.transactions:
+            data = bench.calldata(bench.ERC20_TRANSFER, bench.ADDRESS, 1)
+            method, params = "eth_sendTransaction", [{"to": bench.ADDRESS, "from": holder, "data": data}]
+        else:
+            data = bench.calldata(bench.ERC20_BALANCE_OF, holder)
+            method, params = "eth_call", [{"to": bench.ADDRESS, "from": holder, "data": data}, "latest"]
+
+        request_id += 1
+        start = time.perf_counter()
+        response = await post(reader, writer, {"jsonrpc": "2.0", "id": request_id, "method": method.split()[0], "params": params})
+        latencies.setdefault(method, []).append(time.perf_counter() - start)
+        assert "result" in response, response
+    writer.close()
+
+
+def percentile(latencies, fraction):
+    return sorted(latencies)[int(fraction * (len(latencies) - 1))]
+
+
+async def generate_load(args):
+    holders = [vm.to_address(10**6 + index) for index in range(args.holders)]
+    latencies = {}
+    deadline = time.perf_counter() + args.duration
+    await asyncio.gather(*[connection(args.port, args, holders, latencies, deadline, seed) for seed in range(args.connections)])
+    return latencies
+
+
+def wait_for_server(port):
+    for _ in range(600):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception(f"No server on port {port}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--no-server", action="store_true", help="load a server that is already running")
+    parser.add_argument("--holders", type=int, default=1000)
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds")
+    parser.add_argument("--transactions", type=float, default=0.1, help="fraction of eth_sendTransaction")
+    parser.add_argument("--slow-calls", type=float, default=0.01, help="fraction of slow eth_calls")
+    parser.add_argument("--slow-iterations", type=int, default=100_000)
+    args = parser.parse_args(argv)
+
+    server = None
+    if not args.no_server:
+        server = multiprocessing.get_context("fork").Process(target=run_server, args=(args.port, args.holders, args.slow_iterations))
+        server.start()
+    try:
+        wait_for_server(args.port)
+        latencies = asyncio.run(generate_load(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    num_of_requests = sum(len(method_latencies) for method_latencies in latencies.values())
+    print(f"{num_of_requests / args.duration:.0f} requests/s over {args.connections} connections")
+    print(f"{'method':<22}{'requests':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for method, method_latencies in sorted(latencies.items()):
+        print(f"{method:<22}{len(method_latencies):>10}{percentile(method_latencies, 0.5) * 1e3:>10.2f}{percentile(method_latencies, 0.99) * 1e3:>10.2f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
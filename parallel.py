@@ -0,0 +1,379 @@
+import multiprocessing
+import os
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from vm import (
+    DEFAULT_GAS, DELETED, EVM, MISSING, OperationStatus, TransactionMetadata, ForkedContract, ForkedContracts, Overlay,
+    undo_create_contract, undo_log, undo_nonce, undo_storage
+)
+
+
+# Parallel block execution
+#
+# Block-STM style optimistic execution of a block over a process pool. The block is cut into contiguous chunks and
+# every worker runs its chunk in order on a fork of the state the block starts from, recording what each
+# transaction reads (the slots and accounts it saw, with the values it saw) and what it writes. The parent then
+# validates the transactions in block order: a transaction whose reads all still hold in the state left by the
+# transactions before it commits its writes as they are, any other transaction is re-executed in the parent on
+# that state. Validation compares values, so results and the final state are identical to running the block
+# serially. Workers are forked from the parent and read its state copy-on-write, the state backend has to be one
+# that can be read after a fork, like the default DictBackend.
+
+class Recorder:
+    """Reads and writes of the transaction running on a worker."""
+
+    def __init__(self):
+        self.active = True
+        self.reset()
+
+    def reset(self):
+        # (address, slot) to the value read and address to (code hash, nonce) or None for reads of missing accounts
+        self.slot_reads = {}
+        self.account_reads = {}
+        # reads of what the transaction wrote itself don't depend on other transactions
+        self.written_slots = set()
+        self.written_accounts = set()
+
+    def read_slot(self, address, key, value):
+        slot = (address, key)
+        if self.active and slot not in self.slot_reads and slot not in self.written_slots:
+            self.slot_reads[slot] = value
+
+    def read_account(self, address, contract):
+        if self.active and address not in self.account_reads and address not in self.written_accounts:
+            self.account_reads[address] = account_summary(contract)
+
+
+def account_summary(contract):
+    return None if contract is None else (contract.code_hash, contract.nonce)
+
+
+class RecordingStorage(Overlay):
+    """Storage of a contract on a worker, reads are recorded and writes kept in the overlay."""
+
+    def __init__(self, parent, recorder, address):
+        super().__init__(parent)
+        self.recorder = recorder
+        self.address = address
+
+    def get(self, key, default=None):
+        value = super().get(key)
+        self.recorder.read_slot(self.address, key, value or 0)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self.recorder.written_slots.add((self.address, key))
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.recorder.written_slots.add((self.address, key))
+        super().__delitem__(key)
+
+
+class RecordingContracts(ForkedContracts):
+    """address_to_contract of a worker, a fork of the block's starting state that records account reads."""
+
+    def __init__(self, parent, recorder):
+        super().__init__(parent)
+        self.recorder = recorder
+
+    def get(self, address, default=None):
+        contract = self.writes.get(address, MISSING)
+        if contract is MISSING:
+            contract = self.parent.get(address)
+            if contract is not None:
+                contract = ForkedContract(self, contract)
+                contract.storage = RecordingStorage(contract.storage.parent, self.recorder, address)
+                self.writes[address] = contract
+        elif contract is DELETED:
+            contract = None
+        self.recorder.read_account(address, contract)
+        return default if contract is None else contract
+
+    def __contains__(self, address):
+        # CREATE2 checks for a contract at its address this way, it is a read like any other
+        return self.get(address) is not None
+
+    def __setitem__(self, address, contract):
+        self.recorder.written_accounts.add(address)
+        if not isinstance(contract.storage, RecordingStorage):
+            contract.storage = RecordingStorage(contract.storage, self.recorder, address)
+        self.writes[address] = contract
+
+    def __delitem__(self, address):
+        self.recorder.written_accounts.add(address)
+        super().__delitem__(address)
+
+
+class TransactionResult:
+    """What a transaction of a block did, the same whether it ran on a worker or in the parent."""
+
+    def __init__(self, operation, writes, reexecuted=False):
+        self.status = operation.status
+        self.return_bytes = bytes(operation.return_bytes)
+        self.gas_used = operation.gas_used
+        # (address, log) in the order they were emitted
+        self.logs = writes.logs
+        # (address, slot) to the value it was left with, 0 for cleared slots
+        self.storage = writes.slots
+        # address to the code of every contract it created, and address to the nonce it left
+        self.created = writes.created
+        self.nonces = writes.nonces
+        # validation failed and the transaction ran again in the parent
+        self.reexecuted = reexecuted
+
+    def __eq__(self, other):
+        return (
+            (self.status, self.return_bytes, self.gas_used, self.logs, self.storage, self.created, self.nonces) ==
+            (other.status, other.return_bytes, other.gas_used, other.logs, other.storage, other.created, other.nonces)
+        )
+
+    def __str__(self):
+        return (
+            f"TransactionResult(status={self.status}, return_bytes={self.return_bytes.hex()}, gas_used={self.gas_used}, "
+            f"logs={self.logs}, storage={self.storage}, created={self.created}, nonces={self.nonces}, "
+            f"reexecuted={self.reexecuted})"
+        )
+
+
+class Writes:
+    """State a transaction wrote, taken from the journal it left."""
+
+    def __init__(self, journal):
+        # address to the code of the contracts it created, their storage starts out empty
+        self.created = {}
+        # (address, slot) to the final value
+        self.slots = {}
+        # address to the final nonce
+        self.nonces = {}
+        # (address, log) in the order they were emitted
+        self.logs = []
+
+        contracts = {}
+        emitted = []
+        for undo, *args in journal:
+            if undo is undo_storage:
+                contract, key, _ = args
+                contracts[contract.address] = contract
+                self.slots[(contract.address, key)] = None
+            elif undo is undo_nonce:
+                contract = args[0]
+                contracts[contract.address] = contract
+                self.nonces[contract.address] = None
+            elif undo is undo_log:
+                emitted.append(args[0])
+            elif undo is undo_create_contract:
+                address_to_contract, address, _ = args
+                contracts[address] = address_to_contract.get(address)
+                self.created[address] = None
+
+        for address in self.created:
+            self.created[address] = contracts[address].code
+        for address, key in self.slots:
+            self.slots[(address, key)] = contracts[address].storage.get(key, 0)
+        for address in self.nonces:
+            self.nonces[address] = contracts[address].nonce
+        # the logs of a contract are the last ones on it, in the order they were appended
+        num_of_logs = Counter(contract.address for contract in emitted)
+        for contract in emitted:
+            self.logs.append((contract.address, contract.logs[-num_of_logs[contract.address]]))
+            num_of_logs[contract.address] -= 1
+
+    def apply(self, evm):
+        # writes through the EVM so state roots see them, the journal they leave is dropped
+        state = evm.address_to_contract
+        for address, code in self.created.items():
+            evm.create_contract(bytecode=code, address=address)
+        for (address, key), value in self.slots.items():
+            evm.set_storage(state[address], key, value)
+        for address, nonce in self.nonces.items():
+            state[address].nonce = nonce
+            evm.touch(address)
+        for address, log in self.logs:
+            state[address].logs.append(log)
+        evm.journal = []
+
+
+def execute_steps(evm, address, transaction_metadata, steps=None):
+    # generator that runs a transaction on evm steps opcodes at a time, see EVM.execute_transaction_steps, yielding
+    # its operation between slices. Returns (TransactionResult, Writes) once the transaction is done, the journal is
+    # kept until its writes are taken. Writes made before it, e.g. contracts created outside any transaction, aren't
+    # the transaction's
+    journal_checkpoint = len(evm.journal)
+    evm.batch_journal = True
+    try:
+        for operation in evm.execute_transaction_steps(address, transaction_metadata, steps):
+            if operation.status == OperationStatus.EXECUTING:
+                yield operation
+        writes = Writes(evm.journal[journal_checkpoint:])
+    finally:
+        evm.batch_journal = False
+        evm.journal = []
+    return TransactionResult(operation, writes), writes
+
+
+def execute(evm, address, transaction_metadata):
+    # (TransactionResult, Writes) of a transaction run on evm in one go, execute_steps never yields without steps
+    try:
+        next(execute_steps(evm, address, transaction_metadata))
+    except StopIteration as stop:
+        return stop.value
+    raise Exception("execute_steps yielded without steps")
+
+
+def is_valid(state, slot_reads, account_reads):
+    # True when every read still sees the value the transaction saw
+    for address, summary in account_reads.items():
+        if account_summary(state.get(address)) != summary:
+            return False
+    for (address, key), value in slot_reads.items():
+        contract = state.get(address)
+        if (contract.storage.get(key, 0) if contract is not None else 0) != value:
+            return False
+    return True
+
+
+# set in every worker when the pool starts, (state the workers run on, EVM keyword arguments)
+WORKER_STATE = None
+
+
+def init_worker(state, evm_kwargs):
+    global WORKER_STATE
+    WORKER_STATE = (state, evm_kwargs)
+
+
+def worker_pool(evm, workers):
+    # workers are forked, they start with the parent's state and caches without pickling them
+    evm_kwargs = {
+        "code_analysis_cache": evm.code_analysis_cache,
+        "max_call_depth": evm.max_call_depth,
+        "engine": evm.engine,
+        "jit_threshold": evm.jit_threshold,
+        "metering": evm.metering,
+        "block_gas_limit": evm.block_gas_limit,
+        "keccak_cache": evm.keccak_cache,
+    }
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork"), initializer=init_worker,
+        initargs=(evm.address_to_contract, evm_kwargs)
+    )
+
+
+def run_chunk(transactions):
+    # (result, writes, slot reads, account reads) of every transaction in the chunk, None for the ones that raised
+    state, evm_kwargs = WORKER_STATE
+    recorder = Recorder()
+    evm = EVM(state=RecordingContracts(state, recorder), **evm_kwargs)
+
+    outcomes = []
+    for address, transaction_metadata in transactions:
+        recorder.reset()
+        try:
+            # taking the writes reads storage, those reads aren't the transaction's
+            recorder.active = True
+            evm.batch_journal = True
+            operation = evm.execute_transaction(address, transaction_metadata)
+            recorder.active = False
+            writes = Writes(evm.journal)
+        except Exception:
+            # runs again in the parent, which raises it there if it still does
+            outcomes.append(None)
+            continue
+        finally:
+            recorder.active = False
+            evm.batch_journal = False
+            evm.journal = []
+        outcomes.append((TransactionResult(operation, writes), writes, recorder.slot_reads, recorder.account_reads))
+    return outcomes
+
+
+def execute_serial(evm, transactions):
+    # TransactionResult of every (address, TransactionMetadata) in order, run one after the other on evm
+    results = []
+    for address, transaction_metadata in transactions:
+        result, _ = execute(evm, address, transaction_metadata)
+        results.append(result)
+    evm.commit()
+    return results
+
+
+def execute_block(evm, transactions, workers=None, chunk_size=None):
+    # TransactionResult of every (address, TransactionMetadata) in order, with evm's state left as if they ran
+    # serially. Chunks default to a few per worker so workers that finish early pick up more
+    transactions = list(transactions)
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(transactions) <= 1:
+        return execute_serial(evm, transactions)
+    chunk_size = chunk_size or max(1, len(transactions) // (workers * 4))
+    chunks = [transactions[start:start + chunk_size] for start in range(0, len(transactions), chunk_size)]
+
+    state = evm.address_to_contract
+    results = []
+    with worker_pool(evm, workers) as executor:
+        transaction_iterator = iter(transactions)
+        # chunks come back in block order while later ones still run
+        for outcomes in executor.map(run_chunk, chunks):
+            for outcome in outcomes:
+                address, transaction_metadata = next(transaction_iterator)
+                if outcome is not None:
+                    result, writes, slot_reads, account_reads = outcome
+                    if is_valid(state, slot_reads, account_reads):
+                        writes.apply(evm)
+                        results.append(result)
+                        continue
+                result, _ = execute(evm, address, transaction_metadata)
+                result.reexecuted = True
+                results.append(result)
+    evm.commit()
+    return results
+
+
+# Simulations
+#
+# Many variants of one call against the same state, e.g. quotes for a range of amounts. Every variant runs on its
+# own fork of the state so none of them sees another's writes, and nothing is written to the state itself.
+
+def simulate(evm, address, from_address, gas, calldatas):
+    # TransactionResult of address called with every calldata on its own fork of evm
+    results = []
+    for calldata in calldatas:
+        result, _ = execute(evm.fork(), address, TransactionMetadata(from_address=from_address, data=calldata, gas=gas))
+        results.append(result)
+    return results
+
+
+def simulate_chunk(address, from_address, gas, calldatas):
+    state, evm_kwargs = WORKER_STATE
+    return simulate(EVM(state=state, **evm_kwargs), address, from_address, gas, calldatas)
+
+
+def simulate_many(evm, address, calldatas, from_address, workers=None, chunk_size=None, gas=DEFAULT_GAS):
+    # yields the TransactionResult of every calldata in order as the chunks come back from the workers, the state
+    # is shipped once by forking the workers and only the compact results travel back
+    calldatas = list(calldatas)
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        yield from simulate(evm, address, from_address, gas, calldatas)
+        return
+    chunk_size = chunk_size or max(1, min(1000, len(calldatas) // (workers * 4)))
+    chunks = [calldatas[start:start + chunk_size] for start in range(0, len(calldatas), chunk_size)]
+
+    executor = worker_pool(evm, workers)
+    try:
+        num_of_chunks = len(chunks)
+        for results in executor.map(simulate_chunk, [address] * num_of_chunks, [from_address] * num_of_chunks, [gas] * num_of_chunks, chunks):
+            yield from results
+    finally:
+        # chunks nobody is waiting for anymore are dropped
+        executor.shutdown(cancel_futures=True)
@@ -0,0 +1,127 @@
+import gc
+import json
+import os
+import signal
+import socket
+import time
+
+from parallel import execute
+from vm import DEFAULT_GAS, TransactionMetadata
+
+
+# Prefork server
+#
+# The parent builds and warms one EVM, loads the state and precompiles every contract, then os.fork()s the
+# workers. Workers share the parent's pages copy-on-write, so starting one takes as long as a fork. They all
+# accept() on the same unix socket the parent bound before forking. Every request runs on a fresh EVM.fork() of the
+# pristine state the worker inherited and the fork is dropped afterwards, so no request sees another's writes. A
+# worker serves one connection at a time until the client closes it.
+#
+# Requests and responses are JSON objects, one per line:
+#   {"to": "0x...", "from": "0x...", "data": "0x...", "gas": 30000000}
+#   {"status": "SUCCESS", "return": "0x...", "gas_used": 21000, "logs": [[address, log]], "storage": [[address, slot, value]]}
+# A request that can't be run gets {"error": message}.
+
+def handle_request(evm, request):
+    transaction_metadata = TransactionMetadata(
+        from_address=request["from"], data=request.get("data", "0x"), gas=request.get("gas", DEFAULT_GAS)
+    )
+    result, _ = execute(evm.fork(), request["to"], transaction_metadata)
+    return {
+        "status": result.status.name,
+        "return": "0x" + result.return_bytes.hex(),
+        "gas_used": result.gas_used,
+        "logs": result.logs,
+        "storage": [[address, hex(slot), hex(value)] for (address, slot), value in result.storage.items()],
+    }
+
+
+def serve_connection(evm, connection):
+    with connection, connection.makefile("rwb") as stream:
+        for line in stream:
+            try:
+                response = handle_request(evm, json.loads(line))
+            except Exception as e:
+                response = {"error": str(e)}
+            stream.write(json.dumps(response).encode() + b"\n")
+            stream.flush()
+
+
+def run_worker(evm, listener):
+    # never returns, the worker exits without running anything the parent registered to run at exit
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while True:
+            connection, _ = listener.accept()
+            serve_connection(evm, connection)
+    finally:
+        os._exit(0)
+
+
+class PreforkServer:
+    """Unix socket server of forked workers sharing one warm EVM."""
+
+    def __init__(self, evm, path, workers=4):
+        self.evm = evm
+        self.path = path
+        self.workers = workers
+        self.listener = None
+        self.pids = []
+        # seconds it took to fork every worker
+        self.startup = 0.0
+
+    def start(self):
+        self.evm.precompile()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(128)
+
+        # objects made so far are never collected, so the collector doesn't write to the pages workers share
+        gc.freeze()
+        start = time.perf_counter()
+        for _ in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                run_worker(self.evm, self.listener)
+            self.pids.append(pid)
+        self.startup = time.perf_counter() - start
+        return self
+
+    def stop(self):
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+        self.pids = []
+        self.listener.close()
+        os.unlink(self.path)
+        gc.unfreeze()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class PreforkClient:
+    """Connection to a PreforkServer, requests on one connection are served by the same worker."""
+
+    def __init__(self, path):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(path)
+        self.stream = self.connection.makefile("rwb")
+
+    def call(self, to, from_address, data="0x", gas=DEFAULT_GAS):
+        request = {"to": to, "from": from_address, "data": data, "gas": gas}
+        self.stream.write(json.dumps(request).encode() + b"\n")
+        self.stream.flush()
+        response = json.loads(self.stream.readline())
+        if "error" in response:
+            raise Exception(response["error"])
+        return response
+
+    def close(self):
+        self.stream.close()
+        self.connection.close()
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import itertools
+import json
+
+from collections import OrderedDict
+
+from Crypto.Hash import keccak
+
+from parallel import execute_steps
+from vm import DEFAULT_GAS, EVM, OperationStatus, TransactionMetadata
+
+
+# JSON-RPC server
+#
+# An asyncio HTTP server for the standard eth_call, eth_sendTransaction, eth_getStorageAt and
+# eth_getTransactionReceipt methods, with JSON-RPC batches. Only the latest state is served, block parameters are
+# accepted and ignored.
+#
+# The state is versioned with forks. eth_sendTransaction runs on a fork of the latest version, one at a time in the
+# order they arrived, and that fork becomes the latest version. Reads run on a fork of the version that was latest
+# when they arrived, so writes that land while a read runs never show in it. Whenever nothing runs the versions are
+# merged into the EVM the server was given, which keeps the chain of forks reads go through short.
+#
+# Executions run on the event loop a slice of slice_steps opcodes at a time (see EVM.execute_transaction_steps) and
+# every other request that is ready runs between two slices, so a long eth_call only delays cheap requests by a
+# slice instead of until it is done. Everything runs on one thread, a slice is as long as the event loop is blocked.
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+# what geth answers for reverted eth_calls
+EXECUTION_REVERTED = 3
+
+ZERO_ADDRESS = "0x" + "00" * 20
+
+
+class RPCError(Exception):
+    """Error sent back to the client as the JSON-RPC error object."""
+
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def to_json(self):
+        error = {"code": self.code, "message": self.message}
+        if self.data is not None:
+            error["data"] = self.data
+        return error
+
+
+def to_transaction(params):
+    if not params or not isinstance(params[0], dict) or "to" not in params[0]:
+        raise RPCError(INVALID_PARAMS, "Expected a transaction object with a to address")
+    transaction = params[0]
+    try:
+        transaction_metadata = TransactionMetadata(
+            from_address=transaction.get("from", ZERO_ADDRESS),
+            data=transaction.get("data", transaction.get("input", "0x")),
+            gas=int(transaction.get("gas", hex(DEFAULT_GAS)), 16),
+        )
+    except Exception as e:
+        raise RPCError(INVALID_PARAMS, str(e))
+    return transaction["to"].lower(), transaction_metadata
+
+
+def to_log(address, log):
+    topics = [log[f"topic{topic_num}"] for topic_num in range(len(log) - 1)]
+    return {"address": address, "data": log["data"], "topics": topics}
+
+
+class RPCServer:
+    """JSON-RPC over HTTP for an EVM, reads run on snapshots and writes one at a time."""
+
+    def __init__(self, evm, slice_steps=1000, max_versions=64, max_receipts=65536):
+        self.evm = evm
+        evm.precompile()
+        # forks stacked on evm by writes since the last merge, the last one is the latest state
+        self.versions = []
+        self.max_versions = max_versions
+        # requests running on one of the versions, versions are only merged when there are none
+        self.num_of_running = 0
+        self.merged = asyncio.Condition()
+
+        # opcodes an execution runs before the other requests get their turn
+        self.slice_steps = slice_steps
+        self.write_lock = asyncio.Lock()
+
+        self.transaction_count = itertools.count()
+        # receipts of the latest max_receipts transactions, older ones are dropped
+        self.receipts = OrderedDict()
+        self.max_receipts = max_receipts
+        self.methods = {
+            "eth_call": self.eth_call,
+            "eth_sendTransaction": self.eth_send_transaction,
+            "eth_getStorageAt": self.eth_get_storage_at,
+            "eth_getTransactionReceipt": self.eth_get_transaction_receipt,
+        }
+
+    @property
+    def latest(self):
+        return self.versions[-1] if self.versions else self.evm
+
+    async def begin(self):
+        # waits while too many versions are stacked for reads to stay fast
+        async with self.merged:
+            await self.merged.wait_for(lambda: len(self.versions) < self.max_versions)
+        self.num_of_running += 1
+
+    async def end(self):
+        self.num_of_running -= 1
+        if self.num_of_running or not self.versions:
+            return
+        for version in self.versions:
+            self.evm.merge(version)
+        self.versions = []
+        self.evm.commit()
+        async with self.merged:
+            self.merged.notify_all()
+
+    async def run(self, evm, address, transaction_metadata):
+        # (TransactionResult, Writes) of the transaction run on evm a slice at a time
+        execution = execute_steps(evm, address, transaction_metadata, self.slice_steps)
+        while True:
+            try:
+                next(execution)
+            except StopIteration as stop:
+                return stop.value
+            await asyncio.sleep(0)
+
+    async def eth_call(self, params):
+        address, transaction_metadata = to_transaction(params)
+        await self.begin()
+        try:
+            result, _ = await self.run(self.latest.fork(), address, transaction_metadata)
+        finally:
+            await self.end()
+        if result.status != OperationStatus.SUCCESS:
+            raise RPCError(EXECUTION_REVERTED, "execution reverted", "0x" + result.return_bytes.hex())
+        return "0x" + result.return_bytes.hex()
+
+    async def eth_send_transaction(self, params):
+        address, transaction_metadata = to_transaction(params)
+        async with self.write_lock:
+            await self.begin()
+            try:
+                version = self.latest.fork()
+                result, _ = await self.run(version, address, transaction_metadata)
+                self.versions.append(version)
+            finally:
+                await self.end()
+
+        transaction_hash = "0x" + keccak.new(
+            digest_bits=256, data=json.dumps([next(self.transaction_count), params[0]]).encode()
+        ).hexdigest()
+        self.receipts[transaction_hash] = {
+            "transactionHash": transaction_hash,
+            "status": "0x1" if result.status == OperationStatus.SUCCESS else "0x0",
+            "gasUsed": hex(result.gas_used),
+            "logs": [to_log(address, log) for address, log in result.logs],
+        }
+        if len(self.receipts) > self.max_receipts:
+            self.receipts.popitem(last=False)
+        return transaction_hash
+
+    async def eth_get_storage_at(self, params):
+        try:
+            address, position = params[0].lower(), int(params[1], 16)
+        except (IndexError, AttributeError, TypeError, ValueError):
+            raise RPCError(INVALID_PARAMS, "Expected an address and a storage position")
+        contract = self.latest.address_to_contract.get(address)
+        value = contract.storage.get(position, 0) if contract is not None else 0
+        return "0x" + format(value, "064x")
+
+    async def eth_get_transaction_receipt(self, params):
+        if not params or not isinstance(params[0], str):
+            raise RPCError(INVALID_PARAMS, "Expected a transaction hash")
+        return self.receipts.get(params[0].lower())
+
+    async def handle_request(self, request):
+        # response object of a single request, None for notifications
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return {"jsonrpc": "2.0", "id": None, "error": RPCError(INVALID_REQUEST, "Invalid request").to_json()}
+        request_id = request.get("id")
+        try:
+            method = self.methods.get(request["method"])
+            if method is None:
+                raise RPCError(METHOD_NOT_FOUND, f"Method {request['method']} not found")
+            result = await method(request.get("params", []))
+            response = {"jsonrpc": "2.0", "id": request_id, "result": result}
+        except RPCError as e:
+            response = {"jsonrpc": "2.0", "id": request_id, "error": e.to_json()}
+        except Exception as e:
+            response = {"jsonrpc": "2.0", "id": request_id, "error": RPCError(INTERNAL_ERROR, str(e)).to_json()}
+        return response if "id" in request else None
+
+    async def handle_body(self, body):
+        # response body of a request body, b"" when there is nothing to answer
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return json.dumps({"jsonrpc": "2.0", "id": None, "error": RPCError(PARSE_ERROR, "Parse error").to_json()}).encode()
+
+        if not isinstance(payload, list):
+            response = await self.handle_request(payload)
+            return json.dumps(response).encode() if response is not None else b""
+        if not payload:
+            return json.dumps({"jsonrpc": "2.0", "id": None, "error": RPCError(INVALID_REQUEST, "Empty batch").to_json()}).encode()
+        # the requests of a batch run concurrently, writes still run in the order of the batch
+        responses = await asyncio.gather(*[self.handle_request(request) for request in payload])
+        responses = [response for response in responses if response is not None]
+        return json.dumps(responses).encode() if responses else b""
+
+    async def respond(self, writer, status, response):
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: application/json\r\n"
+            + f"Content-Length: {len(response)}\r\n\r\n".encode() + response
+        )
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep alive, every request is a POST of a JSON-RPC body
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError(content_length)
+                except ValueError:
+                    # where the body ends is unknown, answer and drop the connection
+                    response = json.dumps({
+                        "jsonrpc": "2.0", "id": None, "error": RPCError(PARSE_ERROR, "Invalid Content-Length").to_json()
+                    }).encode()
+                    await self.respond(writer, b"400 Bad Request", response)
+                    break
+                body = await reader.readexactly(content_length)
+
+                response = await self.handle_body(body)
+                await self.respond(writer, b"200 OK", response)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8545):
+        # asyncio server, use it as an async context manager or await serve_forever() on it
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def serve_forever(evm, host, port, slice_steps):
+    server = await RPCServer(evm, slice_steps=slice_steps).serve(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="JSON-RPC server over an empty EVM")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--slice-steps", type=int, default=1000, help="opcodes an execution runs before others get a turn")
+    args = parser.parse_args(argv)
+    asyncio.run(serve_forever(EVM(), args.host, args.port, args.slice_steps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import json
+import sqlite3
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from vm import Contract
+
+
+# SQLite state backend
+#
+# Accounts, code by code hash, logs and storage slots live in a SQLite file. Contracts loaded since the last commit
+# are kept in memory until the commit writes their changes, committed contracts and slot values stay in bounded
+# LRU caches. Slot keys and values are stored as 32 byte big endian blobs.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    address TEXT PRIMARY KEY,
+    nonce INTEGER NOT NULL,
+    code_hash BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS code (
+    code_hash BLOB PRIMARY KEY,
+    code BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS storage (
+    address TEXT NOT NULL,
+    slot BLOB NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (address, slot)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS logs (
+    address TEXT NOT NULL,
+    log_index INTEGER NOT NULL,
+    log TEXT NOT NULL,
+    PRIMARY KEY (address, log_index)
+) WITHOUT ROWID;
+"""
+
+
+class DiskStorage(MutableMapping):
+    """Storage of a contract in a SQLiteBackend, writes are buffered until the backend commits."""
+
+    def __init__(self, backend, address, cleared=False):
+        self.backend = backend
+        self.address = address
+        # slot to value written since the last commit, 0 for deleted slots
+        self.dirty = {}
+        # the slots on disk belong to a contract this one replaced and are deleted on commit
+        self.cleared = cleared
+
+    def get(self, key, default=None):
+        value = self.dirty.get(key)
+        if value is None:
+            value = 0 if self.cleared else self.backend.load_slot(self.address, key)
+        return value or default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if not self.dirty:
+            self.backend.dirty_storages[id(self)] = self
+        self.dirty[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self[key] = 0
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        keys = set() if self.cleared else set(self.backend.stored_slots(self.address))
+        for key, value in self.dirty.items():
+            if value:
+                keys.add(key)
+            else:
+                keys.discard(key)
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class SQLiteBackend(MutableMapping):
+    """State backend over a SQLite file with LRU caches of hot contracts and slots."""
+
+    def __init__(self, path, contract_cache_size=4096, slot_cache_size=65536):
+        self.connection = sqlite3.connect(path)
+        # commits append to the write ahead log without waiting on fsync, a crash can lose the last commits but
+        # never leaves a half written one
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+        # contracts loaded or set since the last commit to (contract, (nonce, number of logs) when loaded)
+        self.touched = {}
+        # addresses deleted since the last commit
+        self.deleted = set()
+        # id to every DiskStorage with writes since the last commit, mappings aren't hashable
+        self.dirty_storages = {}
+
+        self.contract_cache_size = contract_cache_size
+        self.contract_cache = OrderedDict()
+        self.slot_cache_size = slot_cache_size
+        # (address, slot) to the committed value, 0 for slots that are empty on disk
+        self.slot_cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load_contract(self, address):
+        row = self.connection.execute(
+            "SELECT nonce, code FROM accounts JOIN code USING (code_hash) WHERE address = ?", (address,)
+        ).fetchone()
+        if row is None:
+            return None
+        nonce, code = row
+        contract = Contract(bytecode=code, address=address)
+        contract.nonce = nonce
+        contract.logs = [
+            json.loads(log) for log, in self.connection.execute("SELECT log FROM logs WHERE address = ? ORDER BY log_index", (address,))
+        ]
+        contract.storage = DiskStorage(self, address)
+        return contract
+
+    def get(self, address, default=None):
+        entry = self.touched.get(address)
+        if entry is not None:
+            return entry[0]
+        if address in self.deleted:
+            return default
+
+        contract = self.contract_cache.pop(address, None)
+        if contract is None:
+            contract = self.load_contract(address)
+            if contract is None:
+                return default
+        # kept until the next commit, the transaction may change it
+        self.touched[address] = (contract, (contract.nonce, len(contract.logs)))
+        return contract
+
+    def __getitem__(self, address):
+        contract = self.get(address)
+        if contract is None:
+            raise KeyError(address)
+        return contract
+
+    def __setitem__(self, address, contract):
+        if not (isinstance(contract.storage, DiskStorage) and contract.storage.backend is self):
+            # a new contract replaces whatever storage the address had
+            slots = contract.storage
+            contract.storage = DiskStorage(self, address, cleared=True)
+            contract.storage.update(slots)
+            self.dirty_storages[id(contract.storage)] = contract.storage
+        # an undone CREATE puts back the contract it replaced, the replacement's writes go away with it
+        previous = self.touched.get(address)
+        if previous is not None and previous[0].storage is not contract.storage:
+            self.dirty_storages.pop(id(previous[0].storage), None)
+        self.deleted.discard(address)
+        self.contract_cache.pop(address, None)
+        self.touched[address] = (contract, None)
+
+    def __delitem__(self, address):
+        if self.get(address) is None:
+            raise KeyError(address)
+        contract, _ = self.touched.pop(address)
+        self.dirty_storages.pop(id(contract.storage), None)
+        self.deleted.add(address)
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+    def __iter__(self):
+        addresses = {address for address, in self.connection.execute("SELECT address FROM accounts")}
+        addresses.update(self.touched)
+        addresses.difference_update(self.deleted)
+        return iter(addresses)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def load_slot(self, address, key):
+        cache_key = (address, key)
+        value = self.slot_cache.get(cache_key)
+        if value is not None:
+            self.hits += 1
+            self.slot_cache.move_to_end(cache_key)
+            return value
+
+        self.misses += 1
+        row = self.connection.execute(
+            "SELECT value FROM storage WHERE address = ? AND slot = ?", (address, key.to_bytes(32, "big"))
+        ).fetchone()
+        value = int.from_bytes(row[0], "big") if row else 0
+        self.cache_slot(cache_key, value)
+        return value
+
+    def cache_slot(self, cache_key, value):
+        self.slot_cache[cache_key] = value
+        self.slot_cache.move_to_end(cache_key)
+        if len(self.slot_cache) > self.slot_cache_size:
+            self.slot_cache.popitem(last=False)
+
+    def stored_slots(self, address):
+        for slot, in self.connection.execute("SELECT slot FROM storage WHERE address = ?", (address,)):
+            yield int.from_bytes(slot, "big")
+
+    def uncache_slots(self, addresses):
+        # slow path, only when a contract is deleted or replaced
+        for cache_key in [cache_key for cache_key in self.slot_cache if cache_key[0] in addresses]:
+            del self.slot_cache[cache_key]
+
+    def commit(self):
+        # one sqlite transaction for everything changed since the last commit
+        dirty_storages = list(self.dirty_storages.values())
+        cleared = {storage.address for storage in dirty_storages if storage.cleared}
+        with self.connection:
+            execute = self.connection.execute
+            for address in self.deleted | cleared:
+                execute("DELETE FROM storage WHERE address = ?", (address,))
+            for address in self.deleted:
+                execute("DELETE FROM accounts WHERE address = ?", (address,))
+                execute("DELETE FROM logs WHERE address = ?", (address,))
+
+            for address, (contract, loaded) in self.touched.items():
+                if loaded == (contract.nonce, len(contract.logs)):
+                    continue
+                # logs are only ever appended once committed
+                num_of_logs = loaded[1] if loaded else 0
+                if loaded is None:
+                    execute("INSERT OR IGNORE INTO code (code_hash, code) VALUES (?, ?)", (contract.code_hash, contract.code))
+                    execute("DELETE FROM logs WHERE address = ?", (address,))
+                execute(
+                    "INSERT OR REPLACE INTO accounts (address, nonce, code_hash) VALUES (?, ?, ?)",
+                    (address, contract.nonce, contract.code_hash)
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO logs (address, log_index, log) VALUES (?, ?, ?)",
+                    [(address, log_index, json.dumps(log)) for log_index, log in enumerate(contract.logs[num_of_logs:], num_of_logs)]
+                )
+
+            for storage in dirty_storages:
+                slots = [(storage.address, key.to_bytes(32, "big"), value) for key, value in storage.dirty.items()]
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO storage (address, slot, value) VALUES (?, ?, ?)",
+                    [(address, slot, value.to_bytes(32, "big")) for address, slot, value in slots if value]
+                )
+                self.connection.executemany(
+                    "DELETE FROM storage WHERE address = ? AND slot = ?",
+                    [(address, slot) for address, slot, value in slots if not value]
+                )
+
+        # committed values move to the caches
+        if self.deleted or cleared:
+            self.uncache_slots(self.deleted | cleared)
+        for storage in dirty_storages:
+            for key, value in storage.dirty.items():
+                self.cache_slot((storage.address, key), value)
+            storage.dirty = {}
+            storage.cleared = False
+        for address, (contract, _) in self.touched.items():
+            self.contract_cache[address] = contract
+            if len(self.contract_cache) > self.contract_cache_size:
+                self.contract_cache.popitem(last=False)
+
+        self.touched = {}
+        self.deleted = set()
+        self.dirty_storages = {}
+
+    def close(self):
+        self.commit()
+        self.connection.close()
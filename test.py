@@ -1,6 +1,24 @@
+import asyncio
+import json
+import os
+import tempfile
 import unittest
 
-from vm import EVM, TransactionMetadata, get_create_contract_address, get_create2_contract_address
+from Crypto.Hash import keccak
+
+import keccak_batch
+import parallel
+import rlp
+from prefork import PreforkClient, PreforkServer
+from rpc import RPCServer
+from sqlite_backend import SQLiteBackend
+from trie import BLANK_ROOT, Trie
+
+from vm import (
+    EVM, CodeAnalysis, CodeAnalysisCache, Contract, KeccakCache, Operation, OperationMetadata, OperationStatus, Storage,
+    TransactionMetadata,
+    get_create_contract_address, get_create2_contract_address
+)
 
 
 class UtilTestCase(unittest.TestCase):
@@ -76,9 +94,178 @@ class UtilTestCase(unittest.TestCase):
         )
 
 
+class CodeAnalysisTestCase(unittest.TestCase):
+    def test_jumpdests(self):
+        # JUMPDEST
+        # PUSH1 0x5b
+        # JUMPDEST
+        # PUSH2 0x5b5b
+        code_analysis = CodeAnalysis(bytes.fromhex("5b605b5b615b5b"))
+        self.assertEqual(code_analysis.code_size, 7)
+        self.assertEqual(list(code_analysis.jumpdests), [1, 0, 0, 1, 0, 0, 0])
+
+    def test_push_values(self):
+        # PUSH2 0xffee
+        # PUSH0
+        # PUSH3 0x01 (truncated)
+        code_analysis = CodeAnalysis(bytes.fromhex("61ffee5f6201"))
+        self.assertEqual(code_analysis.push_values[0], 0xffee)
+        self.assertEqual(code_analysis.push_values[3], 0)
+        self.assertEqual(code_analysis.push_values[4], 0x01)
+
+    def test_superinstructions(self):
+        # PUSH1 0xaa PUSH1 0x40 MSTORE
+        # PUSH1 0x40 MLOAD (fused)
+        # DUP1 PUSH1 0x0f AND (fused)
+        # PUSH1 0x01 PUSH1 0x04 SHL (fused)
+        # PUSH4 0x12345678
+        # PUSH4 0x12345678 EQ PUSH1 0x20 JUMPI (fused)
+        # STOP
+        # JUMPDEST
+        # PUSH1 0x00 PUSH1 0x40 JUMPI (PUSH1 0x40 JUMPI fused)
+        # STOP
+        code_analysis = CodeAnalysis(bytes.fromhex("60aa604052" "604051" "80600f16" "600160041b" "6312345678" "63123456781460205700" "5b" "600060405700"))
+        self.assertEqual(code_analysis.superinstructions, {5: 2, 8: 3, 12: 3, 22: 4, 35: 2})
+
+    def test_selector_dispatchers(self):
+        # PUSH1 0x00 CALLDATALOAD PUSH1 0xe0 SHR
+        # DUP1 PUSH4 0x11111111 EQ PUSH1 0x27 JUMPI
+        # DUP1 PUSH4 0x22222222 EQ PUSH1 0x2b JUMPI
+        # DUP1 PUSH4 0x33333333 EQ PUSH1 0x40 JUMPI (invalid destination)
+        # PUSH1 0xff STOP
+        # JUMPDEST PUSH1 0x01 STOP
+        # JUMPDEST PUSH1 0x02 STOP
+        code_analysis = CodeAnalysis(bytes.fromhex("60003560e01c" "80631111111114602757" "80632222222214602b57" "80633333333314604057" "60ff00" "5b600100" "5b600200"))
+        self.assertEqual(list(code_analysis.selector_dispatchers), [6, 16, 26])
+
+        # a repeated selector ends the chain, a chain of a single entry is left alone
+        # DUP1 PUSH4 0x11111111 EQ PUSH1 0x00 JUMPI x 2
+        code_analysis = CodeAnalysis(bytes.fromhex("80631111111114600057" * 2))
+        self.assertEqual(code_analysis.selector_dispatchers, {})
+
+    def test_cache(self):
+        code_analysis_cache = CodeAnalysisCache(max_size=1)
+        contract_1 = Contract(bytecode="6001", address="0xd8da6bf26964af9d7eed9e03e53415d37aa96045")
+        contract_2 = Contract(bytecode="6001", address="0xd8da6bf26964af9d7eed9e03e53415d37aa96046")
+        contract_3 = Contract(bytecode="6002", address="0xd8da6bf26964af9d7eed9e03e53415d37aa96047")
+
+        code_analysis = code_analysis_cache.get(contract_1)
+        self.assertIs(code_analysis_cache.get(contract_2), code_analysis)
+        self.assertEqual((code_analysis_cache.hits, code_analysis_cache.misses), (1, 1))
+
+        # evicts the analysis shared by contract_1 and contract_2
+        code_analysis_cache.get(contract_3)
+        self.assertIsNot(code_analysis_cache.get(contract_1), code_analysis)
+        self.assertEqual((code_analysis_cache.hits, code_analysis_cache.misses), (1, 3))
+
+        # changing the bytecode changes the code hash
+        contract_1.bytecode = "6002"
+        self.assertEqual(contract_1.code_hash, contract_3.code_hash)
+
+
+class KeccakCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        keccak_cache = KeccakCache(max_size=2)
+        self.assertEqual(keccak_cache.keccak256(b"").hex(), "c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470")
+        keccak_cache.keccak256(b"a")
+        keccak_cache.keccak256(b"")
+        keccak_cache.keccak256(bytearray(b"b"))
+        # b"a" was the least recently used
+        self.assertEqual(list(keccak_cache.preimage_to_digest), [b"", b"b"])
+        self.assertEqual((keccak_cache.hits, keccak_cache.misses), (1, 3))
+        self.assertEqual(keccak_cache.hit_rate, 0.25)
+
+    def test_max_preimage_size(self):
+        keccak_cache = KeccakCache(max_preimage_size=64)
+        keccak_cache.keccak256(b"a" * 64)
+        self.assertEqual(keccak_cache.keccak256(bytearray(b"a" * 65)), keccak.new(digest_bits=256, data=b"a" * 65).digest())
+        # only the 64 byte preimage is kept
+        self.assertEqual(list(keccak_cache.preimage_to_digest), [b"a" * 64])
+        self.assertEqual(keccak_cache.misses, 2)
+
+    def test_code_hash(self):
+        keccak_cache = KeccakCache(max_code_hashes=1)
+        init_code = "60" * 200
+        for salt in range(3):
+            get_create2_contract_address("0x6ac7ea33f8831ea9dcc53393aaa88b25a785dbf0", salt, init_code, keccak_cache=keccak_cache)
+        # the init code is hashed once, the 85 byte preimages are all different
+        self.assertEqual((keccak_cache.hits, keccak_cache.misses), (2, 4))
+        self.assertEqual(keccak_cache.code_hash(bytes.fromhex(init_code)), keccak.new(digest_bits=256, data=bytes.fromhex(init_code)).digest())
+        self.assertEqual(list(keccak_cache.code_hashes), [bytes.fromhex(init_code)])
+
+    def test_sha3_slot_origin(self):
+        keccak_cache = KeccakCache()
+        evm = EVM(keccak_cache=keccak_cache)
+        # PUSH1 0x05 PUSH1 0x00 MSTORE PUSH1 0x03 PUSH1 0x20 MSTORE PUSH1 0x40 PUSH1 0x00 SHA3
+        evm.create_contract(bytecode="600560005260036020526040600020", address="0xd8da6bf26964af9d7eed9e03e53415d37aa96045")
+        for _ in range(2):
+            operation = evm.execute_transaction(
+                address="0xd8da6bf26964af9d7eed9e03e53415d37aa96045",
+                transaction_metadata=TransactionMetadata(from_address="0xd8da6bf26964af9d7eed9e03e53415d37aa96047")
+            )
+        self.assertEqual((keccak_cache.hits, keccak_cache.misses), (1, 1))
+        self.assertEqual(keccak_cache.slot_origin(int(operation.stack[0], 16)), (5, 3))
+        self.assertIsNone(keccak_cache.slot_origin(0))
+
+
+class KeccakBatchTestCase(unittest.TestCase):
+    def test_keccak256_batch(self):
+        # single and multi block messages around the 136 byte rate
+        for length in [0, 1, 64, 135, 136, 137, 300]:
+            messages = [bytes([index] * length) for index in range(3)]
+            digests = keccak_batch.keccak256_batch(messages)
+            self.assertEqual([bytes(digest) for digest in digests], [keccak.new(digest_bits=256, data=message).digest() for message in messages])
+
+    def test_empty(self):
+        self.assertEqual(keccak_batch.keccak256_batch([]).shape, (0, 32))
+        self.assertEqual(keccak_batch.mapping_slots([], 3).shape, (0, 32))
+        self.assertEqual(keccak_batch.to_addresses(keccak_batch.create2_addresses("0x" + "00" * 20, "00", [])), [])
+
+    def test_mapping_slots(self):
+        slots = keccak_batch.mapping_slots([1, 2**160 - 1], 3)
+        self.assertEqual(bytes(slots[1]), keccak.new(digest_bits=256, data=(2**160 - 1).to_bytes(32, "big") + (3).to_bytes(32, "big")).digest())
+
+    def test_create2_addresses(self):
+        origin_address = "0x6ac7ea33f8831ea9dcc53393aaa88b25a785dbf0"
+        addresses = keccak_batch.create2_addresses(origin_address, "63ffffffff6000526004601cf3", range(10))
+        self.assertEqual(
+            keccak_batch.to_addresses(addresses),
+            [get_create2_contract_address(origin_address, salt, "63ffffffff6000526004601cf3") for salt in range(10)]
+        )
+
+    def test_find_create2_salt(self):
+        origin_address = "0x6ac7ea33f8831ea9dcc53393aaa88b25a785dbf0"
+        salt, address = keccak_batch.find_create2_salt(origin_address, "", lambda address: address.startswith("0x00"), batch_size=100)
+        self.assertEqual(address, get_create2_contract_address(origin_address, salt, ""))
+        self.assertFalse(any(get_create2_contract_address(origin_address, other, "").startswith("0x00") for other in range(salt)))
+
+        self.assertIsNone(keccak_batch.find_create2_salt(origin_address, "", lambda address: False, start=10, count=50))
+
+
+class StorageTestCase(unittest.TestCase):
+    def test_int_slots(self):
+        storage = Storage({0: 1, 5: 0xff, 2**255: 2})
+        self.assertEqual(storage, {0: 1, 5: 0xff, 2**255: 2})
+        self.assertEqual(storage.get(4), None)
+        self.assertEqual(storage.get(10**6, 0), 0)
+
+    def test_zero_deletes(self):
+        storage = Storage({0: 1, 5: 0xff, 2**255: 2})
+        storage[5] = 0
+        storage[2**255] = 0
+        storage[7] = 0
+        self.assertEqual(storage, {0: 1})
+        self.assertEqual(len(storage), 1)
+        self.assertNotIn(5, storage)
+        with self.assertRaises(KeyError):
+            del storage[5]
+
+
 class OpcodeTestCase(unittest.TestCase):
+    evm_options = {"engine": "interpreter"}
+
     def setUp(self):
-        self.evm = EVM()
+        self.evm = EVM(**self.evm_options)
         self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
         self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
         self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
@@ -133,6 +320,60 @@ class OpcodeTestCase(unittest.TestCase):
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, ["ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff", "0"])
 
+    def test_stack_limit(self):
+        # PUSH0 x 1024
+        self.evm.create_contract(bytecode="5f" * 1024, address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.SUCCESS)
+        self.assertEqual(len(operation.stack), 1024)
+        self.assertEqual(operation.stack_words[-1], 0)
+
+        # PUSH0 x 1025
+        self.evm.create_contract(bytecode="5f" * 1025, address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+
+    def test_superinstructions(self):
+        # same code as CodeAnalysisTestCase.test_superinstructions
+        self.evm.create_contract(bytecode="60aa604052" "604051" "80600f16" "600160041b" "6312345678" "63123456781460205700" "5b" "600060405700", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.SUCCESS)
+        self.assertEqual(operation.stack, ["aa", "a", "10"])
+        self.assertEqual(operation.program_counter, 39)
+        self.assertEqual("".join(operation.memory), "00" * 0x5f + "aa")
+
+        # PUSH1 0x01 PUSH1 0x10 JUMPI (fused, invalid destination)
+        self.evm.create_contract(bytecode="6001601057", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(operation.stack, [])
+
+        # PUSH1 0x01 x 1023
+        # DUP1 PUSH1 0x0f AND (fused), DUP1 still fits on the stack and PUSH1 overflows it
+        self.evm.create_contract(bytecode="6001" * 1023 + "80600f16", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(len(operation.stack), 1024)
+
+    def test_selector_dispatcher(self):
+        # same code as CodeAnalysisTestCase.test_selector_dispatchers
+        self.evm.create_contract(bytecode="60003560e01c" "80631111111114602757" "80632222222214602b57" "80633333333314604057" "60ff00" "5b600100" "5b600200", address=self.address_1)
+
+        for selector, status, stack, program_counter in [
+            ("11111111", OperationStatus.SUCCESS, ["11111111", "1"], 43),
+            ("22222222", OperationStatus.SUCCESS, ["22222222", "2"], 47),
+            ("33333333", OperationStatus.FAILURE, ["33333333"], 0),
+            ("44444444", OperationStatus.SUCCESS, ["44444444", "ff"], 39),
+        ]:
+            operation = self.evm.execute_transaction(
+                address=self.address_1,
+                transaction_metadata=TransactionMetadata(from_address=self.eoa_1, data="0x" + selector),
+            )
+            self.assertEqual(operation.status, status)
+            self.assertEqual(operation.stack, stack)
+            if status == OperationStatus.SUCCESS:
+                self.assertEqual(operation.program_counter, program_counter)
+
     def test_dup1(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='600180'_
         # PUSH1 0x01
@@ -425,6 +666,11 @@ class OpcodeTestCase(unittest.TestCase):
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, ["ffffffffffff"])
 
+        self.evm = EVM(**self.evm_options, block_gas_limit=30_000_000)
+        self.evm.create_contract(bytecode="45", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.stack, ["1c9c380"])
+
     def test_chainid(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='46'_
         # CHAINID
@@ -723,7 +969,7 @@ class OpcodeTestCase(unittest.TestCase):
         contract = self.evm.create_contract(bytecode="602e600055600054600154", address=self.address_1)
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, ["2e", "0"])
-        self.assertEqual(contract.storage, {"0": "2e"})
+        self.assertEqual(contract.storage, {0: 0x2e})
 
     def test_sstore(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='61ffff6000556100ff61230555'_
@@ -736,7 +982,7 @@ class OpcodeTestCase(unittest.TestCase):
         contract = self.evm.create_contract(bytecode="61ffff6000556100ff61230555", address=self.address_1)
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, [])
-        self.assertEqual(contract.storage, {"0": "ffff", "2305": "ff"})
+        self.assertEqual(contract.storage, {0: 0xffff, 0x2305: 0xff})
 
     def test_mstore(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='~052~152'~60ff600%01~_
@@ -829,6 +1075,34 @@ class OpcodeTestCase(unittest.TestCase):
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, ["1"])
 
+    def test_jump_past_code(self):
+        # PUSH1 0xff
+        # JUMP
+        self.evm.create_contract(bytecode="60ff56", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+
+    def test_jump_into_push_data(self):
+        # PUSH1 0x04
+        # JUMP
+        # PUSH1 0x5b
+        self.evm.create_contract(bytecode="600456605b", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+
+    def test_not_implemented(self):
+        # PUSH1 0x01
+        # PUSH1 0x01
+        # SSTORE
+        # PUSH1 0x01
+        # PUSH1 0x01
+        # SDIV
+        # STOP
+        contract = self.evm.create_contract(bytecode="6001600155600160010500", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(contract.storage, {})
+
     def test_pc(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='58585b58600158'_
         # PC
@@ -861,6 +1135,16 @@ class OpcodeTestCase(unittest.TestCase):
             "ff00000000000000000000000000000000000000000000000000000000000000",
         ])
 
+    def test_calldataload_bytes(self):
+        # PUSH1 0x10
+        # CALLDATALOAD
+        self.evm.create_contract(bytecode="601035", address=self.address_1)
+        transaction_metadata = TransactionMetadata(data=bytes.fromhex("ab" * 20), from_address=self.eoa_1)
+        self.assertEqual(transaction_metadata.data, "0x" + "ab" * 20)
+
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=transaction_metadata)
+        self.assertEqual(operation.stack, ["abababab" + "00" * 28])
+
     def test_calldatasize(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&callData=0xff&codeType=Bytecode&code=%2736%27_
         # CALLDATASIZE
@@ -883,6 +1167,17 @@ class OpcodeTestCase(unittest.TestCase):
         self.assertEqual(operation.stack, [])
         self.assertEqual("".join(operation.memory), "ff00000000000000ffffffffffffffffffffffffffffffffffffffffffffffff")
 
+    def test_calldatacopy_past_calldata(self):
+        # PUSH1 0x40
+        # PUSH1 0x1e
+        # PUSH1 0x01
+        # CALLDATACOPY
+        self.evm.create_contract(bytecode="6040601e600137", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(data="0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff", from_address=self.eoa_1))
+        self.assertEqual(operation.stack, [])
+        self.assertEqual(operation.memory_bytes, bytearray(b"\x00\xff\xff" + bytes(93)))
+        self.assertEqual(operation.memory[1:4], ["ff", "ff", "00"])
+
     def test_log0(self):
         # PUSH1 0xff
         # PUSH1 0x00
@@ -983,7 +1278,7 @@ class OpcodeTestCase(unittest.TestCase):
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, [])
         self.assertEqual("".join(operation.memory), "ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef0000000000000000000000000000000000000000000000000000000000000000")
-        self.assertEqual(operation.return_bytes, "ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef0000")
+        self.assertEqual(operation.return_bytes, bytes.fromhex("ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef0000"))
 
     def test_sha3(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='7fffffffffyyyy6z5260046z20'~zz0z000y~~%01yz~_
@@ -1049,7 +1344,7 @@ class OpcodeTestCase(unittest.TestCase):
         self.assertEqual(operation.stack, [])
         self.assertEqual("".join(operation.memory), "0000000000000000000000000000000000000000000000000000000000000042")
         self.assertEqual(contract.storage, {})
-        self.assertEqual(operation.return_bytes, "0x0000000000000000000000000000000000000000000000000000000000000042")
+        self.assertEqual(operation.return_bytes, bytes.fromhex("0000000000000000000000000000000000000000000000000000000000000042"))
 
     def test_call(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='600035600757fe5b'_
@@ -1086,7 +1381,123 @@ class OpcodeTestCase(unittest.TestCase):
         operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, ["0", "1"])
         self.assertEqual("".join(operation.memory), "00000000000000000000000000000067600035600757fe5b60005260086018f3")
-        self.assertEqual(operation.return_bytes, "")
+        self.assertEqual(operation.return_bytes, b"")
+
+        # calldata of the second call is the memory word
+        self.assertEqual(operation.child_operations[0].transaction_metadata.calldata, b"")
+        self.assertEqual(operation.child_operations[1].transaction_metadata.data, "0x00000000000000000000000000000067600035600757fe5b60005260086018f3")
+
+    def test_call_return_data(self):
+        # PUSH1 0x20
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH20 0xd8da6bf26964af9d7eed9e03e53415d37aa96045
+        # PUSH2 0xffff
+        # CALL
+        # RETURNDATASIZE
+        self.evm.create_contract(bytecode="60206000600060006000" + "73d8da6bf26964af9d7eed9e03e53415d37aa96045" + "61fffff13d", address=self.address_2)
+
+        # PUSH1 0x42 PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN, and the same ending in REVERT
+        for bytecode, success in [("604260005260206000f3", "1"), ("604260005260206000fd", "0")]:
+            self.evm.create_contract(bytecode=bytecode, address=self.address_1)
+            operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+            self.assertEqual(operation.stack, [success, "20"])
+            self.assertEqual("".join(operation.memory), "00" * 31 + "42")
+            self.assertEqual(operation.child_operations[0].return_bytes, bytes(31) + b"\x42")
+
+    def test_call_parent_revert(self):
+        # PUSH1 0x01
+        # PUSH1 0x00
+        # SSTORE
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # LOG0
+        contract_1 = self.evm.create_contract(bytecode="600160005560006000a0", address=self.address_1)
+
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH20 0xd8da6bf26964af9d7eed9e03e53415d37aa96045
+        # PUSH2 0xffff
+        # CALL
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # REVERT
+        self.evm.create_contract(bytecode="6000600060006000600073d8da6bf26964af9d7eed9e03e53415d37aa9604561fffff160006000fd", address=self.address_2)
+
+        operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(contract_1.storage, {})
+        self.assertEqual(contract_1.logs, [])
+        self.assertEqual(self.evm.journal, [])
+
+    def test_call_child_failure(self):
+        # PUSH1 0x01
+        # PUSH1 0x00
+        # SSTORE
+        # INVALID
+        contract_1 = self.evm.create_contract(bytecode="6001600055fe", address=self.address_1)
+
+        # PUSH1 0x02
+        # PUSH1 0x00
+        # SSTORE
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH20 0xd8da6bf26964af9d7eed9e03e53415d37aa96045
+        # PUSH2 0xffff
+        # CALL
+        contract_2 = self.evm.create_contract(bytecode="60026000556000600060006000600073d8da6bf26964af9d7eed9e03e53415d37aa9604561fffff1", address=self.address_2)
+
+        operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.stack, ["0"])
+        self.assertEqual(contract_1.storage, {})
+        self.assertEqual(contract_2.storage, {0: 2})
+
+    def test_call_depth(self):
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # ADDRESS
+        # PUSH2 0xffff
+        # CALL
+        # metered calls only pass on all but 1/64 of the gas and run out long before 1024 frames
+        for max_call_depth in [3, 1024]:
+            self.evm = EVM(**self.evm_options, max_call_depth=max_call_depth, metering=False)
+            self.evm.create_contract(bytecode="600060006000600060003061fffff1", address=self.address_1)
+            operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+            self.assertEqual(operation.stack, ["1"])
+
+            depth = 0
+            while operation.child_operations:
+                operation = operation.child_operations[0]
+                depth += 1
+                self.assertEqual(operation.depth, depth)
+            self.assertEqual(depth, max_call_depth)
+            # the deepest CALL is over the limit and fails without running
+            self.assertEqual(operation.stack, ["0"])
+
+    def test_call_empty_account(self):
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH20 0xd8da6bf26964af9d7eed9e03e53415d37aa96045
+        # PUSH2 0xffff
+        # CALL
+        self.evm.create_contract(bytecode="6000600060006000600073d8da6bf26964af9d7eed9e03e53415d37aa9604561fffff1", address=self.address_2)
+        operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.stack, ["1"])
+        self.assertNotIn(self.address_1, self.evm.address_to_contract)
 
     def test_staticcall(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='7f7f7rrrrrft7wt7wtv0uvs7fy0vsv9u00604s604dxxf0xxxx8463zwa'~000zwwy~~~x6~wfffv602uxf3yyyytx52s052rzz%01rstuvwxyz~_
@@ -1115,7 +1526,7 @@ class OpcodeTestCase(unittest.TestCase):
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
         self.assertEqual(operation.stack, ["3e4ea2156166390f880071d94458efb098473311", "1"])
         self.assertEqual("".join(operation.memory), "7f7fffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff6000527fff60005260206000f3000000000000000000000000000000000000000000000060205260296000f300000000000000000000000000000000000000")
-        self.assertEqual(operation.return_bytes, "")
+        self.assertEqual(operation.return_bytes, b"")
 
     def test_create(self):
         # https://www.evm.codes/playground?fork=shanghai&unit=Wei&codeType=Bytecode&code='~x~~z9f06c63ffffffffy4601cf3ydx'~z0z600y~52zx~~f0%01xyz~_
@@ -1170,7 +1581,7 @@ class OpcodeTestCase(unittest.TestCase):
         # PUSH1 0x00
         # PUSH1 0x00
         # REVERT
-        self.evm = EVM()
+        self.evm = EVM(**self.evm_options)
 
         contract = self.evm.create_contract(bytecode="600060006000f0600060006009f06c63ffffffff6000526004601cf3600052600d60136000f060006000fd", address=self.address_1)
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
@@ -1212,7 +1623,7 @@ class OpcodeTestCase(unittest.TestCase):
         # PUSH1 0x13
         # PUSH1 0x00
         # CREATE
-        self.evm = EVM()
+        self.evm = EVM(**self.evm_options)
 
         contract = self.evm.create_contract(bytecode="600060006000f0600060006009f060fe6000526001601f6000f06c63ffffffff6000526004601cf3600052600d60136000f0", address=self.address_1)
         operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
@@ -1270,3 +1681,900 @@ class OpcodeTestCase(unittest.TestCase):
         self.assertEqual(self.evm.address_to_contract[created_contract_1_address].bytecode, "")
         self.assertEqual(self.evm.address_to_contract[created_contract_2_address].bytecode, "")
         self.assertEqual(self.evm.address_to_contract[created_contract_3_address].bytecode, "ffffffff")
+
+    def test_gas(self):
+        # GAS
+        # GAS
+        self.evm.create_contract(bytecode="5a5a", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.stack, [hex(30_000_000 - 21000 - 2)[2:], hex(30_000_000 - 21000 - 4)[2:]])
+        self.assertEqual(operation.gas_used, 21000 + 4)
+
+    def test_gas_memory_expansion(self):
+        # PUSH1 0x01
+        # PUSH1 0xff
+        # MSTORE
+        self.evm.create_contract(bytecode="600160ff52", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        # 9 words of memory
+        self.assertEqual(operation.gas_used, 21000 + 9 + 27)
+
+    def test_gas_exp(self):
+        # PUSH32 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
+        # PUSH1 0x02
+        # EXP
+        # STOP
+        self.evm.create_contract(bytecode="7f" + "ff" * 32 + "60020a00", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        # 50 per byte of the exponent
+        self.assertEqual(operation.gas_used, 21000 + 16 + 50 * 32)
+
+    def test_gas_memory_expansion_out_of_gas(self):
+        # PUSH1 0x01
+        # PUSH1 0x02
+        # PUSH3 0xffffff
+        # MSTORE
+        self.evm.create_contract(bytecode="6001600262ffffff52", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1, gas=100_000))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        # MSTORE popped its offset but not yet its value
+        self.assertEqual(operation.stack, ["1", "2"])
+
+        # PUSH1 0x01
+        # PUSH3 0xffffff
+        # MLOAD
+        self.evm.create_contract(bytecode="600162ffffff51", address=self.address_2)
+        operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1, gas=100_000))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(operation.stack, ["1"])
+
+    def test_gas_intrinsic(self):
+        self.evm.create_contract(bytecode="", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1, data="0x0001"))
+        self.assertEqual(operation.gas_used, 21000 + 4 + 16)
+
+        with self.assertRaises(Exception):
+            self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1, gas=20999))
+
+    def test_gas_sstore(self):
+        # PUSH1 0x01
+        # PUSH1 0x00
+        # SSTORE
+        self.evm.create_contract(bytecode="6001600055", address=self.address_1)
+        # cold slot set from zero, then a cold slot written with the value it already has
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.gas_used, 21000 + 6 + 2100 + 20000)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.gas_used, 21000 + 6 + 2100 + 100)
+
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # SSTORE
+        contract = self.evm.create_contract(bytecode="6000600055", address=self.address_2)
+        contract.storage[0] = 1
+        # clearing the slot refunds 4800
+        operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.gas_used, 21000 + 6 + 2100 + 2900 - 4800)
+        self.assertEqual(contract.storage, {})
+
+    def test_gas_sstore_stipend(self):
+        # PUSH1 0x01
+        # PUSH1 0x00
+        # SSTORE
+        self.evm.create_contract(bytecode="6001600055", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1, gas=21000 + 6 + 2300))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(self.evm.address_to_contract[self.address_1].storage, {})
+
+    def test_out_of_gas(self):
+        # JUMPDEST
+        # PUSH1 0x00
+        # JUMP
+        self.evm.create_contract(bytecode="5b600056", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1, gas=100_000))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(operation.gas, 0)
+        self.assertEqual(operation.gas_used, 100_000)
+
+    def test_call_gas(self):
+        # GAS
+        self.evm.create_contract(bytecode="5a", address=self.address_1)
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH1 0x00
+        # PUSH20 0xd8da6bf26964af9d7eed9e03e53415d37aa96045
+        # GAS
+        # CALL
+        self.evm.create_contract(bytecode="6000600060006000600073d8da6bf26964af9d7eed9e03e53415d37aa960455af1", address=self.address_2)
+        operation = self.evm.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.stack, ["1"])
+
+        # the cold account access is charged before all but 1/64 of the gas left is passed on
+        available = 30_000_000 - 21000 - 20 - 2600
+        child_gas = available - available // 64
+        self.assertEqual(operation.child_operations[0].stack, [hex(child_gas - 2)[2:]])
+        self.assertEqual(operation.gas_used, 21000 + 20 + 2600 + 2)
+
+    def test_metering_disabled(self):
+        # GAS
+        # PUSH1 0x01
+        # PUSH1 0x00
+        # SSTORE
+        self.evm = EVM(**self.evm_options, metering=False)
+        self.evm.create_contract(bytecode="5a6001600055", address=self.address_1)
+        operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.stack, [hex(30_000_000)[2:]])
+        self.assertEqual(operation.gas_used, 0)
+
+
+class ThreadedOpcodeTestCase(OpcodeTestCase):
+    # runs every opcode test again on the threaded engine
+    evm_options = {"engine": "threaded"}
+
+
+class JitOpcodeTestCase(OpcodeTestCase):
+    # runs every opcode test again on the jit engine, compiling the code on its first run
+    evm_options = {"engine": "jit", "jit_threshold": 0}
+
+
+class JitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.code_analysis_cache = CodeAnalysisCache()
+        self.evm = EVM(code_analysis_cache=self.code_analysis_cache, engine="jit", jit_threshold=2)
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+
+    def test_threshold(self):
+        # PUSH1 0x03
+        # loop: JUMPDEST
+        # PUSH1 0x01 SWAP1 SUB
+        # DUP1 PUSH1 0x02 JUMPI
+        # PUSH1 0x00 SSTORE
+        contract = self.evm.create_contract(bytecode="60035b6001900380600257600055", address=self.address_1)
+        code_analysis = self.code_analysis_cache.get(contract)
+
+        for call_count in range(1, 5):
+            operation = self.evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+            self.assertEqual(operation.status, OperationStatus.SUCCESS)
+            self.assertEqual(operation.stack, [])
+            self.assertEqual(contract.storage, {})
+
+            # compiled on the first run past the threshold
+            self.assertEqual(code_analysis.call_count, min(call_count, 3))
+            # the EVM meters gas so the metered blocks are the ones compiled
+            self.assertIsNone(code_analysis.jit_blocks)
+            if call_count <= 2:
+                self.assertIsNone(code_analysis.metered_jit_blocks)
+            else:
+                self.assertIsNotNone(code_analysis.metered_jit_blocks)
+
+    def test_shared_by_code_hash(self):
+        # PUSH1 0x02 PUSH1 0x03 ADD PUSH1 0x00 MSTORE
+        bytecode = "600260030160005260206000f3"
+        self.evm.create_contract(bytecode=bytecode, address=self.address_1)
+        self.evm.create_contract(bytecode=bytecode, address=self.address_2)
+
+        for address in [self.address_1, self.address_1, self.address_1, self.address_2]:
+            operation = self.evm.execute_transaction(address=address, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+            self.assertEqual(operation.return_bytes, bytes.fromhex("0000000000000000000000000000000000000000000000000000000000000005"))
+
+        # one compile shared by both contracts
+        self.assertEqual(len(self.code_analysis_cache.code_hash_to_analysis), 1)
+        self.assertEqual(self.code_analysis_cache.hits, 3)
+
+
+class ForkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.evm = EVM()
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD PUSH1 0x00 SSTORE
+        self.counter = self.evm.create_contract(bytecode="600054600101600055", address=self.address_1)
+        self.counter.storage[1] = 0xff
+
+    def increment(self, evm):
+        return evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+
+    def test_fork(self):
+        self.increment(self.evm)
+        fork = self.evm.fork()
+        self.increment(fork)
+        self.increment(fork)
+
+        self.assertEqual(fork.address_to_contract[self.address_1].storage, {0: 3, 1: 0xff})
+        self.assertEqual(self.counter.storage, {0: 1, 1: 0xff})
+        self.assertIs(self.evm.address_to_contract[self.address_1], self.counter)
+
+    def test_fork_of_fork(self):
+        fork = self.evm.fork()
+        self.increment(fork)
+        fork_of_fork = fork.fork()
+        self.increment(fork_of_fork)
+        self.increment(fork_of_fork)
+        # discarded forks leave their parents as they were
+        del fork_of_fork
+
+        self.assertEqual(fork.address_to_contract[self.address_1].storage, {0: 1, 1: 0xff})
+        self.assertEqual(self.counter.storage, {1: 0xff})
+
+    def test_parent_writes(self):
+        fork = self.evm.fork()
+        contract = fork.address_to_contract[self.address_1]
+        self.assertEqual(contract.nonce, 0)
+        self.increment(self.evm)
+        self.counter.nonce = 1
+        self.counter.logs.append({"data": "0x1"})
+
+        # whatever the fork hasn't written shows the parent as it is now
+        self.assertEqual(contract.storage, {0: 1, 1: 0xff})
+        self.assertEqual(contract.nonce, 1)
+        self.assertEqual(contract.logs, [{"data": "0x1"}])
+
+        contract.nonce = 5
+        contract.logs.append({"data": "0x2"})
+        self.counter.nonce = 2
+        self.assertEqual(contract.nonce, 5)
+        self.assertEqual(contract.logs, [{"data": "0x1"}, {"data": "0x2"}])
+        self.assertEqual(self.counter.logs, [{"data": "0x1"}])
+
+    def test_fork_reads(self):
+        for _ in range(3):
+            self.counter.logs.append({"data": "0x0"})
+        fork = self.evm.fork()
+        fork.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        contract = fork.address_to_contract[self.address_1]
+        # reads share the parent's logs and keep nothing in the fork
+        self.assertIs(contract.logs.parent, self.counter.logs)
+        self.assertEqual(fork.address_to_contract.writes, {})
+        self.assertIs(fork.address_to_contract[self.address_1], contract)
+
+        self.increment(fork)
+        self.assertEqual(list(fork.address_to_contract.writes), [self.address_1])
+
+    def test_fork_writes(self):
+        # PUSH1 0x00 PUSH1 0x00 LOG0
+        # PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 CREATE
+        self.evm.create_contract(bytecode="60006000a0600060006000f0", address=self.address_2)
+        fork = self.evm.fork()
+        operation = fork.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        created_address = get_create_contract_address(sender_address=self.address_2, sender_nonce=0)
+        self.assertEqual(operation.stack, [created_address[2:]])
+
+        self.assertIn(created_address, fork.address_to_contract)
+        self.assertEqual(fork.address_to_contract[self.address_2].nonce, 1)
+        self.assertEqual(len(fork.address_to_contract[self.address_2].logs), 1)
+        self.assertNotIn(created_address, self.evm.address_to_contract)
+        self.assertEqual(self.evm.address_to_contract[self.address_2].nonce, 0)
+        self.assertEqual(self.evm.address_to_contract[self.address_2].logs, [])
+
+    def test_fork_revert(self):
+        # PUSH1 0x00 PUSH1 0x01 SSTORE PUSH1 0x00 DUP1 REVERT
+        self.evm.create_contract(bytecode="6000600155600080fd", address=self.address_2)
+        fork = self.evm.fork()
+        operation = fork.execute_transaction(address=self.address_2, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(fork.address_to_contract[self.address_2].storage, {})
+        self.assertEqual(len(fork.address_to_contract), 2)
+
+
+class SQLiteBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state.db")
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def increment(self, evm):
+        return evm.execute_transaction(address=self.address_1, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+
+    def test_persisted(self):
+        evm = EVM(state=SQLiteBackend(self.path))
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD PUSH1 0x00 SSTORE PUSH1 0x00 PUSH1 0x00 LOG0
+        evm.create_contract(bytecode="60005460010160005560006000a0", address=self.address_1)
+        for _ in range(3):
+            self.increment(evm)
+        evm.address_to_contract.close()
+
+        state = SQLiteBackend(self.path)
+        contract = state[self.address_1]
+        self.assertEqual(contract.bytecode, "60005460010160005560006000a0")
+        self.assertEqual(contract.storage, {0: 3})
+        self.assertEqual(len(contract.logs), 3)
+        self.assertEqual(list(state), [self.address_1])
+
+        evm = EVM(state=state)
+        self.increment(evm)
+        self.assertEqual(contract.storage, {0: 4})
+
+    def test_revert(self):
+        evm = EVM(state=SQLiteBackend(self.path))
+        # PUSH1 0x01 PUSH1 0x00 SSTORE PUSH1 0x00 DUP1 REVERT
+        evm.create_contract(bytecode="6001600055600080fd", address=self.address_1)
+        operation = self.increment(evm)
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        evm.address_to_contract.close()
+
+        self.assertEqual(SQLiteBackend(self.path)[self.address_1].storage, {})
+
+    def test_replace_contract(self):
+        evm = EVM(state=SQLiteBackend(self.path))
+        contract = evm.create_contract(bytecode="", address=self.address_1)
+        contract.storage[1] = 1
+        evm.commit()
+
+        evm.create_contract(bytecode="00", address=self.address_1)
+        evm.commit()
+        self.assertEqual(evm.address_to_contract[self.address_1].storage, {})
+        self.assertEqual(SQLiteBackend(self.path)[self.address_1].storage, {})
+
+    def test_commit_per_block(self):
+        evm = EVM(state=SQLiteBackend(self.path), commit_per_transaction=False)
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD PUSH1 0x00 SSTORE
+        evm.create_contract(bytecode="600054600101600055", address=self.address_1)
+        self.increment(evm)
+        self.increment(evm)
+        self.assertNotIn(self.address_1, SQLiteBackend(self.path))
+
+        evm.commit()
+        self.assertEqual(SQLiteBackend(self.path)[self.address_1].storage, {0: 2})
+
+    def test_slot_cache(self):
+        state = SQLiteBackend(self.path, slot_cache_size=2)
+        evm = EVM(state=state)
+        contract = evm.create_contract(bytecode="", address=self.address_1)
+        for key in range(10):
+            contract.storage[key] = key + 1
+        evm.commit()
+
+        self.assertEqual(len(state.slot_cache), 2)
+        self.assertEqual([contract.storage[key] for key in range(10)], list(range(1, 11)))
+        self.assertEqual(len(state.slot_cache), 2)
+
+
+class TrieTestCase(unittest.TestCase):
+    def root_hash(self, items):
+        trie = Trie()
+        for key, value in items:
+            trie.set(key, value)
+        return trie.root_hash().hex()
+
+    def test_root_hash(self):
+        # https://github.com/ethereum/tests/blob/develop/TrieTests/trieanyorder.json
+        self.assertEqual(Trie().root_hash(), BLANK_ROOT)
+        self.assertEqual(self.root_hash([(b"doe", b"reindeer"), (b"dog", b"puppy"), (b"dogglesworth", b"cat")]),
+                         "8aad789dff2f538bca5d8ea56e8abe10f4c7ba3a5dea95fea4cd6e7c3a1168d3")
+        self.assertEqual(self.root_hash([(b"foo", b"bar"), (b"food", b"bass")]),
+                         "17beaa1648bafa633cda809c90c04af50fc8aed3cb40d16efbddee6fdf63c4c3")
+        self.assertEqual(self.root_hash([(b"do", b"verb"), (b"horse", b"stallion"), (b"doge", b"coin"), (b"dog", b"puppy")]),
+                         "5991bb8c6514148a29db676a14ac506cd2cd5775ace63c30a4fe457715e9ac84")
+
+    def test_delete(self):
+        # https://github.com/ethereum/tests/blob/develop/TrieTests/trietest.json, emptyValues
+        self.assertEqual(self.root_hash([
+            (b"do", b"verb"), (b"ether", b"wookiedoo"), (b"horse", b"stallion"), (b"shaman", b"horse"),
+            (b"doge", b"coin"), (b"ether", b""), (b"dog", b"puppy"), (b"shaman", b""),
+        ]), "5991bb8c6514148a29db676a14ac506cd2cd5775ace63c30a4fe457715e9ac84")
+
+        trie = Trie()
+        for key in range(100):
+            trie.set(key.to_bytes(2, "big"), b"value")
+        for key in range(100):
+            trie.delete(key.to_bytes(2, "big"))
+        self.assertEqual(trie.root_hash(), BLANK_ROOT)
+        self.assertIsNone(trie.root)
+
+    def test_get(self):
+        trie = Trie()
+        trie.set(b"dog", b"puppy")
+        trie.set(b"doge", b"coin")
+        self.assertEqual(trie.get(b"dog"), b"puppy")
+        self.assertEqual(trie.get(b"doge"), b"coin")
+        self.assertIsNone(trie.get(b"do"))
+        self.assertIsNone(trie.get(b"dogs"))
+
+    def test_copy(self):
+        trie = Trie()
+        trie.set(b"dog", b"puppy")
+        root_hash = trie.root_hash()
+        copy = trie.copy()
+        copy.set(b"doge", b"coin")
+
+        self.assertEqual(trie.root_hash(), root_hash)
+        self.assertIsNone(trie.get(b"doge"))
+        self.assertNotEqual(copy.root_hash(), root_hash)
+
+
+class StateRootTestCase(unittest.TestCase):
+    def setUp(self):
+        self.evm = EVM()
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+
+    def keccak256(self, data):
+        return keccak.new(digest_bits=256, data=data).digest()
+
+    def increment(self, evm, address):
+        return evm.execute_transaction(address=address, transaction_metadata=TransactionMetadata(from_address=self.eoa_1))
+
+    def test_state_root(self):
+        self.assertEqual(self.evm.state_root(), BLANK_ROOT)
+        # PUSH1 0x2a PUSH1 0x01 SSTORE
+        contract = self.evm.create_contract(bytecode="602a600155", address=self.address_1)
+        self.increment(self.evm, self.address_1)
+
+        # a trie with a single key is a single leaf holding the whole path
+        storage_root = self.keccak256(rlp.encode([b"\x20" + self.keccak256((1).to_bytes(32, "big")), rlp.encode(0x2a)]))
+        account = rlp.encode([0, 0, storage_root, contract.code_hash])
+        self.assertEqual(self.evm.state_root(), self.keccak256(rlp.encode([b"\x20" + self.keccak256(bytes.fromhex(self.address_1[2:])), account])))
+
+    def test_incremental(self):
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD PUSH1 0x00 SSTORE
+        self.evm.create_contract(bytecode="600054600101600055", address=self.address_1)
+        # PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 CREATE PUSH1 0x01 SSTORE
+        self.evm.create_contract(bytecode="600060006000f0600155", address=self.address_2)
+        self.evm.state_root()
+
+        self.increment(self.evm, self.address_1)
+        self.increment(self.evm, self.address_2)
+        # only what was written since the last root is rehashed
+        self.assertEqual(self.evm.touched_accounts, {
+            self.address_1: {0},
+            self.address_2: {1},
+            get_create_contract_address(sender_address=self.address_2, sender_nonce=0): None,
+        })
+        self.assertEqual(self.evm.state_root(), self.evm.state_root(rebuild=True))
+
+        for contract in self.evm.address_to_contract.values():
+            contract.storage.clear()
+        # the storage was changed directly, nothing saw it until the tries are rebuilt
+        self.assertNotEqual(self.evm.state_root(), self.evm.state_root(rebuild=True))
+
+    def test_revert(self):
+        # PUSH1 0x01 PUSH1 0x00 SSTORE PUSH1 0x00 DUP1 REVERT
+        self.evm.create_contract(bytecode="6001600055600080fd", address=self.address_1)
+        state_root = self.evm.state_root()
+        operation = self.increment(self.evm, self.address_1)
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(self.evm.state_root(), state_root)
+
+    def test_empty_account(self):
+        # accounts with no nonce, code or storage aren't in the trie
+        self.evm.create_contract(bytecode="", address=self.address_1)
+        self.assertEqual(self.evm.state_root(), BLANK_ROOT)
+
+    def test_fork(self):
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD PUSH1 0x00 SSTORE
+        self.evm.create_contract(bytecode="600054600101600055", address=self.address_1)
+        state_root = self.evm.state_root()
+        self.increment(self.evm, self.address_1)
+
+        fork = self.evm.fork()
+        self.increment(fork, self.address_1)
+        self.assertEqual(fork.state_root(), fork.state_root(rebuild=True))
+
+        incremented_state_root = self.evm.state_root()
+        self.assertNotEqual(incremented_state_root, state_root)
+        self.assertNotEqual(fork.state_root(), incremented_state_root)
+        self.assertEqual(self.evm.state_root(rebuild=True), incremented_state_root)
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.evm = EVM()
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD PUSH1 0x00 SSTORE
+        self.counter = self.evm.create_contract(bytecode="600054600101600055", address=self.address_1)
+        # PUSH1 0x00 DUP1 REVERT
+        self.evm.create_contract(bytecode="600080fd", address=self.address_2)
+
+    def transactions(self, *addresses):
+        return [(address, TransactionMetadata(from_address=self.eoa_1)) for address in addresses]
+
+    def test_batch(self):
+        batch = self.evm.execute_batch(self.transactions(self.address_1, self.address_2, self.address_1))
+        operations = iter(batch)
+        # operations stream back as the transactions run
+        self.assertEqual(next(operations).status, OperationStatus.SUCCESS)
+        self.assertEqual(self.counter.storage, {0: 1})
+
+        self.assertEqual([operation.status for operation in operations], [OperationStatus.FAILURE, OperationStatus.SUCCESS])
+        self.assertEqual(self.counter.storage, {0: 2})
+        self.assertEqual(batch.num_of_transactions, 3)
+        self.assertEqual(batch.num_of_failures, 1)
+        # set 0 to 1, revert, reset 1 to 2
+        self.assertEqual(batch.gas_used, (21000 + 22112) + (21000 + 6) + (21000 + 5012))
+        self.assertGreater(batch.transactions_per_second, 0)
+        self.assertTrue(batch.committed)
+
+    def test_all_or_nothing(self):
+        batch = self.evm.execute_batch(self.transactions(self.address_1, self.address_1), all_or_nothing=True)
+        self.assertEqual(len(batch.run()), 2)
+        self.assertTrue(batch.committed)
+        self.assertEqual(self.counter.storage, {0: 2})
+        self.assertEqual(self.evm.journal, [])
+
+        # the failure stops the batch and undoes the transactions before it
+        batch = self.evm.execute_batch(self.transactions(self.address_1, self.address_2, self.address_1), all_or_nothing=True)
+        self.assertEqual([operation.status for operation in batch.run()], [OperationStatus.SUCCESS, OperationStatus.FAILURE])
+        self.assertFalse(batch.committed)
+        self.assertEqual(self.counter.storage, {0: 2})
+        self.assertEqual(self.evm.journal, [])
+
+    def test_all_or_nothing_commit(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "state.db")
+        evm = EVM(state=SQLiteBackend(path))
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD PUSH1 0x00 SSTORE
+        evm.create_contract(bytecode="600054600101600055", address=self.address_1)
+        evm.commit()
+
+        operations = iter(evm.execute_batch(self.transactions(self.address_1, self.address_1), all_or_nothing=True))
+        next(operations)
+        self.assertEqual(SQLiteBackend(path)[self.address_1].storage, {})
+        next(operations)
+        self.assertEqual(SQLiteBackend(path)[self.address_1].storage, {})
+        list(operations)
+        self.assertEqual(SQLiteBackend(path)[self.address_1].storage, {0: 2})
+
+
+class ParallelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+        self.address_3 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96048"
+        self.address_4 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96049"
+
+    def evm(self):
+        evm = EVM()
+        # CALLER SLOAD PUSH1 0x01 ADD CALLER SSTORE, a counter per caller
+        evm.create_contract(bytecode="33546001013355", address=self.address_1)
+        # PUSH1 0x00 PUSH1 0x00 LOG0 PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 CREATE
+        evm.create_contract(bytecode="60006000a0600060006000f0", address=self.address_2)
+        # CALLDATASIZE PUSH1 0x15 JUMPI
+        # PUSH1 0x00 SLOAD PUSH1 0x1c JUMPI
+        # PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 CREATE2 POP STOP
+        # JUMPDEST PUSH1 0x01 PUSH1 0x00 SSTORE STOP
+        # JUMPDEST STOP
+        # with calldata sets slot 0, without it CREATE2s an empty contract unless slot 0 is set
+        evm.create_contract(bytecode="36601557600054601c576000600060006000f550005b6001600055005b00", address=self.address_3)
+        # PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 CREATE2 POP STOP, the same address as address_3's CREATE2
+        evm.create_contract(bytecode="6000600060006000f55000", address=self.address_4)
+        return evm
+
+    def block(self, addresses, num_of_callers):
+        return [
+            (address, TransactionMetadata(from_address="0x" + format(index % num_of_callers + 1, "040x")))
+            for index, address in enumerate(addresses)
+        ]
+
+    def assertSameAsSerial(self, transactions, workers=2, chunk_size=4):
+        serial_evm = self.evm()
+        serial_results = parallel.execute_serial(serial_evm, transactions)
+        evm = self.evm()
+        results = parallel.execute_block(evm, transactions, workers=workers, chunk_size=chunk_size)
+
+        self.assertEqual(results, serial_results)
+        for address in [self.address_1, self.address_2]:
+            self.assertEqual(dict(evm.address_to_contract[address].storage), dict(serial_evm.address_to_contract[address].storage))
+            self.assertEqual(evm.address_to_contract[address].logs, serial_evm.address_to_contract[address].logs)
+            self.assertEqual(evm.address_to_contract[address].nonce, serial_evm.address_to_contract[address].nonce)
+        self.assertEqual(evm.state_root(), serial_evm.state_root())
+        return results
+
+    def test_independent(self):
+        # every transaction has its own caller and writes its own slot
+        results = self.assertSameAsSerial(self.block([self.address_1] * 16, num_of_callers=16))
+        self.assertTrue(all(result.status == OperationStatus.SUCCESS for result in results))
+        self.assertFalse(any(result.reexecuted for result in results))
+
+    def test_conflicts(self):
+        # the same four callers over and over, a caller's second transaction reads its first one's write
+        results = self.assertSameAsSerial(self.block([self.address_1] * 16, num_of_callers=4))
+        self.assertTrue(any(result.reexecuted for result in results))
+
+    def test_create(self):
+        # every CREATE reads and writes the nonce of address_2 and creates a contract at a new address
+        results = self.assertSameAsSerial(self.block([self.address_2, self.address_1] * 6, num_of_callers=3))
+        self.assertEqual(results[0].logs, [(self.address_2, {"data": "0x0"})])
+
+    def test_create2_conflict(self):
+        # serially only address_4 creates the contract. The second chunk runs address_3 without the first chunk's
+        # write, so it creates it and address_4 sees it there, then address_3 is re-executed and creates nothing
+        transactions = [
+            (self.address_3, TransactionMetadata(from_address=self.eoa_1, data="0x01")),
+            (self.eoa_1, TransactionMetadata(from_address=self.eoa_1)),
+            (self.address_3, TransactionMetadata(from_address=self.eoa_1)),
+            (self.address_4, TransactionMetadata(from_address=self.eoa_1)),
+        ]
+        results = self.assertSameAsSerial(transactions, chunk_size=2)
+        self.assertEqual([result.reexecuted for result in results], [False, False, True, True])
+        self.assertEqual(list(results[3].created), [get_create2_contract_address(self.eoa_1, 0, "")])
+
+
+class SimulateManyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.evm = EVM()
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+        # PUSH1 0x00 CALLDATALOAD PUSH1 0x00 SLOAD ADD DUP1 PUSH1 0x00 SSTORE
+        # PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN
+        # adds the calldata to slot 0 and returns the sum
+        self.contract = self.evm.create_contract(bytecode="600035600054018060005560005260206000f3", address=self.address_1)
+        self.contract.storage[0] = 100
+
+    def test_simulate_many(self):
+        calldatas = ["0x" + format(amount, "064x") for amount in range(1, 21)]
+        results = list(self.evm.simulate_many(self.address_1, calldatas, self.eoa_1, workers=2, chunk_size=3))
+
+        # every variant ran against the same state
+        self.assertEqual([int.from_bytes(result.return_bytes, "big") for result in results], list(range(101, 121)))
+        self.assertEqual([result.storage for result in results], [{(self.address_1, 0): amount} for amount in range(101, 121)])
+        self.assertTrue(all(result.status == OperationStatus.SUCCESS for result in results))
+        self.assertEqual(self.contract.storage, {0: 100})
+        self.assertEqual(results, list(self.evm.simulate_many(self.address_1, calldatas, self.eoa_1, workers=1)))
+
+
+class PreforkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "evm.sock")
+        self.evm = EVM()
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD DUP1 PUSH1 0x00 SSTORE PUSH1 0x00 MSTORE PUSH1 0x00 PUSH1 0x00 LOG0
+        # PUSH1 0x20 PUSH1 0x00 RETURN
+        self.evm.create_contract(bytecode="60005460010180600055600052600060006000a060206000f3", address=self.address_1)
+        self.evm.address_to_contract[self.address_1].storage[0] = 41
+
+    def test_prefork(self):
+        with PreforkServer(self.evm, self.path, workers=2):
+            for _ in range(3):
+                client = PreforkClient(self.path)
+                for _ in range(2):
+                    response = client.call(self.address_1, self.eoa_1)
+                    # every request starts from the state the workers were forked with
+                    self.assertEqual(response["status"], "SUCCESS")
+                    self.assertEqual(response["return"], "0x" + format(42, "064x"))
+                    self.assertEqual(response["storage"], [[self.address_1, "0x0", "0x2a"]])
+                    self.assertEqual(response["logs"], [[self.address_1, {"data": "0x0"}]])
+
+                with self.assertRaises(Exception):
+                    client.call(self.address_1, self.eoa_1, data="0x1")
+                client.close()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class RPCTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.evm = EVM()
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD DUP1 PUSH1 0x00 SSTORE PUSH1 0x00 MSTORE PUSH1 0x00 PUSH1 0x00 LOG0
+        # PUSH1 0x20 PUSH1 0x00 RETURN
+        self.evm.create_contract(bytecode="60005460010180600055600052600060006000a060206000f3", address=self.address_1)
+        # PUSH2 0x4e20 JUMPDEST PUSH1 0x01 SWAP1 SUB DUP1 PUSH1 0x03 JUMPI
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD DUP1 PUSH1 0x00 SSTORE PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN
+        # loops for a while, then increments slot 0 and returns it
+        self.evm.create_contract(bytecode="614e205b60019003806003576000546001018060005560005260206000f3", address=self.address_2)
+        self.server = RPCServer(self.evm)
+
+    async def request(self, payload):
+        body = await self.server.handle_body(json.dumps(payload).encode())
+        return json.loads(body) if body else None
+
+    def call(self, method, params, request_id=1):
+        return {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+
+    async def test_send_transaction(self):
+        response = await self.request(self.call("eth_sendTransaction", [{"to": self.address_1, "from": self.eoa_1}]))
+        transaction_hash = response["result"]
+
+        response = await self.request(self.call("eth_getStorageAt", [self.address_1, "0x0", "latest"]))
+        self.assertEqual(response["result"], "0x" + format(1, "064x"))
+        response = await self.request(self.call("eth_getTransactionReceipt", [transaction_hash]))
+        self.assertEqual(response["result"]["status"], "0x1")
+        self.assertEqual(response["result"]["logs"], [{"address": self.address_1, "data": "0x0", "topics": []}])
+
+        # nothing is running, the write was merged into the EVM
+        self.assertEqual(self.server.versions, [])
+        self.assertEqual(self.evm.address_to_contract[self.address_1].storage, {0: 1})
+
+    async def test_receipts(self):
+        self.server.max_receipts = 2
+        transaction_hashes = []
+        for _ in range(3):
+            response = await self.request(self.call("eth_sendTransaction", [{"to": self.address_1, "from": self.eoa_1}]))
+            transaction_hashes.append(response["result"])
+
+        # the oldest receipt was dropped
+        self.assertEqual(list(self.server.receipts), transaction_hashes[1:])
+        response = await self.request(self.call("eth_getTransactionReceipt", [transaction_hashes[0]]))
+        self.assertIsNone(response["result"])
+
+    async def test_slices(self):
+        # the slow call runs 1000 opcodes at a time, the cheap one finishes between two of its slices
+        slow = asyncio.create_task(self.request(self.call("eth_call", [{"to": self.address_2, "from": self.eoa_1}])))
+        await asyncio.sleep(0)
+        response = await self.request(self.call("eth_call", [{"to": self.address_1, "from": self.eoa_1}]))
+        self.assertEqual(response["result"], "0x" + format(1, "064x"))
+        self.assertFalse(slow.done())
+        self.assertEqual((await slow)["result"], "0x" + format(1, "064x"))
+
+    async def test_call(self):
+        response = await self.request(self.call("eth_call", [{"to": self.address_1, "from": self.eoa_1}, "latest"]))
+        self.assertEqual(response["result"], "0x" + format(1, "064x"))
+        # calls never write
+        self.assertEqual(self.evm.address_to_contract[self.address_1].storage, {})
+
+    async def test_snapshot(self):
+        self.evm.address_to_contract[self.address_2].storage[0] = 7
+        # the call and the transaction run at the same time, the call only sees the state it started on
+        call = asyncio.create_task(self.request(self.call("eth_call", [{"to": self.address_2, "from": self.eoa_1}])))
+        await asyncio.sleep(0)
+        response = await self.request(self.call("eth_sendTransaction", [{"to": self.address_2, "from": self.eoa_1}]))
+        self.assertIn("result", response)
+        self.assertEqual((await call)["result"], "0x" + format(8, "064x"))
+
+        self.assertEqual(self.evm.address_to_contract[self.address_2].storage, {0: 8})
+        response = await self.request(self.call("eth_call", [{"to": self.address_2, "from": self.eoa_1}]))
+        self.assertEqual(response["result"], "0x" + format(9, "064x"))
+
+    async def test_batch(self):
+        responses = await self.request([
+            self.call("eth_sendTransaction", [{"to": self.address_1, "from": self.eoa_1}], request_id=1),
+            self.call("eth_sendTransaction", [{"to": self.address_1, "from": self.eoa_1}], request_id=2),
+            # notifications get no response
+            {"jsonrpc": "2.0", "method": "eth_sendTransaction", "params": [{"to": self.address_1, "from": self.eoa_1}]},
+            self.call("eth_chainId", [], request_id=3),
+            self.call("eth_getStorageAt", [], request_id=4),
+        ])
+        self.assertEqual([response["id"] for response in responses], [1, 2, 3, 4])
+        self.assertEqual(responses[2]["error"]["code"], -32601)
+        self.assertEqual(responses[3]["error"]["code"], -32602)
+        self.assertEqual(self.evm.address_to_contract[self.address_1].storage, {0: 3})
+
+    async def test_errors(self):
+        self.assertEqual(json.loads(await self.server.handle_body(b"{"))["error"]["code"], -32700)
+        self.assertEqual((await self.request([]))["error"]["code"], -32600)
+
+        # PUSH1 0x00 DUP1 REVERT
+        self.evm.create_contract(bytecode="600080fd", address=self.address_1)
+        response = await self.request(self.call("eth_call", [{"to": self.address_1, "from": self.eoa_1}]))
+        self.assertEqual(response["error"], {"code": 3, "message": "execution reverted", "data": "0x"})
+
+    async def test_http(self):
+        server = await self.server.serve(port=0)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+            for request_id in range(2):
+                body = json.dumps(self.call("eth_getStorageAt", [self.address_1, "0x0"], request_id)).encode()
+                writer.write(b"POST / HTTP/1.1\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+                self.assertEqual(await reader.readline(), b"HTTP/1.1 200 OK\r\n")
+                headers = (await reader.readuntil(b"\r\n\r\n")).decode()
+                length = int(headers.split("Content-Length: ")[1].split("\r\n")[0])
+                self.assertEqual(json.loads(await reader.readexactly(length))["id"], request_id)
+            writer.close()
+
+    async def test_http_content_length(self):
+        server = await self.server.serve(port=0)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+            writer.write(b"POST / HTTP/1.1\r\nContent-Length: twelve\r\n\r\n{}")
+            self.assertEqual(await reader.readline(), b"HTTP/1.1 400 Bad Request\r\n")
+            headers = (await reader.readuntil(b"\r\n\r\n")).decode()
+            length = int(headers.split("Content-Length: ")[1].split("\r\n")[0])
+            self.assertEqual(json.loads(await reader.readexactly(length))["error"]["code"], -32700)
+            # the connection is dropped, where the body ended is unknown
+            self.assertEqual(await reader.read(), b"")
+            writer.close()
+
+
+class RunStepsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.evm = EVM()
+        self.address_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96045"
+        self.address_2 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96046"
+        self.eoa_1 = "0xd8da6bf26964af9d7eed9e03e53415d37aa96047"
+
+        # PUSH1 0x0a JUMPDEST PUSH1 0x01 SWAP1 SUB DUP1 PUSH1 0x02 JUMPI
+        # PUSH1 0x00 SLOAD PUSH1 0x01 ADD DUP1 PUSH1 0x00 SSTORE PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN
+        # 83 opcodes, loops 10 times then increments slot 0 and returns it
+        self.counter = self.evm.create_contract(bytecode="600a5b60019003806002576000546001018060005560005260206000f3", address=self.address_1)
+        # PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 PUSH1 0x00 PUSH20 address_1 GAS CALL
+        # PUSH1 0x00 MSTORE PUSH1 0x20 PUSH1 0x00 RETURN
+        self.evm.create_contract(bytecode=f"6000600060006000600073{self.address_1[2:]}5af160005260206000f3", address=self.address_2)
+
+    def transaction_metadata(self):
+        return TransactionMetadata(from_address=self.eoa_1)
+
+    def test_run_steps(self):
+        operation = Operation(
+            evm=self.evm, address=self.address_1, transaction_metadata=self.transaction_metadata(),
+            operation_metadata=OperationMetadata(),
+        )
+        self.assertEqual(operation.run_steps(10), 10)
+        # PUSH1 0x0a, one pass of the loop, then JUMPDEST PUSH1 0x01 of the next
+        self.assertEqual(operation.program_counter, 5)
+        self.assertEqual(operation.stack, ["9", "1"])
+        self.assertEqual(operation.status, OperationStatus.EXECUTING)
+
+        self.assertEqual(operation.run_steps(1000), 73)
+        self.assertEqual(operation.status, OperationStatus.SUCCESS)
+        self.assertEqual(operation.return_bytes, (1).to_bytes(32, "big"))
+
+    def test_execute_transaction_steps(self):
+        expected = self.evm.fork().execute_transaction(self.address_1, self.transaction_metadata())
+
+        statuses = []
+        for operation in self.evm.execute_transaction_steps(self.address_1, self.transaction_metadata(), steps=10):
+            statuses.append(operation.status)
+        # after 10, 20, ... 80 opcodes and once done
+        self.assertEqual(statuses, [OperationStatus.EXECUTING] * 8 + [OperationStatus.SUCCESS])
+        self.assertEqual(operation.status, OperationStatus.SUCCESS)
+        self.assertEqual(operation.return_bytes, expected.return_bytes)
+        self.assertEqual(operation.gas_used, expected.gas_used)
+        self.assertEqual(self.counter.storage, {0: 1})
+
+    def test_nested(self):
+        for engine in ["interpreter", "threaded", "jit"]:
+            # steps always run on the interpreter, whatever engine ran the code before
+            evm = EVM(engine=engine, jit_threshold=0, state=self.evm.fork().address_to_contract)
+            expected = evm.fork().execute_transaction(self.address_2, self.transaction_metadata())
+
+            # the steps of the CALL and of the called contract count towards the same slices
+            operations = list(evm.execute_transaction_steps(self.address_2, self.transaction_metadata(), steps=7))
+            # 13 opcodes of address_2 and 83 of address_1, yielded after every 7 and once done
+            self.assertEqual(len(operations), 96 // 7 + 1)
+            operation = operations[-1]
+            self.assertEqual(operation.status, OperationStatus.SUCCESS)
+            self.assertEqual(operation.return_bytes, (1).to_bytes(32, "big"))
+            self.assertEqual(operation.gas_used, expected.gas_used)
+            self.assertEqual(evm.address_to_contract[self.address_1].storage, {0: 1})
+
+    def test_interleaved(self):
+        # every transaction runs on its own fork, taking turns slice by slice
+        forks = [self.evm.fork() for _ in range(3)]
+        executions = [fork.execute_transaction_steps(self.address_2, self.transaction_metadata(), steps=5) for fork in forks]
+        operations = [None] * len(executions)
+        while any(execution is not None for execution in executions):
+            for index, execution in enumerate(executions):
+                if execution is not None:
+                    operations[index] = next(execution, None)
+                    if operations[index].status != OperationStatus.EXECUTING:
+                        executions[index] = None
+
+        self.assertEqual([operation.status for operation in operations], [OperationStatus.SUCCESS] * 3)
+        self.assertEqual([fork.address_to_contract[self.address_1].storage for fork in forks], [{0: 1}] * 3)
+        self.assertEqual(self.counter.storage, {})
+
+    def test_close(self):
+        execution = self.evm.execute_transaction_steps(self.address_2, self.transaction_metadata(), steps=45)
+        operation = next(execution)
+        self.assertEqual(operation.status, OperationStatus.EXECUTING)
+        self.assertEqual(self.counter.storage, {})
+        self.assertEqual(next(execution).status, OperationStatus.EXECUTING)
+        # the called contract wrote slot 0 in the second slice
+        self.assertEqual(self.counter.storage, {0: 1})
+
+        # dropped halfway, nothing it wrote is left
+        execution.close()
+        self.assertEqual(operation.status, OperationStatus.FAILURE)
+        self.assertEqual(self.counter.storage, {})
+        self.assertEqual(self.evm.journal, [])
+        self.assertEqual(self.evm.accessed_addresses, set())
@@ -0,0 +1,274 @@
+import rlp
+from Crypto.Hash import keccak
+
+
+# Merkle Patricia Trie
+#
+# Hexary Patricia trie as in the yellow paper, appendix D. Nodes are immutable, an update copies the nodes on the
+# path to its key and shares every other node with the trie it came from, so copying a trie is O(1) and a node's
+# hash is computed once and cached on the node. Computing the root after a batch of updates only hashes the nodes
+# created since the last root, the dirty paths. Paths are hex strings of nibbles.
+
+def keccak256(data):
+    return keccak.new(digest_bits=256, data=data).digest()
+
+
+# root hash of the empty trie, keccak256(rlp(b""))
+BLANK_ROOT = keccak256(rlp.encode(b""))
+
+HEX_DIGITS = "0123456789abcdef"
+HEX_INDEX = {digit: index for index, digit in enumerate(HEX_DIGITS)}
+NO_CHILDREN = (None,) * 16
+
+
+def hex_prefix(path, is_leaf):
+    # compact encoding of a nibble path with the leaf flag and the parity of its length in the first nibble
+    flag = 2 if is_leaf else 0
+    if len(path) % 2:
+        return bytes.fromhex(HEX_DIGITS[flag + 1] + path)
+    return bytes.fromhex(HEX_DIGITS[flag] + "0" + path)
+
+
+class Leaf:
+    """Rest of the path to a key and its value."""
+
+    __slots__ = ("path", "value", "reference")
+
+    def __init__(self, path, value):
+        self.path = path
+        self.value = value
+        # rlp structure of the node when it encodes to less than 32 bytes, its hash otherwise, None until computed
+        self.reference = None
+
+    def structure(self):
+        return [hex_prefix(self.path, True), self.value]
+
+
+class Extension:
+    """Path shared by every key below its child, the child is always a Branch."""
+
+    __slots__ = ("path", "child", "reference")
+
+    def __init__(self, path, child):
+        self.path = path
+        self.child = child
+        self.reference = None
+
+    def structure(self):
+        return [hex_prefix(self.path, False), reference(self.child)]
+
+
+class Branch:
+    """One child per nibble and the value of the key ending here."""
+
+    __slots__ = ("children", "value", "reference")
+
+    def __init__(self, children, value):
+        self.children = children
+        self.value = value
+        self.reference = None
+
+    def structure(self):
+        return [b"" if child is None else reference(child) for child in self.children] + [self.value or b""]
+
+
+def reference(node):
+    # how a parent refers to node, nodes shorter than a hash are embedded. Only nodes created since they were
+    # last referenced have to be encoded
+    node_reference = node.reference
+    if node_reference is None:
+        structure = node.structure()
+        encoded = rlp.encode(structure)
+        node_reference = structure if len(encoded) < 32 else keccak256(encoded)
+        node.reference = node_reference
+    return node_reference
+
+
+def common_prefix_length(path, other_path):
+    length = 0
+    max_length = min(len(path), len(other_path))
+    while length < max_length and path[length] == other_path[length]:
+        length += 1
+    return length
+
+
+def get(node, path):
+    while node is not None:
+        if type(node) is Branch:
+            if not path:
+                return node.value
+            node = node.children[HEX_INDEX[path[0]]]
+            path = path[1:]
+        elif type(node) is Leaf:
+            return node.value if node.path == path else None
+        else:
+            if not path.startswith(node.path):
+                return None
+            path = path[len(node.path):]
+            node = node.child
+    return None
+
+
+def insert(node, path, value):
+    # node with value set at path, node itself is left as it was
+    if node is None:
+        return Leaf(path, value)
+
+    if type(node) is Branch:
+        if not path:
+            return Branch(node.children, value)
+        index = HEX_INDEX[path[0]]
+        children = list(node.children)
+        children[index] = insert(children[index], path[1:], value)
+        return Branch(tuple(children), node.value)
+
+    length = common_prefix_length(node.path, path)
+    if type(node) is Leaf and length == len(node.path) == len(path):
+        return Leaf(path, value)
+    if type(node) is Extension and length == len(node.path):
+        return Extension(node.path, insert(node.child, path[length:], value))
+
+    # the paths split after length nibbles, a branch takes what is left of the node and then the new key
+    children = list(NO_CHILDREN)
+    branch_value = None
+    rest = node.path[length:]
+    if type(node) is Leaf:
+        if rest:
+            children[HEX_INDEX[rest[0]]] = Leaf(rest[1:], node.value)
+        else:
+            branch_value = node.value
+    else:
+        children[HEX_INDEX[rest[0]]] = Extension(rest[1:], node.child) if len(rest) > 1 else node.child
+    branch = insert(Branch(tuple(children), branch_value), path[length:], value)
+    return Extension(path[:length], branch) if length else branch
+
+
+def join(path, node):
+    # node moved down path, after the branch above it collapsed
+    if type(node) is Leaf:
+        return Leaf(path + node.path, node.value)
+    if type(node) is Extension:
+        return Extension(path + node.path, node.child)
+    return Extension(path, node)
+
+
+def delete(node, path):
+    # node without the key at path, the same node when the key isn't there
+    if node is None:
+        return None
+
+    if type(node) is Leaf:
+        return None if node.path == path else node
+
+    if type(node) is Extension:
+        if not path.startswith(node.path):
+            return node
+        child = delete(node.child, path[len(node.path):])
+        if child is node.child:
+            return node
+        return join(node.path, child)
+
+    if not path:
+        if node.value is None:
+            return node
+        children, value = node.children, None
+    else:
+        index = HEX_INDEX[path[0]]
+        child = delete(node.children[index], path[1:])
+        if child is node.children[index]:
+            return node
+        children = node.children[:index] + (child,) + node.children[index + 1:]
+        value = node.value
+
+    # a branch left with a single entry collapses into it
+    indexes = [index for index, child in enumerate(children) if child is not None]
+    if value is not None:
+        return Branch(children, value) if indexes else Leaf("", value)
+    if len(indexes) > 1:
+        return Branch(children, None)
+    return join(HEX_DIGITS[indexes[0]], children[indexes[0]])
+
+
+class Trie:
+    """Merkle Patricia Trie of byte keys to byte values, copies share every node."""
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def get(self, key):
+        return get(self.root, key.hex())
+
+    def set(self, key, value):
+        # empty values delete the key like they do on chain
+        if value:
+            self.root = insert(self.root, key.hex(), value)
+        else:
+            self.delete(key)
+
+    def delete(self, key):
+        self.root = delete(self.root, key.hex())
+
+    def copy(self):
+        return Trie(self.root)
+
+    def root_hash(self):
+        if self.root is None:
+            return BLANK_ROOT
+        root_reference = reference(self.root)
+        # the root is always hashed, even when it is short enough to be embedded
+        if isinstance(root_reference, list):
+            return keccak256(rlp.encode(root_reference))
+        return root_reference
+
+
+# State trie
+#
+# The account trie maps keccak256(address) to rlp([nonce, balance, storage root, code hash]) and every account has
+# a storage trie of keccak256(slot) to rlp(value). The EVM has no balances, they are always 0. Accounts with
+# nonce 0, no code and no storage are empty and left out of the trie (EIP-161).
+
+class StateTrie:
+    """Account and storage tries of an EVM's state, updated one touched account at a time."""
+
+    def __init__(self, accounts=None, storage_tries=None):
+        self.accounts = accounts if accounts is not None else Trie()
+        # keccak256(address) to the root node of the account's storage trie. A trie too, only used as a map that
+        # is O(1) to copy and never hashed
+        self.storage_tries = storage_tries if storage_tries is not None else Trie()
+
+    def update(self, address, contract, slots=None):
+        # sets the account of address from contract, None when there is no contract at address anymore.
+        # Only the given storage slots are updated, slots=None rebuilds the storage trie from all of
+        # contract.storage
+        account_key = keccak256(bytes.fromhex(address[2:]))
+        if contract is None:
+            self.accounts.delete(account_key)
+            self.storage_tries.delete(account_key)
+            return
+
+        if slots is None:
+            storage_trie = Trie()
+            slots = contract.storage
+        else:
+            storage_trie = Trie(self.storage_tries.get(account_key))
+        storage = contract.storage
+        for slot in slots:
+            value = storage.get(slot)
+            storage_trie.set(keccak256(slot.to_bytes(32, "big")), rlp.encode(value) if value else b"")
+        self.storage_tries.set(account_key, storage_trie.root)
+
+        storage_root = storage_trie.root_hash()
+        if not contract.nonce and not contract.code and storage_root == BLANK_ROOT:
+            self.accounts.delete(account_key)
+        else:
+            self.accounts.set(account_key, rlp.encode([contract.nonce, 0, storage_root, contract.code_hash]))
+
+    def storage_root(self, address):
+        return Trie(self.storage_tries.get(keccak256(bytes.fromhex(address[2:])))).root_hash()
+
+    def root_hash(self):
+        return self.accounts.root_hash()
+
+    def copy(self):
+        # shares every node, updates to either copy never show in the other
+        return StateTrie(self.accounts.copy(), self.storage_tries.copy())
@@ -1,11 +1,24 @@
-import math
+import operator
+import time
+import weakref
 
-from collections import deque
+from collections import OrderedDict
+from collections.abc import MutableMapping, Sequence
 from enum import Enum
+from functools import partial
 
 import rlp
 from Crypto.Hash import keccak
 
+from trie import StateTrie
+
+
+MAX_UINT256 = 2**256 - 1
+STACK_LIMIT = 1024
+
+# gas of a transaction unless TransactionMetadata says otherwise
+DEFAULT_GAS = 30_000_000
+
 
 class OperationStatus(Enum):
     EXECUTING = "EXECUTING"
@@ -13,39 +26,91 @@ class OperationStatus(Enum):
     FAILURE = "FAILURE"
 
 
+class OutOfGas(Exception):
+    """Raised wherever gas is charged, the operation fails with all its gas consumed."""
+
+
 class Operation:
-    def __init__(self, evm, address, transaction_metadata, operation_metadata):
+    def __init__(self, evm, address, transaction_metadata, operation_metadata, gas=None):
         self.status = OperationStatus.EXECUTING
 
         self.evm = evm
 
-        self.contract = evm.address_to_contract[address]
-        bytecode = self.contract.bytecode
+        # gas left, only charged when the EVM meters gas
+        self.metering = evm.metering
+        self.gas = transaction_metadata.gas if gas is None else gas
+        # SSTORE refunds, handed to the parent when the operation succeeds
+        self.gas_refund = 0
+        # set on the top level operation once the transaction is done
+        self.gas_used = 0
+
+        # an address without a contract runs as empty code
+        self.contract = evm.address_to_contract.get(address) or Contract(bytecode="", address=address)
 
-        # split into array of 2 characters
-        self.parsed_bytecode = [bytecode[i:i+2] for i in range(0, len(bytecode), 2)]
+        code_analysis = evm.code_analysis_cache.get(self.contract)
+        self.code_analysis = code_analysis
+        self.code = code_analysis.code
+        self.jumpdests = code_analysis.jumpdests
+        self.push_values = code_analysis.push_values
 
         self.transaction_metadata = transaction_metadata
         self.operation_metadata = operation_metadata
 
+        # CALLDATALOAD and CALLDATACOPY slice the calldata without copying it
+        self.calldata = memoryview(transaction_metadata.calldata)
+
+        parent_operation = operation_metadata.parent_operation
+        self.depth = parent_operation.depth + 1 if parent_operation else 0
+
         # pointer used to decide what opcode to step into next
         self.program_counter = 0
 
-        self.stack = []
-        self.memory = []
+        # 256-bit words are kept as python ints, use the stack property for the hex string view
+        self.stack_words = []
+        # byte addressed memory, use the memory property for the list of hex bytes view
+        self.memory_bytes = bytearray()
 
-        self.old_nonce = self.contract.nonce
-        self.old_storage = dict(self.contract.storage)
-        self.old_logs = list(self.contract.logs)
+        # state writes made after this point are undone on rollback
+        self.journal_checkpoint = len(evm.journal)
 
         self.child_operations = []
         self.create_contracts = []
 
-        self.return_bytes = ""
+        # set while this operation waits on a CALL or CREATE, see EVM.run
+        self.pending_operation = None
+        self.pending_resume = None
+
+        # set by RETURN and REVERT, shared with the parent operation without copying
+        self.return_bytes = b""
+
+    @property
+    def stack(self):
+        return StackView(self.stack_words)
+
+    @property
+    def memory(self):
+        return MemoryView(self.memory_bytes)
+
+    def extend_memory(self, offset, size):
+        # memory only grows when a non empty range is touched, always in 32 byte words
+        if size:
+            min_required_memory_size = (offset + size + 31) // 32 * 32
+            if min_required_memory_size > len(self.memory_bytes):
+                # charged before growing so huge offsets run out of gas instead of memory
+                if self.metering:
+                    charge_gas(self, memory_gas(min_required_memory_size) - memory_gas(len(self.memory_bytes)))
+                self.memory_bytes.extend(bytes(min_required_memory_size - len(self.memory_bytes)))
+
+    def copy_to_memory(self, memory_offset, source, source_offset, size):
+        # bytes past the end of source are copied as zeros
+        chunk = source[source_offset:source_offset+size]
+        self.memory_bytes[memory_offset:memory_offset+len(chunk)] = chunk
+        if len(chunk) < size:
+            self.memory_bytes[memory_offset+len(chunk):memory_offset+size] = bytes(size - len(chunk))
 
     def debug(self):
         print(f"contract: {self.contract}")
-        print(f"parsed_bytecode: {self.parsed_bytecode}")
+        print(f"code: {self.code.hex()}")
         print(f"program_counter: {self.program_counter}")
         print(f"transaction_metadata: {self.transaction_metadata}")
         print(f"operation_metadata: {self.operation_metadata}")
@@ -55,916 +120,2297 @@ class Operation:
         print("\n")
 
     def step(self):
-        if self.program_counter >= len(self.parsed_bytecode):
+        if self.program_counter >= len(self.code):
             self.status = OperationStatus.SUCCESS
 
         # code done executing
         if self.status in {OperationStatus.SUCCESS, OperationStatus.FAILURE}:
             return
 
-        opcode = self.parsed_bytecode[self.program_counter]
+        # static gas is charged per basic block like the other engines do
+        if self.metering:
+            charge_gas(self, self.code_analysis.block_gas[self.program_counter])
+
+        # always a single opcode, never a superinstruction, so debug output shows every opcode
+        opcode = self.code[self.program_counter]
+        program_counter = HANDLERS[opcode](self, self.stack_words, self.program_counter)
+        if program_counter != HALT:
+            self.program_counter = program_counter
+
+    def run(self):
+        # hot loop, everything used per opcode is bound to a local
+        code_analysis = self.code_analysis
+        if self.metering:
+            if code_analysis.metered_handlers is None:
+                code_analysis.metered_handlers = meter_handlers(code_analysis)
+            handlers = code_analysis.metered_handlers
+        else:
+            handlers = code_analysis.handlers
+        code_size = len(handlers)
+        stack = self.stack_words
+
+        program_counter = self.program_counter
+        while program_counter < code_size:
+            program_counter = handlers[program_counter](self, stack, program_counter)
 
-        # STOP
-        if opcode == "00":
-            self.program_counter += 1
-            # eh revisit
+        # ran past the end of the code, same as STOP
+        if program_counter != HALT:
+            self.program_counter = program_counter
             self.status = OperationStatus.SUCCESS
-            return
 
-        # ADD a b
-        elif opcode == "01":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = hex((a + b) % 2**256)[2:]
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+    def run_steps(self, max_steps):
+        # runs at most max_steps opcodes and returns how many ran, fewer when the operation stops or suspends on a
+        # CALL or CREATE. Always one opcode per step on the interpreter handlers, whatever the engine, so it can stop
+        # between any two opcodes and carry on from there on the next call
+        code_analysis = self.code_analysis
+        if self.metering:
+            if code_analysis.metered_step_handlers is None:
+                code_analysis.metered_step_handlers = meter_handlers(code_analysis, [HANDLERS[opcode] for opcode in self.code])
+            handlers = code_analysis.metered_step_handlers
+        else:
+            if code_analysis.step_handlers is None:
+                code_analysis.step_handlers = [HANDLERS[opcode] for opcode in self.code]
+            handlers = code_analysis.step_handlers
+        code_size = len(handlers)
+        stack = self.stack_words
+
+        program_counter = self.program_counter
+        steps = 0
+        try:
+            while steps < max_steps and program_counter < code_size:
+                steps += 1
+                program_counter = handlers[program_counter](self, stack, program_counter)
+        except OutOfGas:
+            fail(self, "out of gas")
+            return steps
+
+        if program_counter != HALT:
+            self.program_counter = program_counter
+            if program_counter >= code_size:
+                self.status = OperationStatus.SUCCESS
+        return steps
+
+    def run_threaded(self):
+        code_analysis = self.code_analysis
+        if code_analysis.threaded_blocks is None:
+            code_analysis.threaded_blocks = compile_threaded(code_analysis)
+
+        threaded_blocks = code_analysis.threaded_blocks
+        code_size = len(threaded_blocks)
+        stack = self.stack_words
+
+        # blocks only start at JUMPDESTs and after a block ending opcode, so every jump lands on one
+        program_counter = self.program_counter
+        if self.metering:
+            block_gas = code_analysis.block_gas
+            while program_counter < code_size:
+                self.gas -= block_gas[program_counter]
+                if self.gas < 0:
+                    raise OutOfGas
+                for instruction in threaded_blocks[program_counter]:
+                    program_counter = instruction(self, stack)
+                    if program_counter == HALT:
+                        return
+        else:
+            while program_counter < code_size:
+                for instruction in threaded_blocks[program_counter]:
+                    program_counter = instruction(self, stack)
+                    if program_counter == HALT:
+                        return
+
+        self.program_counter = program_counter
+        self.status = OperationStatus.SUCCESS
+
+    def run_jit(self):
+        code_analysis = self.code_analysis
+        jit_blocks = code_analysis.metered_jit_blocks if self.metering else code_analysis.jit_blocks
+        if jit_blocks is None:
+            # cold code runs on the interpreter until it has been called jit_threshold times
+            if self.program_counter == 0:
+                code_analysis.call_count += 1
+            if code_analysis.call_count <= self.evm.jit_threshold:
+                return self.run()
+
+            jit_blocks = compile_jit(code_analysis, metered=self.metering)
+            if self.metering:
+                code_analysis.metered_jit_blocks = jit_blocks
+            else:
+                code_analysis.jit_blocks = jit_blocks
 
-        # MUL a b
-        elif opcode == "02":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = hex((a * b) % 2**256)[2:]
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+        code_size = len(jit_blocks)
+        stack = self.stack_words
 
-        # SUB a b
-        elif opcode == "03":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = hex((a - b) % 2**256)[2:]
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+        program_counter = self.program_counter
+        while program_counter < code_size:
+            program_counter = jit_blocks[program_counter](self, stack)
 
-        # DIV a b
-        elif opcode == "04":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            if b == 0:
-                c = "0"
-            else:
-                c = hex(a // b)[2:]
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+        if program_counter != HALT:
+            self.program_counter = program_counter
+            self.status = OperationStatus.SUCCESS
 
-        # MOD
-        elif opcode == "06":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
+    def rollback(self):
+        self.evm.revert_journal(self.journal_checkpoint)
+        self.status = OperationStatus.FAILURE
 
-            if b == 0:
-                c = "0"
+    def execute(self, debug=False):
+        # runs until the operation stops or suspends on a CALL or CREATE
+        try:
+            if debug:
+                self.debug()
+                while self.status == OperationStatus.EXECUTING and not self.pending_operation:
+                    self.step()
+                    self.debug()
             else:
-                c = hex(a % b)[2:]
+                self.evm.run_engine(self)
+        except OutOfGas:
+            fail(self, "out of gas")
+
+    def resume_pending_operation(self):
+        child_operation, resume = self.pending_operation, self.pending_resume
+        self.pending_operation = None
+        self.pending_resume = None
+        resume(self, child_operation)
+
+
+# Opcode handlers
+#
+# Every handler takes (operation, stack, program_counter) and returns the program counter of the next
+# opcode to run. Handlers that stop the operation update operation.program_counter and operation.status
+# themselves and return HALT instead.
+
+# larger than any program counter so the run loop only needs a single comparison per opcode
+HALT = 2**64
+
+
+def fail(operation, message=None):
+    if message:
+        print(message)
+    # every failure other than REVERT consumes all the gas left
+    operation.gas = 0
+    operation.rollback()
+    return HALT
+
+
+def stack_overflow(operation):
+    return fail(operation, "stack overflow")
+
+
+# Gas
+#
+# Static costs are summed per basic block and charged when a block is entered, see CodeAnalysis.block_gas.
+# Handlers only charge the parts that depend on their arguments or on state, and only when metering.
+
+COLD_ACCOUNT_ACCESS_GAS = 2600
+COLD_SLOAD_GAS = 2100
+WARM_ACCESS_GAS = 100
+SSTORE_SET_GAS = 20000
+SSTORE_RESET_GAS = 2900
+SSTORE_CLEAR_REFUND = 4800
+SSTORE_STIPEND = 2300
+CALL_VALUE_GAS = 9000
+CALL_STIPEND = 2300
+CODE_DEPOSIT_GAS = 200
+TRANSACTION_GAS = 21000
+
+# gas every opcode costs before its dynamic part, opcodes that are only priced dynamically are 0
+STATIC_GAS = [0] * 256
+for _opcodes, _gas in [
+    ((0x01, 0x03, 0x10, 0x11, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x1b, 0x1c), 3),
+    ((0x02, 0x04, 0x06), 5),
+    ((0x08, 0x09, 0x56), 8),
+    ((0x0a, 0x57), 10),
+    ((0x20,), 30),
+    ((0x30, 0x32, 0x33, 0x34, 0x36, 0x38, 0x3d, 0x45, 0x46, 0x48, 0x50, 0x58, 0x59, 0x5a, 0x5f), 2),
+    ((0x35, 0x37, 0x39, 0x3e, 0x51, 0x52, 0x53), 3),
+    ((0x5b,), 1),
+    ((0xf0, 0xf5), 32000),
+]:
+    for _opcode in _opcodes:
+        STATIC_GAS[_opcode] = _gas
+for _opcode in range(0x60, 0xa0):
+    STATIC_GAS[_opcode] = 3
+for _num_of_topics in range(5):
+    STATIC_GAS[0xa0 + _num_of_topics] = 375 * (_num_of_topics + 1)
+
+
+def charge_gas(operation, gas):
+    operation.gas -= gas
+    if operation.gas < 0:
+        raise OutOfGas
+
+
+def memory_gas(size):
+    words = size // 32
+    return 3 * words + words * words // 512
+
+
+def address_access_gas(operation, address):
+    return COLD_ACCOUNT_ACCESS_GAS if operation.evm.warm(operation.evm.accessed_addresses, address) else WARM_ACCESS_GAS
+
+
+def storage_access_gas(operation, key):
+    storage_key = (operation.contract.address, key)
+    return COLD_SLOAD_GAS if operation.evm.warm(operation.evm.accessed_storage_keys, storage_key) else WARM_ACCESS_GAS
+
+
+def sstore_gas(operation, key, value):
+    # EIP-2200 net gas metering with the EIP-2929 access costs and EIP-3529 refunds
+    evm = operation.evm
+    current = operation.contract.storage.get(key, 0)
+    storage_key = (operation.contract.address, key)
+    original = evm.original_storage.setdefault(storage_key, current)
+
+    gas = COLD_SLOAD_GAS if evm.warm(evm.accessed_storage_keys, storage_key) else 0
+    if value == current:
+        return gas + WARM_ACCESS_GAS
+
+    if original == current:
+        if original == 0:
+            return gas + SSTORE_SET_GAS
+        if value == 0:
+            operation.gas_refund += SSTORE_CLEAR_REFUND
+        return gas + SSTORE_RESET_GAS
 
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+    # the slot was already written in this transaction
+    if original != 0:
+        if current == 0:
+            operation.gas_refund -= SSTORE_CLEAR_REFUND
+        elif value == 0:
+            operation.gas_refund += SSTORE_CLEAR_REFUND
+    if value == original:
+        operation.gas_refund += (SSTORE_SET_GAS if original == 0 else SSTORE_RESET_GAS) - WARM_ACCESS_GAS
+    return gas + WARM_ACCESS_GAS
+
+
+def call_gas(operation, requested_gas):
+    # EIP-150, a call can forward at most all but one 64th of the gas left
+    if not operation.metering:
+        return operation.gas
+    gas = min(requested_gas, operation.gas - operation.gas // 64)
+    operation.gas -= gas
+    return gas
+
+
+def create_gas(operation):
+    return call_gas(operation, operation.gas)
+
+
+def return_gas(operation, child_operation):
+    if operation.metering:
+        operation.gas += child_operation.gas
+        if child_operation.status == OperationStatus.SUCCESS:
+            operation.gas_refund += child_operation.gas_refund
+
+
+def metered_handler(handler, gas):
+    # charges the static gas of a whole basic block before running its first opcode
+    if handler is op_jumpdest:
+        def op_metered(operation, stack, program_counter):
+            operation.gas -= gas
+            if operation.gas < 0:
+                raise OutOfGas
+            return program_counter + 1
+    else:
+        def op_metered(operation, stack, program_counter):
+            operation.gas -= gas
+            if operation.gas < 0:
+                raise OutOfGas
+            return handler(operation, stack, program_counter)
+    return op_metered
 
-        # ADDMOD
-        elif opcode == "08":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = int(self.stack.pop(), 16)
 
-            if c == 0:
-                d = "0"
-            else:
-                d = hex((a + b) % c)[2:]
+def meter_handlers(code_analysis, handlers=None):
+    # the interpreter dispatch table, or the given handlers, with every block start charging its block
+    handlers = list(code_analysis.handlers if handlers is None else handlers)
+    for basic_block in code_analysis.basic_blocks:
+        gas = code_analysis.block_gas[basic_block.start]
+        if gas:
+            handlers[basic_block.start] = metered_handler(handlers[basic_block.start], gas)
+    return handlers
 
-            self.stack.append(d)
-            self.program_counter += 1
-            return
 
-        # MULMOD
-        elif opcode == "09":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = int(self.stack.pop(), 16)
+def intrinsic_gas(calldata):
+    zero_bytes = calldata.count(0)
+    return TRANSACTION_GAS + 4 * zero_bytes + 16 * (len(calldata) - zero_bytes)
 
-            if c == 0:
-                d = "0"
-            else:
-                d = hex((a * b) % c)[2:]
 
-            self.stack.append(d)
-            self.program_counter += 1
-            return
+def op_stop(operation, stack, program_counter):
+    operation.program_counter = program_counter + 1
+    operation.status = OperationStatus.SUCCESS
+    return HALT
 
-        # EXP
-        elif opcode == "0a":
-            a = int(self.stack.pop(), 16)
-            exponent = int(self.stack.pop(), 16)
 
-            c = hex(pow(a, exponent, 2**256))[2:]
+def op_add(operation, stack, program_counter):
+    stack.append((stack.pop() + stack.pop()) & MAX_UINT256)
+    return program_counter + 1
 
-            self.stack.append(c)
-            self.program_counter += 1
-            return
 
-        # LT a b
-        elif opcode == "10":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = "1" if a < b else "0"
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+def op_mul(operation, stack, program_counter):
+    stack.append((stack.pop() * stack.pop()) & MAX_UINT256)
+    return program_counter + 1
 
-        # GT a b
-        elif opcode == "11":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = "1" if a > b else "0"
-            self.stack.append(c)
-            self.program_counter += 1
-            return
 
-        # EQ a b
-        elif opcode == "14":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = "1" if a == b else "0"
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+def op_sub(operation, stack, program_counter):
+    a = stack.pop()
+    stack.append((a - stack.pop()) & MAX_UINT256)
+    return program_counter + 1
 
-        # ISZERO
-        elif opcode == "15":
-            a = int(self.stack.pop(), 16)
-            b = "1" if a == 0 else "0"
-            self.stack.append(b)
-            self.program_counter += 1
-            return
 
-        # AND
-        elif opcode == "16":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = hex(a & b)[2:]
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+def op_div(operation, stack, program_counter):
+    a = stack.pop()
+    b = stack.pop()
+    stack.append(a // b if b else 0)
+    return program_counter + 1
 
-        # OR
-        elif opcode == "17":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = hex(a | b)[2:]
-            self.stack.append(c)
-            self.program_counter += 1
-            return
 
-        # XOR
-        elif opcode == "18":
-            a = int(self.stack.pop(), 16)
-            b = int(self.stack.pop(), 16)
-            c = hex(a ^ b)[2:]
-            self.stack.append(c)
-            self.program_counter += 1
-            return
+def op_mod(operation, stack, program_counter):
+    a = stack.pop()
+    b = stack.pop()
+    stack.append(a % b if b else 0)
+    return program_counter + 1
 
-        # NOT
-        elif opcode == "19":
-            a = int(self.stack.pop(), 16)
-            b = hex(~a & 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff)[2:]
-            self.stack.append(b)
-            self.program_counter += 1
-            return
 
-        # BYTE
-        elif opcode == "1a":
-            offset = int(self.stack.pop(), 16)
+def op_addmod(operation, stack, program_counter):
+    a = stack.pop()
+    b = stack.pop()
+    c = stack.pop()
+    stack.append((a + b) % c if c else 0)
+    return program_counter + 1
 
-            value = self.stack.pop().rjust(64, "0")
-            value_byte_array = [value[idx:idx+2] for idx in range(0, len(value), 2)]
-            try:
-                byte = value_byte_array[offset]
-            except IndexError:
-                byte = "0"
 
-            self.stack.append(byte)
+def op_mulmod(operation, stack, program_counter):
+    a = stack.pop()
+    b = stack.pop()
+    c = stack.pop()
+    stack.append((a * b) % c if c else 0)
+    return program_counter + 1
 
-            self.program_counter += 1
-            return
 
-        # SHL
-        elif opcode == "1b":
-            shift = int(self.stack.pop(), 16)
-            value = int(self.stack.pop(), 16)
+def op_exp(operation, stack, program_counter):
+    a = stack.pop()
+    exponent = stack.pop()
+    if operation.metering:
+        charge_gas(operation, 50 * ((exponent.bit_length() + 7) // 8))
+    stack.append(pow(a, exponent, 2**256))
+    return program_counter + 1
 
-            shifted_value = hex((value << shift) & 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff)[2:]
-            self.stack.append(shifted_value)
 
-            self.program_counter += 1
-            return
+def op_lt(operation, stack, program_counter):
+    a = stack.pop()
+    stack.append(1 if a < stack.pop() else 0)
+    return program_counter + 1
 
-        # SHR
-        elif opcode == "1c":
-            shift = int(self.stack.pop(), 16)
-            value = int(self.stack.pop(), 16)
 
-            shifted_value = hex((value >> shift) & 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff)[2:]
-            self.stack.append(shifted_value)
+def op_gt(operation, stack, program_counter):
+    a = stack.pop()
+    stack.append(1 if a > stack.pop() else 0)
+    return program_counter + 1
 
-            self.program_counter += 1
-            return
 
-        # SHA3
-        elif opcode == "20":
-            offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
+def op_eq(operation, stack, program_counter):
+    stack.append(1 if stack.pop() == stack.pop() else 0)
+    return program_counter + 1
 
-            min_required_memory_size = math.ceil((offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
 
-            memory_bytes_array = []
-            for idx in range(size):
-                memory_byte = self.memory[idx + offset]
-                memory_bytes_array.append(memory_byte)
+def op_iszero(operation, stack, program_counter):
+    stack.append(0 if stack.pop() else 1)
+    return program_counter + 1
 
-            memory_bytes = "".join(memory_bytes_array)
-            hashed_value = keccak.new(digest_bits=256, data=bytes.fromhex(memory_bytes)).hexdigest()
 
-            self.stack.append(hashed_value)
-            self.program_counter += 1
-            return
+def op_and(operation, stack, program_counter):
+    stack.append(stack.pop() & stack.pop())
+    return program_counter + 1
 
-        # ADDRESS
-        elif opcode == "30":
-            self.stack.append(self.contract.address[2:])
-            self.program_counter += 1
-            return
 
-        # ORIGIN
-        elif opcode == "32":
-            parent_operation = self
-            while parent_operation.operation_metadata.parent_operation:
-                parent_operation = parent_operation.operation_metadata.parent_operation
+def op_or(operation, stack, program_counter):
+    stack.append(stack.pop() | stack.pop())
+    return program_counter + 1
 
-            self.stack.append(parent_operation.transaction_metadata.from_address[2:])
-            self.program_counter += 1
-            return
 
-        # CALLER
-        elif opcode == "33":
-            self.stack.append(self.transaction_metadata.from_address[2:])
-            self.program_counter += 1
-            return
+def op_xor(operation, stack, program_counter):
+    stack.append(stack.pop() ^ stack.pop())
+    return program_counter + 1
 
-        # CALLVALUE
-        elif opcode == "34":
-            call_value = hex(int(self.transaction_metadata.value))[2:]
-            self.stack.append(call_value)
-            self.program_counter += 1
-            return
 
-        # CALLDATALOAD
-        elif opcode == "35":
-            offset = int(self.stack.pop(), 16)
+def op_not(operation, stack, program_counter):
+    stack.append(stack.pop() ^ MAX_UINT256)
+    return program_counter + 1
 
-            calldata = self.transaction_metadata.data[2:]
-            parsed_calldata = [calldata[i:i + 2] for i in range(0, len(calldata), 2)]
 
-            bytes_list = []
-            for idx in range(32):
-                try:
-                    byte = parsed_calldata[idx + offset]
-                except IndexError:
-                    byte = "00"
-                bytes_list.append(byte)
+def op_byte(operation, stack, program_counter):
+    offset = stack.pop()
+    value = stack.pop()
+    stack.append((value >> (248 - offset * 8)) & 0xff if offset < 32 else 0)
+    return program_counter + 1
 
-            load_bytes = hex(int("".join(bytes_list), 16))[2:]
-            self.stack.append(load_bytes)
 
-            self.program_counter += 1
-            return
+def op_shl(operation, stack, program_counter):
+    shift = stack.pop()
+    value = stack.pop()
+    stack.append((value << shift) & MAX_UINT256 if shift < 256 else 0)
+    return program_counter + 1
 
-        # CALLDATASIZE
-        elif opcode == "36":
-            calldata = self.transaction_metadata.data[2:]
-            parsed_calldata = [calldata[i:i + 2] for i in range(0, len(calldata), 2)]
-            calldata_size = hex(len(parsed_calldata))[2:]
 
-            self.stack.append(calldata_size)
+def op_shr(operation, stack, program_counter):
+    shift = stack.pop()
+    value = stack.pop()
+    stack.append(value >> shift)
+    return program_counter + 1
 
-            self.program_counter += 1
-            return
 
-        # CALLDATACOPY
-        elif opcode == "37":
-            memory_offset = int(self.stack.pop(), 16)
-            calldata_offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
+def op_sha3(operation, stack, program_counter):
+    offset = stack.pop()
+    size = stack.pop()
 
-            calldata = self.transaction_metadata.data[2:]
-            parsed_calldata = [calldata[i:i + 2] for i in range(0, len(calldata), 2)]
+    if operation.metering:
+        charge_gas(operation, 6 * ((size + 31) // 32))
+    operation.extend_memory(offset, size)
 
-            min_required_memory_size = math.ceil((memory_offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+    digest = operation.evm.keccak_cache.keccak256(operation.memory_bytes[offset:offset+size])
+    stack.append(int.from_bytes(digest, "big"))
+    return program_counter + 1
 
-            for idx in range(size):
-                try:
-                    byte = parsed_calldata[idx + calldata_offset]
-                except IndexError:
-                    byte = "00"
-                self.memory[idx + memory_offset] = byte
 
-            self.program_counter += 1
-            return
+def op_address(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(int(operation.contract.address, 16))
+    return program_counter + 1
 
-        # MLOAD
-        elif opcode == "51":
-            offset = int(self.stack.pop(), 16)
 
-            min_required_memory_size = math.ceil((offset + 32) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+def op_origin(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
 
-            word_byte_array = []
-            for idx in range(32):
-                byte = self.memory[idx + offset]
-                word_byte_array.append(byte)
+    parent_operation = operation
+    while parent_operation.operation_metadata.parent_operation:
+        parent_operation = parent_operation.operation_metadata.parent_operation
 
-            word = hex(int("".join(word_byte_array), 16))[2:]
-            self.stack.append(word)
+    stack.append(int(parent_operation.transaction_metadata.from_address, 16))
+    return program_counter + 1
 
-            self.program_counter += 1
-            return
 
-        # MSTORE
-        elif opcode == "52":
-            offset = int(self.stack.pop(), 16)
+def op_caller(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(int(operation.transaction_metadata.from_address, 16))
+    return program_counter + 1
 
-            min_required_memory_size = math.ceil((offset + 32) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
 
-            value = self.stack.pop()
-            value = value.rjust(64, "0")
-            value_byte_array = [value[idx:idx+2] for idx in range(0, len(value), 2)]
+def op_callvalue(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(int(operation.transaction_metadata.value))
+    return program_counter + 1
 
-            for idx in range(32):
-                self.memory[idx + offset] = value_byte_array[idx]
 
-            self.program_counter += 1
-            return
+def op_calldataload(operation, stack, program_counter):
+    offset = stack.pop()
 
-        # MSTORE8
-        elif opcode == "53":
-            offset = int(self.stack.pop(), 16)
+    # bytes past the end of the calldata read as zeros
+    word = operation.calldata[offset:offset+32]
+    stack.append(int.from_bytes(word, "big") << (256 - len(word) * 8))
+    return program_counter + 1
 
-            min_required_memory_size = math.ceil((offset + 1) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
 
-            value = self.stack.pop()
-            value = value.rjust(64, "0")
-            value_byte_array = [value[idx:idx+2] for idx in range(0, len(value), 2)]
+def op_calldatasize(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(len(operation.calldata))
+    return program_counter + 1
 
-            self.memory[offset] = value_byte_array[-1]
 
-            self.program_counter += 1
-            return
+def op_calldatacopy(operation, stack, program_counter):
+    memory_offset = stack.pop()
+    calldata_offset = stack.pop()
+    size = stack.pop()
 
-        # SLOAD
-        elif opcode == "54":
-            key = self.stack.pop()
-            value = self.contract.storage.get(key, "0")
-            self.stack.append(value)
-            self.program_counter += 1
-            return
+    if operation.metering:
+        charge_gas(operation, 3 * ((size + 31) // 32))
+    operation.extend_memory(memory_offset, size)
+    operation.copy_to_memory(memory_offset, operation.calldata, calldata_offset, size)
+    return program_counter + 1
 
-        # SSTORE
-        elif opcode == "55":
-            if self.operation_metadata.is_static_call_context:
-                self.rollback()
-                return
 
-            key = self.stack.pop()
-            value = self.stack.pop()
-            self.contract.storage[key] = value
-            self.program_counter += 1
-            return
+def op_codesize(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(len(operation.code))
+    return program_counter + 1
 
-        # JUMP
-        elif opcode == "56":
-            new_program_counter = int(self.stack.pop(), 16)
-            if self.parsed_bytecode[new_program_counter] != "5b":
-                print("invalid JUMP")
-                self.rollback()
-            else:
-                self.program_counter = new_program_counter
-            return
 
-        # JUMPI
-        elif opcode == "57":
-            new_program_counter = int(self.stack.pop(), 16)
-            condition = int(self.stack.pop(), 16)
+def op_codecopy(operation, stack, program_counter):
+    memory_offset = stack.pop()
+    bytecode_offset = stack.pop()
+    size = stack.pop()
 
-            if condition != 0:
-                if self.parsed_bytecode[new_program_counter] != "5b":
-                    print("invalid JUMP")
-                    self.rollback()
-                else:
-                    self.program_counter = new_program_counter
-            else:
-                self.program_counter += 1
-            return
+    if operation.metering:
+        charge_gas(operation, 3 * ((size + 31) // 32))
+    operation.extend_memory(memory_offset, size)
+    operation.copy_to_memory(memory_offset, operation.code, bytecode_offset, size)
+    return program_counter + 1
 
-        # JUMPDEST
-        elif opcode == "5b":
-            self.program_counter += 1
-            return
 
-        # PC
-        elif opcode == "58":
-            self.stack.append(str(self.program_counter))
-            self.program_counter += 1
-            return
+def op_extcodesize(operation, stack, program_counter):
+    address = to_address(stack.pop())
+    if operation.metering:
+        charge_gas(operation, address_access_gas(operation, address))
+    external_contract = operation.evm.address_to_contract.get(address)
+    if not external_contract:
+        stack.append(0)
+    else:
+        stack.append(operation.evm.code_analysis_cache.get(external_contract).code_size)
+    return program_counter + 1
 
-        # MSIZE
-        elif opcode == "59":
-            memory_size = hex(len(self.memory))[2:]
-            self.stack.append(memory_size)
-            self.program_counter += 1
-            return
 
-        # PUSH0
-        elif opcode == "5f":
-            self.stack.append("0")
-            self.program_counter += 1
-            return
+def op_extcodecopy(operation, stack, program_counter):
+    address = to_address(stack.pop())
+    memory_offset = stack.pop()
+    bytecode_offset = stack.pop()
+    size = stack.pop()
 
-        # PUSH1 to PUSH32
-        elif opcode in {"60", "61", "62", "63", "64", "65", "66", "67",
-                        "68", "69", "6a", "6b", "6c", "6d", "6e", "6f",
-                        "70", "71", "72", "73", "74", "75", "76", "77",
-                        "78", "79", "7a", "7b", "7c", "7d", "7e", "7f"}:
-            self.program_counter += 1
-            num_of_bytes = int(opcode, 16) - 95
-
-            bytes_list = deque([])
-            for _ in range(num_of_bytes):
-                try:
-                    val = self.parsed_bytecode[self.program_counter]
-                    bytes_list.append(val)
-                    self.program_counter += 1
-                except IndexError:
-                    val = "00"
-                    bytes_list.appendleft(val)
-            bytes_num = hex(int("".join(bytes_list), 16))[2:]
-            self.stack.append(bytes_num)
-            return
+    if operation.metering:
+        charge_gas(operation, address_access_gas(operation, address) + 3 * ((size + 31) // 32))
+    operation.extend_memory(memory_offset, size)
 
-        # DUP1 to DUP16
-        elif opcode in {"80", "81", "82", "83", "84", "85", "86", "87",
-                        "88", "89", "8a", "8b", "8c", "8d", "8e", "8f"}:
-            self.program_counter += 1
-            stack_item_reverse_index = int(opcode, 16) - 127
-            stack_item = self.stack[-stack_item_reverse_index]
-            self.stack.append(stack_item)
-            return
+    external_contract = operation.evm.address_to_contract.get(address)
+    external_code = operation.evm.code_analysis_cache.get(external_contract).code if external_contract else b""
+    operation.copy_to_memory(memory_offset, external_code, bytecode_offset, size)
+    return program_counter + 1
 
-        # SWAP1 to SWAP16
-        elif opcode in {"90", "91", "92", "93", "94", "95", "96", "97",
-                        "98", "99", "9a", "9b", "9c", "9d", "9e", "9f"}:
-            self.program_counter += 1
-            stack_item_a_reverse_index = -1
-            stack_item_b_reverse_index = -(int(opcode, 16) - 142)
-            self.stack[stack_item_a_reverse_index], self.stack[stack_item_b_reverse_index] = self.stack[stack_item_b_reverse_index], self.stack[stack_item_a_reverse_index]
-            return
 
-        # LOG0 to LOG4
-        elif opcode in {"a0", "a1", "a2", "a3", "a4"}:
-            if self.operation_metadata.is_static_call_context:
-                self.rollback()
-                return
+def op_returndatasize(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
 
-            offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
+    if not operation.child_operations:
+        stack.append(0)
+    else:
+        stack.append(len(operation.child_operations[-1].return_bytes))
+    return program_counter + 1
 
-            topics = {}
-            num_of_topics = int(opcode[-1])
-            for topic_num in range(num_of_topics):
-                topics[f"topic{topic_num}"] = hex(int(self.stack.pop(), 16))
 
-            min_required_memory_size = math.ceil((offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+def op_returndatacopy(operation, stack, program_counter):
+    memory_offset = stack.pop()
+    return_bytes_offset = stack.pop()
+    size = stack.pop()
 
-            data_byte_array = []
-            for idx in range(size):
-                byte = self.memory[idx + offset]
-                data_byte_array.append(byte)
-            data = hex(int("".join(data_byte_array), 16))
+    if not operation.child_operations:
+        return_data = b""
+    else:
+        return_data = operation.child_operations[-1].return_bytes
 
-            log = {"data": data, **topics}
-            self.contract.logs.append(log)
+    if return_bytes_offset + size > len(return_data):
+        return fail(operation, "invalid RETURNDATACOPY")
 
-            self.program_counter += 1
-            return
+    if operation.metering:
+        charge_gas(operation, 3 * ((size + 31) // 32))
+    operation.extend_memory(memory_offset, size)
+    operation.memory_bytes[memory_offset:memory_offset+size] = memoryview(return_data)[return_bytes_offset:return_bytes_offset+size]
+    return program_counter + 1
 
-        # CODESIZE
-        elif opcode == "38":
-            self.stack.append(hex(len(self.parsed_bytecode))[2:])
-            self.program_counter += 1
-            return
 
-        # CODECOPY
-        elif opcode == "39":
-            memory_offset = int(self.stack.pop(), 16)
-            bytecode_offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
+def op_gaslimit(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(operation.evm.block_gas_limit)
+    return program_counter + 1
 
-            min_required_memory_size = math.ceil((memory_offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
 
-            for idx in range(size):
-                try:
-                    bytecode_byte = self.parsed_bytecode[idx + bytecode_offset]
-                except IndexError:
-                    bytecode_byte = "00"
-                self.memory[idx + memory_offset] = bytecode_byte
+def op_chainid(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(1)
+    return program_counter + 1
 
-            self.program_counter += 1
-            return
 
-        # EXTCODESIZE
-        elif opcode == "3b":
-            address = "0x" + self.stack.pop()
-            external_contract = self.evm.address_to_contract[address]
-            if not external_contract:
-                self.stack.append("0")
-            else:
-                external_bytecode = external_contract.bytecode
-                external_parsed_bytecode = [external_bytecode[i:i+2] for i in range(0, len(external_bytecode), 2)]
-                code_size = hex(len(external_parsed_bytecode))[2:]
-                self.stack.append(code_size)
+def op_basefee(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(10)
+    return program_counter + 1
 
-            self.program_counter += 1
-            return
 
-        # EXTCODECOPY
-        elif opcode == "3c":
-            address = "0x" + self.stack.pop()
-            memory_offset = int(self.stack.pop(), 16)
-            bytecode_offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
-
-            min_required_memory_size = math.ceil((memory_offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
-
-            external_contract = self.evm.address_to_contract[address]
-            external_bytecode = external_contract.bytecode if external_contract else ""
-            external_parsed_bytecode = [external_bytecode[i:i + 2] for i in range(0, len(external_bytecode), 2)]
-
-            for idx in range(size):
-                try:
-                    external_bytecode_byte = external_parsed_bytecode[idx + bytecode_offset]
-                except IndexError:
-                    external_bytecode_byte = "00"
-                self.memory[idx + memory_offset] = external_bytecode_byte
-
-            self.program_counter += 1
-            return
+def op_pop(operation, stack, program_counter):
+    stack.pop()
+    return program_counter + 1
 
-        # RETURNDATASIZE
-        elif opcode == "3d":
-            if not self.child_operations:
-                self.stack.append("0")
-            else:
-                return_bytes = self.child_operations[-1].return_bytes
-                parsed_return_bytes = [return_bytes[i:i+2] for i in range(0, len(return_bytes), 2)]
-                return_size = hex(len(parsed_return_bytes))[2:]
-                self.stack.append(return_size)
 
-            self.program_counter += 1
-            return
+def op_mload(operation, stack, program_counter):
+    offset = stack.pop()
 
-        # RETURNDATACOPY
-        elif opcode == "3e":
-            memory_offset = int(self.stack.pop(), 16)
-            return_bytes_offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
+    operation.extend_memory(offset, 32)
 
-            min_required_memory_size = math.ceil((memory_offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+    stack.append(int.from_bytes(operation.memory_bytes[offset:offset+32], "big"))
+    return program_counter + 1
 
-            if not self.child_operations:
-                parsed_return_bytes = []
-            else:
-                return_bytes = self.child_operations[-1].return_bytes
-                parsed_return_bytes = [return_bytes[i:i+2] for i in range(0, len(return_bytes), 2)]
 
-            for idx in range(size):
-                parsed_return_byte = parsed_return_bytes[idx + return_bytes_offset]
-                self.memory[idx + memory_offset] = parsed_return_byte
+def op_mstore(operation, stack, program_counter):
+    offset = stack.pop()
 
-            self.program_counter += 1
-            return
+    operation.extend_memory(offset, 32)
 
-        # GASLIMIT
-        elif opcode == "45":
-            self.stack.append("ffffffffffff")
-            self.program_counter += 1
-            return
+    operation.memory_bytes[offset:offset+32] = stack.pop().to_bytes(32, "big")
+    return program_counter + 1
 
-        # CHAINID
-        elif opcode == "46":
-            self.stack.append("1")
-            self.program_counter += 1
-            return
 
-        # BASEFEE
-        elif opcode == "48":
-            self.stack.append("a")
-            self.program_counter += 1
-            return
+def op_mstore8(operation, stack, program_counter):
+    offset = stack.pop()
 
-        # POP
-        elif opcode == "50":
-            self.stack.pop()
-            self.program_counter += 1
-            return
+    operation.extend_memory(offset, 1)
 
-        # CREATE
-        elif opcode == "f0":
-            if self.operation_metadata.is_static_call_context:
-                self.rollback()
-                return
-
-            self.stack.pop()
-            offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
-
-            min_required_memory_size = math.ceil((offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
-
-            create_bytecode = "".join(self.memory[offset:offset+size])
-            create_address = get_create_contract_address(sender_address=self.contract.address, sender_nonce=self.contract.nonce)
-
-            create_contract = self.evm.create_contract(bytecode=create_bytecode, address=create_address)
-            operation = self.evm.execute_transaction(
-                address=create_address,
-                transaction_metadata=TransactionMetadata(from_address=self.contract.address),
-                operation_metadata=OperationMetadata(is_static_call_context=self.operation_metadata.is_static_call_context, parent_operation=self)
-            )
-            if operation.status == OperationStatus.FAILURE:
-                self.stack.append("0")
-                del self.evm.address_to_contract[create_address]
-            else:
-                self.create_contracts.append(create_contract)
-                self.contract.nonce += 1
-                self.stack.append(create_address[2:])
-                create_contract.bytecode = operation.return_bytes
+    operation.memory_bytes[offset] = stack.pop() & 0xff
+    return program_counter + 1
 
-            self.program_counter += 1
 
-            return
+def op_sload(operation, stack, program_counter):
+    key = stack.pop()
+    if operation.metering:
+        charge_gas(operation, storage_access_gas(operation, key))
+    stack.append(operation.contract.storage.get(key, 0))
+    return program_counter + 1
 
-        # CALL
-        elif opcode == "f1":
-            self.stack.pop()
-            address = "0x" + self.stack.pop()
-            value = self.stack.pop()
-            args_offset = int(self.stack.pop(), 16)
-            args_size = int(self.stack.pop(), 16)
-            ret_offset = int(self.stack.pop(), 16)
-            ret_size = int(self.stack.pop(), 16)
-
-            if self.operation_metadata.is_static_call_context and value != 0:
-                self.rollback()
-                return
-
-            min_required_memory_size = math.ceil((args_offset + args_size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
-
-            operation_calldata = "0x" + "".join(self.memory[args_offset:args_offset+args_size])
-
-            operation = self.evm.execute_transaction(
-                address=address,
-                transaction_metadata=TransactionMetadata(data=operation_calldata, from_address=self.contract.address),
-                operation_metadata=OperationMetadata(is_static_call_context=self.operation_metadata.is_static_call_context, parent_operation=self)
-            )
-
-            self.child_operations.append(operation)
-            if operation.status == OperationStatus.FAILURE:
-                self.stack.append("0")
-            else:
-                min_required_memory_size = math.ceil((ret_offset + ret_size) / 32) * 32
-                if min_required_memory_size > len(self.memory):
-                    self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
 
-                return_bytes_array = [operation.return_bytes[2:][i:i+2] for i in range(0, len(operation.return_bytes[2:]), 2)]
-                for idx in range(ret_size):
-                    byte = return_bytes_array[idx]
-                    self.memory[idx + ret_offset] = byte
+def op_sstore(operation, stack, program_counter):
+    if operation.operation_metadata.is_static_call_context:
+        return fail(operation)
 
-                self.stack.append("1")
+    key = stack.pop()
+    value = stack.pop()
+    if operation.metering:
+        # the gas left as if every opcode had been charged on its own
+        if operation.gas + operation.code_analysis.gas_after[program_counter] <= SSTORE_STIPEND:
+            raise OutOfGas
+        charge_gas(operation, sstore_gas(operation, key, value))
 
-            self.program_counter += 1
-            return
+    operation.evm.set_storage(operation.contract, key, value)
+    return program_counter + 1
 
-        # RETURN
-        elif opcode == "f3":
-            offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
 
-            min_required_memory_size = math.ceil((offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+def op_jump(operation, stack, program_counter):
+    new_program_counter = stack.pop()
+    jumpdests = operation.jumpdests
+    if new_program_counter >= len(jumpdests) or not jumpdests[new_program_counter]:
+        return fail(operation, "invalid JUMP")
+    return new_program_counter
 
-            return_bytes_array = []
-            for idx in range(size):
-                byte = self.memory[idx + offset]
-                return_bytes_array.append(byte)
 
-            return_bytes = "".join(return_bytes_array)
+def op_jumpi(operation, stack, program_counter):
+    new_program_counter = stack.pop()
+    condition = stack.pop()
 
-            self.program_counter += 1
-            self.status = OperationStatus.SUCCESS
-            self.return_bytes = return_bytes
+    if condition != 0:
+        jumpdests = operation.jumpdests
+        if new_program_counter >= len(jumpdests) or not jumpdests[new_program_counter]:
+            return fail(operation, "invalid JUMP")
+        return new_program_counter
+    return program_counter + 1
 
-            return
 
-        # CREATE2
-        elif opcode == "f5":
-            if self.operation_metadata.is_static_call_context:
-                self.rollback()
-                return
+def op_jumpdest(operation, stack, program_counter):
+    return program_counter + 1
 
-            self.stack.pop()
-            offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
-            salt = int(self.stack.pop(), 16)
 
-            min_required_memory_size = math.ceil((offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+def op_pc(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(program_counter)
+    return program_counter + 1
 
-            create2_bytecode = "".join(self.memory[offset:offset+size])
 
-            parent_operation = self
-            while parent_operation.operation_metadata.parent_operation:
-                parent_operation = parent_operation.operation_metadata.parent_operation
-            origin_address = parent_operation.transaction_metadata.from_address
+def op_gas(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    if operation.metering:
+        # the rest of the block was charged up front, it is not spent yet
+        stack.append(operation.gas + operation.code_analysis.gas_after[program_counter])
+    else:
+        stack.append(operation.gas)
+    return program_counter + 1
 
-            create2_address = get_create2_contract_address(origin_address=origin_address, salt=salt, initialisation_code=create2_bytecode)
 
-            if create2_address in self.evm.address_to_contract:
-                self.stack.append("0")
-            else:
-                create2_contract = self.evm.create_contract(bytecode=create2_bytecode, address=create2_address)
-                operation = self.evm.execute_transaction(
-                    address=create2_address,
-                    transaction_metadata=TransactionMetadata(from_address=self.contract.address),
-                    operation_metadata=OperationMetadata(is_static_call_context=self.operation_metadata.is_static_call_context, parent_operation=self)
-                )
-                if operation.status == OperationStatus.FAILURE:
-                    self.stack.append("0")
-                    del self.evm.address_to_contract[create2_address]
-                else:
-                    self.create_contracts.append(create2_contract)
-                    self.contract.nonce += 1
-                    self.stack.append(create2_address[2:])
-                    create2_contract.bytecode = operation.return_bytes
+def op_msize(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(len(operation.memory_bytes))
+    return program_counter + 1
 
-            self.program_counter += 1
 
-            return
+def op_push0(operation, stack, program_counter):
+    if len(stack) >= STACK_LIMIT:
+        return stack_overflow(operation)
+    stack.append(0)
+    return program_counter + 1
+
+
+def make_op_push(num_of_bytes):
+    def op_push(operation, stack, program_counter):
+        if len(stack) >= STACK_LIMIT:
+            return stack_overflow(operation)
+        stack.append(operation.push_values[program_counter])
+        return program_counter + 1 + num_of_bytes
+    return op_push
+
+
+def make_op_dup(position):
+    def op_dup(operation, stack, program_counter):
+        if len(stack) >= STACK_LIMIT:
+            return stack_overflow(operation)
+        stack.append(stack[-position])
+        return program_counter + 1
+    return op_dup
+
 
-        # STATICCALL
-        elif opcode == "fa":
-            self.stack.pop()
-            address = "0x" + self.stack.pop()
-            args_offset = int(self.stack.pop(), 16)
-            args_size = int(self.stack.pop(), 16)
-            ret_offset = int(self.stack.pop(), 16)
-            ret_size = int(self.stack.pop(), 16)
-
-            min_required_memory_size = math.ceil((args_offset + args_size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
-
-            operation_calldata = "0x" + "".join(self.memory[args_offset:args_offset + args_size])
-
-            operation = self.evm.execute_transaction(
-                address=address,
-                transaction_metadata=TransactionMetadata(data=operation_calldata, from_address=self.contract.address),
-                operation_metadata=OperationMetadata(is_static_call_context=True, parent_operation=self)
-            )
-
-            self.child_operations.append(operation)
-            if operation.status == OperationStatus.FAILURE:
-                self.stack.append("0")
+def make_op_swap(position):
+    other = -position - 1
+
+    def op_swap(operation, stack, program_counter):
+        stack[-1], stack[other] = stack[other], stack[-1]
+        return program_counter + 1
+    return op_swap
+
+
+def make_op_log(num_of_topics):
+    def op_log(operation, stack, program_counter):
+        if operation.operation_metadata.is_static_call_context:
+            return fail(operation)
+
+        offset = stack.pop()
+        size = stack.pop()
+        if operation.metering:
+            charge_gas(operation, 8 * size)
+
+        topics = {}
+        for topic_num in range(num_of_topics):
+            topics[f"topic{topic_num}"] = hex(stack.pop())
+
+        operation.extend_memory(offset, size)
+
+        data = hex(int.from_bytes(operation.memory_bytes[offset:offset+size], "big"))
+
+        log = {"data": data, **topics}
+        operation.evm.append_log(operation.contract, log)
+        return program_counter + 1
+    return op_log
+
+
+def suspend(operation, child_operation, resume, program_counter):
+    # hand the child to the EVM frame loop, resume(operation, child_operation) runs once the child is done
+    operation.program_counter = program_counter + 1
+    operation.pending_operation = child_operation
+    operation.pending_resume = resume
+    return HALT
+
+
+def op_create(operation, stack, program_counter):
+    if operation.operation_metadata.is_static_call_context:
+        return fail(operation)
+
+    stack.pop()
+    offset = stack.pop()
+    size = stack.pop()
+
+    if operation.metering:
+        charge_gas(operation, 2 * ((size + 31) // 32))
+    operation.extend_memory(offset, size)
+
+    evm = operation.evm
+    if operation.depth >= evm.max_call_depth:
+        stack.append(0)
+        return program_counter + 1
+
+    create_bytecode = operation.memory_bytes[offset:offset+size].hex()
+    contract = operation.contract
+    create_address = get_create_contract_address(sender_address=contract.address, sender_nonce=contract.nonce, keccak_cache=evm.keccak_cache)
+
+    journal_checkpoint = len(evm.journal)
+    create_contract = evm.create_contract(bytecode=create_bytecode, address=create_address)
+    child_operation = Operation(
+        evm=evm,
+        address=create_address,
+        transaction_metadata=TransactionMetadata(from_address=contract.address),
+        operation_metadata=OperationMetadata(is_static_call_context=operation.operation_metadata.is_static_call_context, parent_operation=operation),
+        gas=create_gas(operation),
+    )
+    return suspend(operation, child_operation, partial(resume_create, journal_checkpoint=journal_checkpoint, create_contract=create_contract), program_counter)
+
+
+def resume_create(operation, child_operation, journal_checkpoint, create_contract):
+    # the returned code is paid for from the gas the init code has left
+    if operation.metering and child_operation.status == OperationStatus.SUCCESS:
+        code_deposit_gas = CODE_DEPOSIT_GAS * len(child_operation.return_bytes)
+        if child_operation.gas < code_deposit_gas:
+            child_operation.gas = 0
+            child_operation.status = OperationStatus.FAILURE
+        else:
+            child_operation.gas -= code_deposit_gas
+    return_gas(operation, child_operation)
+
+    if child_operation.status == OperationStatus.FAILURE:
+        operation.stack_words.append(0)
+        operation.evm.revert_journal(journal_checkpoint)
+    else:
+        operation.create_contracts.append(create_contract)
+        operation.evm.increment_nonce(operation.contract)
+        operation.stack_words.append(int(create_contract.address, 16))
+        create_contract.bytecode = child_operation.return_bytes
+
+
+def op_call(operation, stack, program_counter):
+    gas = stack.pop()
+    address = to_address(stack.pop())
+    value = stack.pop()
+    args_offset = stack.pop()
+    args_size = stack.pop()
+    ret_offset = stack.pop()
+    ret_size = stack.pop()
+
+    if operation.operation_metadata.is_static_call_context and value != 0:
+        return fail(operation)
+
+    if operation.metering:
+        charge_gas(operation, address_access_gas(operation, address) + (CALL_VALUE_GAS if value else 0))
+    # the output range is part of the memory the call is charged for
+    operation.extend_memory(args_offset, args_size)
+    operation.extend_memory(ret_offset, ret_size)
+
+    if operation.depth >= operation.evm.max_call_depth:
+        stack.append(0)
+        return program_counter + 1
+
+    # a copy, the caller can change its memory once it resumes
+    operation_calldata = bytes(operation.memory_bytes[args_offset:args_offset+args_size])
+
+    child_operation = Operation(
+        evm=operation.evm,
+        address=address,
+        transaction_metadata=TransactionMetadata(data=operation_calldata, from_address=operation.contract.address),
+        operation_metadata=OperationMetadata(is_static_call_context=operation.operation_metadata.is_static_call_context, parent_operation=operation),
+        gas=call_gas(operation, gas) + (CALL_STIPEND if value and operation.metering else 0),
+    )
+    return suspend(operation, child_operation, partial(resume_call, ret_offset=ret_offset, ret_size=ret_size), program_counter)
+
+
+def resume_call(operation, child_operation, ret_offset, ret_size):
+    operation.child_operations.append(child_operation)
+    return_gas(operation, child_operation)
+
+    # the output is copied on success and on REVERT, any other failure leaves no return data
+    return_data = child_operation.return_bytes
+    copy_size = min(ret_size, len(return_data))
+    operation.memory_bytes[ret_offset:ret_offset+copy_size] = memoryview(return_data)[:copy_size]
+
+    operation.stack_words.append(0 if child_operation.status == OperationStatus.FAILURE else 1)
+
+
+def op_return(operation, stack, program_counter):
+    offset = stack.pop()
+    size = stack.pop()
+
+    operation.extend_memory(offset, size)
+
+    operation.program_counter = program_counter + 1
+    operation.status = OperationStatus.SUCCESS
+    operation.return_bytes = bytes(operation.memory_bytes[offset:offset+size])
+    return HALT
+
+
+def op_create2(operation, stack, program_counter):
+    if operation.operation_metadata.is_static_call_context:
+        return fail(operation)
+
+    stack.pop()
+    offset = stack.pop()
+    size = stack.pop()
+    salt = stack.pop()
+
+    # init code words are hashed for the address on top of the EIP-3860 init code cost
+    if operation.metering:
+        charge_gas(operation, 8 * ((size + 31) // 32))
+    operation.extend_memory(offset, size)
+
+    evm = operation.evm
+    if operation.depth >= evm.max_call_depth:
+        stack.append(0)
+        return program_counter + 1
+
+    create2_bytecode = operation.memory_bytes[offset:offset+size].hex()
+
+    parent_operation = operation
+    while parent_operation.operation_metadata.parent_operation:
+        parent_operation = parent_operation.operation_metadata.parent_operation
+    origin_address = parent_operation.transaction_metadata.from_address
+
+    create2_address = get_create2_contract_address(
+        origin_address=origin_address, salt=salt, initialisation_code=create2_bytecode, keccak_cache=evm.keccak_cache
+    )
+
+    if create2_address in evm.address_to_contract:
+        stack.append(0)
+        return program_counter + 1
+
+    journal_checkpoint = len(evm.journal)
+    create2_contract = evm.create_contract(bytecode=create2_bytecode, address=create2_address)
+    child_operation = Operation(
+        evm=evm,
+        address=create2_address,
+        transaction_metadata=TransactionMetadata(from_address=operation.contract.address),
+        operation_metadata=OperationMetadata(is_static_call_context=operation.operation_metadata.is_static_call_context, parent_operation=operation),
+        gas=create_gas(operation),
+    )
+    return suspend(operation, child_operation, partial(resume_create, journal_checkpoint=journal_checkpoint, create_contract=create2_contract), program_counter)
+
+
+def op_staticcall(operation, stack, program_counter):
+    gas = stack.pop()
+    address = to_address(stack.pop())
+    args_offset = stack.pop()
+    args_size = stack.pop()
+    ret_offset = stack.pop()
+    ret_size = stack.pop()
+
+    if operation.metering:
+        charge_gas(operation, address_access_gas(operation, address))
+    # the output range is part of the memory the call is charged for
+    operation.extend_memory(args_offset, args_size)
+    operation.extend_memory(ret_offset, ret_size)
+
+    if operation.depth >= operation.evm.max_call_depth:
+        stack.append(0)
+        return program_counter + 1
+
+    # a copy, the caller can change its memory once it resumes
+    operation_calldata = bytes(operation.memory_bytes[args_offset:args_offset+args_size])
+
+    child_operation = Operation(
+        evm=operation.evm,
+        address=address,
+        transaction_metadata=TransactionMetadata(data=operation_calldata, from_address=operation.contract.address),
+        operation_metadata=OperationMetadata(is_static_call_context=True, parent_operation=operation),
+        gas=call_gas(operation, gas),
+    )
+    return suspend(operation, child_operation, partial(resume_call, ret_offset=ret_offset, ret_size=ret_size), program_counter)
+
+
+def op_revert(operation, stack, program_counter):
+    offset = stack.pop()
+    size = stack.pop()
+
+    operation.extend_memory(offset, size)
+
+    operation.rollback()
+    operation.return_bytes = bytes(operation.memory_bytes[offset:offset+size])
+    return HALT
+
+
+def op_invalid(operation, stack, program_counter):
+    return fail(operation)
+
+
+def op_not_implemented(operation, stack, program_counter):
+    return fail(operation, f"OPCODE {operation.code[program_counter]:02x} not implemented")
+
+
+# handler for every opcode byte, indexed by the opcode
+HANDLERS = [op_not_implemented] * 256
+
+HANDLERS[0x00] = op_stop
+HANDLERS[0x01] = op_add
+HANDLERS[0x02] = op_mul
+HANDLERS[0x03] = op_sub
+HANDLERS[0x04] = op_div
+HANDLERS[0x06] = op_mod
+HANDLERS[0x08] = op_addmod
+HANDLERS[0x09] = op_mulmod
+HANDLERS[0x0a] = op_exp
+HANDLERS[0x10] = op_lt
+HANDLERS[0x11] = op_gt
+HANDLERS[0x14] = op_eq
+HANDLERS[0x15] = op_iszero
+HANDLERS[0x16] = op_and
+HANDLERS[0x17] = op_or
+HANDLERS[0x18] = op_xor
+HANDLERS[0x19] = op_not
+HANDLERS[0x1a] = op_byte
+HANDLERS[0x1b] = op_shl
+HANDLERS[0x1c] = op_shr
+HANDLERS[0x20] = op_sha3
+HANDLERS[0x30] = op_address
+HANDLERS[0x32] = op_origin
+HANDLERS[0x33] = op_caller
+HANDLERS[0x34] = op_callvalue
+HANDLERS[0x35] = op_calldataload
+HANDLERS[0x36] = op_calldatasize
+HANDLERS[0x37] = op_calldatacopy
+HANDLERS[0x38] = op_codesize
+HANDLERS[0x39] = op_codecopy
+HANDLERS[0x3b] = op_extcodesize
+HANDLERS[0x3c] = op_extcodecopy
+HANDLERS[0x3d] = op_returndatasize
+HANDLERS[0x3e] = op_returndatacopy
+HANDLERS[0x45] = op_gaslimit
+HANDLERS[0x46] = op_chainid
+HANDLERS[0x48] = op_basefee
+HANDLERS[0x50] = op_pop
+HANDLERS[0x51] = op_mload
+HANDLERS[0x52] = op_mstore
+HANDLERS[0x53] = op_mstore8
+HANDLERS[0x54] = op_sload
+HANDLERS[0x55] = op_sstore
+HANDLERS[0x56] = op_jump
+HANDLERS[0x57] = op_jumpi
+HANDLERS[0x58] = op_pc
+HANDLERS[0x59] = op_msize
+HANDLERS[0x5a] = op_gas
+HANDLERS[0x5b] = op_jumpdest
+HANDLERS[0x5f] = op_push0
+for _num_of_bytes in range(1, 33):
+    HANDLERS[0x5f + _num_of_bytes] = make_op_push(_num_of_bytes)
+for _position in range(1, 17):
+    HANDLERS[0x7f + _position] = make_op_dup(_position)
+    HANDLERS[0x8f + _position] = make_op_swap(_position)
+for _num_of_topics in range(5):
+    HANDLERS[0xa0 + _num_of_topics] = make_op_log(_num_of_topics)
+HANDLERS[0xf0] = op_create
+HANDLERS[0xf1] = op_call
+HANDLERS[0xf3] = op_return
+HANDLERS[0xf5] = op_create2
+HANDLERS[0xfa] = op_staticcall
+HANDLERS[0xfd] = op_revert
+HANDLERS[0xfe] = op_invalid
+
+
+# Superinstructions
+#
+# Solidity output is dominated by a few short opcode sequences. A peephole pass over every basic block replaces
+# the handler of the first opcode of such a sequence with a single handler for the whole sequence in
+# CodeAnalysis.handlers, the handlers of the other opcodes stay in place so a jump or a resume landing inside a
+# sequence runs the plain opcodes from there. Every fused handler first checks the stack has room for the whole
+# sequence and otherwise runs only the first opcode, so failures still happen at the same opcode.
+
+PUSH_OPCODES = frozenset(range(0x60, 0x80))
+DUP_OPCODES = frozenset(range(0x80, 0x90))
+
+
+def fuse_push_jumpi(code_analysis, instructions):
+    (push_program_counter, push_opcode), (jumpi_program_counter, _) = instructions
+    first = HANDLERS[push_opcode]
+    destination = code_analysis.push_values[push_program_counter]
+    is_jumpdest = destination < code_analysis.code_size and code_analysis.jumpdests[destination]
+    next_program_counter = jumpi_program_counter + 1
+
+    def op_push_jumpi(operation, stack, program_counter):
+        if len(stack) >= STACK_LIMIT:
+            return first(operation, stack, program_counter)
+        if stack.pop():
+            if not is_jumpdest:
+                return fail(operation, "invalid JUMP")
+            return destination
+        return next_program_counter
+    return op_push_jumpi
+
+
+def fuse_push_mload(code_analysis, instructions):
+    (push_program_counter, push_opcode), (mload_program_counter, _) = instructions
+    first = HANDLERS[push_opcode]
+    offset = code_analysis.push_values[push_program_counter]
+    next_program_counter = mload_program_counter + 1
+
+    def op_push_mload(operation, stack, program_counter):
+        if len(stack) >= STACK_LIMIT:
+            return first(operation, stack, program_counter)
+        operation.extend_memory(offset, 32)
+        stack.append(int.from_bytes(operation.memory_bytes[offset:offset+32], "big"))
+        return next_program_counter
+    return op_push_mload
+
+
+def fuse_dup_push_and(code_analysis, instructions):
+    (_, dup_opcode), (push_program_counter, _), (and_program_counter, _) = instructions
+    first = HANDLERS[dup_opcode]
+    position = dup_opcode - 0x7f
+    mask = code_analysis.push_values[push_program_counter]
+    next_program_counter = and_program_counter + 1
+
+    def op_dup_push_and(operation, stack, program_counter):
+        if len(stack) > STACK_LIMIT - 2:
+            return first(operation, stack, program_counter)
+        stack.append(stack[-position] & mask)
+        return next_program_counter
+    return op_dup_push_and
+
+
+def fuse_push_push_shl(code_analysis, instructions):
+    (value_program_counter, push_opcode), (shift_program_counter, _), (shl_program_counter, _) = instructions
+    first = HANDLERS[push_opcode]
+    value = code_analysis.push_values[value_program_counter]
+    shift = code_analysis.push_values[shift_program_counter]
+    result = (value << shift) & MAX_UINT256 if shift < 256 else 0
+    next_program_counter = shl_program_counter + 1
+
+    def op_push_push_shl(operation, stack, program_counter):
+        if len(stack) > STACK_LIMIT - 2:
+            return first(operation, stack, program_counter)
+        stack.append(result)
+        return next_program_counter
+    return op_push_push_shl
+
+
+def fuse_push4_eq_push_jumpi(code_analysis, instructions):
+    (selector_program_counter, push_opcode), _, (push_program_counter, _), (jumpi_program_counter, _) = instructions
+    first = HANDLERS[push_opcode]
+    selector = code_analysis.push_values[selector_program_counter]
+    destination = code_analysis.push_values[push_program_counter]
+    is_jumpdest = destination < code_analysis.code_size and code_analysis.jumpdests[destination]
+    next_program_counter = jumpi_program_counter + 1
+
+    def op_push4_eq_push_jumpi(operation, stack, program_counter):
+        if len(stack) >= STACK_LIMIT:
+            return first(operation, stack, program_counter)
+        if stack.pop() == selector:
+            if not is_jumpdest:
+                return fail(operation, "invalid JUMP")
+            return destination
+        return next_program_counter
+    return op_push4_eq_push_jumpi
+
+
+# (opcodes allowed at each position, factory of the fused handler), longest sequences first
+SUPERINSTRUCTIONS = [
+    ((frozenset({0x63}), frozenset({0x14}), PUSH_OPCODES, frozenset({0x57})), fuse_push4_eq_push_jumpi),
+    ((PUSH_OPCODES, PUSH_OPCODES, frozenset({0x1b})), fuse_push_push_shl),
+    ((DUP_OPCODES, PUSH_OPCODES, frozenset({0x16})), fuse_dup_push_and),
+    ((PUSH_OPCODES, frozenset({0x57})), fuse_push_jumpi),
+    ((PUSH_OPCODES, frozenset({0x51})), fuse_push_mload),
+]
+
+
+def fuse_superinstructions(code_analysis):
+    # sequences never cross a basic block, none of them contains a JUMPDEST and JUMPI only ends them
+    for basic_block in code_analysis.basic_blocks:
+        instructions = basic_block.instructions
+        index = 0
+        while index < len(instructions):
+            for pattern, fuse in SUPERINSTRUCTIONS:
+                sequence = instructions[index:index+len(pattern)]
+                if len(sequence) == len(pattern) and all(opcode in opcodes for (_, opcode), opcodes in zip(sequence, pattern)):
+                    program_counter = sequence[0][0]
+                    code_analysis.handlers[program_counter] = fuse(code_analysis, sequence)
+                    code_analysis.superinstructions[program_counter] = len(sequence)
+                    index += len(sequence)
+                    break
             else:
-                min_required_memory_size = math.ceil((ret_offset + ret_size) / 32) * 32
-                if min_required_memory_size > len(self.memory):
-                    self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+                index += 1
+
+
+# Selector dispatcher
+#
+# solc starts every contract with a linear chain of DUP1 PUSH4 selector EQ PUSH dest JUMPI, one entry per external
+# function, that compares the selector on top of the stack against each function in turn. Every entry of such a
+# chain gets a handler that looks the selector up in a dict instead and goes straight to the destination, or past
+# the end of the chain when nothing matches. The entries leave the stack as they found it, so the stack, memory
+# and status are the same as after the walk.
+
+SELECTOR_DISPATCHER_ENTRY = (frozenset({0x80}), frozenset({0x63}), frozenset({0x14}), PUSH_OPCODES, frozenset({0x57}))
+
+
+def make_op_dispatch(code_analysis, selectors, index, end_program_counter, walk_gas):
+    # selectors maps every selector of the chain to (index of its entry, destination), entries before index are
+    # not part of the walk from here
+    # walk_gas[k] is the static gas of entries 1 to k, entry index itself is charged with the block it starts
+    jumpdests = code_analysis.jumpdests
+    code_size = code_analysis.code_size
+
+    def op_dispatch(operation, stack, program_counter):
+        if not stack or len(stack) > STACK_LIMIT - 2:
+            return HANDLERS[0x80](operation, stack, program_counter)
+
+        entry = selectors.get(stack[-1])
+        if entry is None or entry[0] < index:
+            if operation.metering:
+                charge_gas(operation, walk_gas[-1] - walk_gas[index])
+            return end_program_counter
+        if operation.metering:
+            charge_gas(operation, walk_gas[entry[0]] - walk_gas[index])
+        destination = entry[1]
+        if destination >= code_size or not jumpdests[destination]:
+            return fail(operation, "invalid JUMP")
+        return destination
+    return op_dispatch
+
+
+def find_selector_dispatchers(code_analysis):
+    instructions = [instruction for basic_block in code_analysis.basic_blocks for instruction in basic_block.instructions]
+    size = len(SELECTOR_DISPATCHER_ENTRY)
+
+    index = 0
+    while index < len(instructions):
+        # entries follow each other with nothing in between, a repeated selector ends the chain so every selector
+        # has a single destination
+        selectors = {}
+        entries = []
+        while True:
+            entry = instructions[index:index+size]
+            if len(entry) < size or not all(opcode in opcodes for (_, opcode), opcodes in zip(entry, SELECTOR_DISPATCHER_ENTRY)):
+                break
+            selector = code_analysis.push_values[entry[1][0]]
+            if selector in selectors:
+                break
+            selectors[selector] = (len(entries), code_analysis.push_values[entry[3][0]])
+            entries.append(entry[0][0])
+            index += size
+
+        # a single entry is already a superinstruction
+        if len(entries) > 1:
+            end_program_counter = instructions[index - 1][0] + 1
+            entry_gas = sum(STATIC_GAS[opcode] for opcode in (0x80, 0x63, 0x14, 0x60, 0x57))
+            walk_gas = [entry_gas * entry_index for entry_index in range(len(entries))]
+            for entry_index, program_counter in enumerate(entries):
+                op_dispatch = make_op_dispatch(code_analysis, selectors, entry_index, end_program_counter, walk_gas)
+                code_analysis.handlers[program_counter] = op_dispatch
+                code_analysis.selector_dispatchers[program_counter] = op_dispatch
+        if not entries:
+            index += 1
+
+
+# Threaded code
+#
+# The threaded engine compiles every basic block of a contract into a tuple of closures, one per opcode, with
+# the program counter and PUSH constants bound when the block is compiled. Each closure takes
+# (operation, stack) and returns the next program counter like the opcode handlers do, so control only goes
+# back to the run loop between blocks.
+
+def thread_handler(handler, program_counter):
+    def instruction(operation, stack):
+        return handler(operation, stack, program_counter)
+    return instruction
 
-                return_bytes_array = [operation.return_bytes[2:][i:i + 2] for i in
-                                      range(0, len(operation.return_bytes[2:]), 2)]
-                for idx in range(ret_size):
-                    byte = return_bytes_array[idx]
-                    self.memory[idx + ret_offset] = byte
 
-                self.stack.append("1")
+def thread_push(code_analysis, program_counter):
+    value = code_analysis.push_values[program_counter]
+    next_program_counter = program_counter + code_analysis.code[program_counter] - 0x5e
 
-            self.program_counter += 1
-            return
+    def instruction(operation, stack):
+        if len(stack) >= STACK_LIMIT:
+            return stack_overflow(operation)
+        stack.append(value)
+        return next_program_counter
+    return instruction
 
-        # REVERT
-        elif opcode == "fd":
-            offset = int(self.stack.pop(), 16)
-            size = int(self.stack.pop(), 16)
 
-            min_required_memory_size = math.ceil((offset + size) / 32) * 32
-            if min_required_memory_size > len(self.memory):
-                self.memory.extend(["00" for _ in range(min_required_memory_size - len(self.memory))])
+def thread_dup(code_analysis, program_counter):
+    position = code_analysis.code[program_counter] - 0x7f
+    next_program_counter = program_counter + 1
 
-            return_bytes_array = []
-            for idx in range(size):
-                byte = self.memory[idx + offset]
-                return_bytes_array.append(byte)
+    def instruction(operation, stack):
+        if len(stack) >= STACK_LIMIT:
+            return stack_overflow(operation)
+        stack.append(stack[-position])
+        return next_program_counter
+    return instruction
 
-            return_bytes = "0x" + "".join(return_bytes_array)
 
-            self.rollback()
-            self.return_bytes = return_bytes
+def thread_swap(code_analysis, program_counter):
+    other = 0x8e - code_analysis.code[program_counter]
+    next_program_counter = program_counter + 1
 
-            return
+    def instruction(operation, stack):
+        stack[-1], stack[other] = stack[other], stack[-1]
+        return next_program_counter
+    return instruction
 
-        # INVALID
-        elif opcode == "fe":
-            self.rollback()
-            return
 
+def thread_pop(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        stack.pop()
+        return next_program_counter
+    return instruction
+
+
+def thread_jumpdest(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        return next_program_counter
+    return instruction
+
+
+def thread_add(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        stack.append((stack.pop() + stack.pop()) & MAX_UINT256)
+        return next_program_counter
+    return instruction
+
+
+def thread_mul(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        stack.append((stack.pop() * stack.pop()) & MAX_UINT256)
+        return next_program_counter
+    return instruction
+
+
+def thread_sub(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        a = stack.pop()
+        stack.append((a - stack.pop()) & MAX_UINT256)
+        return next_program_counter
+    return instruction
+
+
+def thread_lt(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        a = stack.pop()
+        stack.append(1 if a < stack.pop() else 0)
+        return next_program_counter
+    return instruction
+
+
+def thread_gt(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        a = stack.pop()
+        stack.append(1 if a > stack.pop() else 0)
+        return next_program_counter
+    return instruction
+
+
+def thread_eq(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        stack.append(1 if stack.pop() == stack.pop() else 0)
+        return next_program_counter
+    return instruction
+
+
+def thread_iszero(code_analysis, program_counter):
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        stack.append(0 if stack.pop() else 1)
+        return next_program_counter
+    return instruction
+
+
+def thread_bitwise(function):
+    # AND, OR and XOR, function is the C level operator
+    def thread(code_analysis, program_counter):
+        next_program_counter = program_counter + 1
+
+        def instruction(operation, stack):
+            stack.append(function(stack.pop(), stack.pop()))
+            return next_program_counter
+        return instruction
+    return thread
+
+
+def thread_jump(code_analysis, program_counter):
+    jumpdests = code_analysis.jumpdests
+    code_size = code_analysis.code_size
+
+    def instruction(operation, stack):
+        new_program_counter = stack.pop()
+        if new_program_counter >= code_size or not jumpdests[new_program_counter]:
+            return fail(operation, "invalid JUMP")
+        return new_program_counter
+    return instruction
+
+
+def thread_jumpi(code_analysis, program_counter):
+    jumpdests = code_analysis.jumpdests
+    code_size = code_analysis.code_size
+    next_program_counter = program_counter + 1
+
+    def instruction(operation, stack):
+        new_program_counter = stack.pop()
+        if stack.pop():
+            if new_program_counter >= code_size or not jumpdests[new_program_counter]:
+                return fail(operation, "invalid JUMP")
+            return new_program_counter
+        return next_program_counter
+    return instruction
+
+
+# closure factories for the most common opcodes, everything else binds the interpreter handler
+THREAD_FACTORIES = {
+    0x01: thread_add,
+    0x02: thread_mul,
+    0x03: thread_sub,
+    0x10: thread_lt,
+    0x11: thread_gt,
+    0x14: thread_eq,
+    0x15: thread_iszero,
+    0x16: thread_bitwise(operator.and_),
+    0x17: thread_bitwise(operator.or_),
+    0x18: thread_bitwise(operator.xor),
+    0x50: thread_pop,
+    0x56: thread_jump,
+    0x57: thread_jumpi,
+    0x5b: thread_jumpdest,
+}
+for _opcode in range(0x60, 0x80):
+    THREAD_FACTORIES[_opcode] = thread_push
+for _opcode in range(0x80, 0x90):
+    THREAD_FACTORIES[_opcode] = thread_dup
+for _opcode in range(0x90, 0xa0):
+    THREAD_FACTORIES[_opcode] = thread_swap
+
+
+def compile_threaded(code_analysis):
+    # list indexed by program counter, the closures of the block starting there or None
+    threaded_blocks = [None] * code_analysis.code_size
+    for basic_block in code_analysis.basic_blocks:
+        op_dispatch = code_analysis.selector_dispatchers.get(basic_block.start)
+        if op_dispatch:
+            threaded_blocks[basic_block.start] = (thread_handler(op_dispatch, basic_block.start),)
+            continue
+
+        instructions = []
+        for program_counter, opcode in basic_block.instructions:
+            # a JUMPDEST only has to produce the next program counter when it is the whole block
+            if opcode == 0x5b and len(basic_block.instructions) > 1:
+                continue
+
+            thread = THREAD_FACTORIES.get(opcode)
+            if thread:
+                instructions.append(thread(code_analysis, program_counter))
+            else:
+                instructions.append(thread_handler(HANDLERS[opcode], program_counter))
+        threaded_blocks[basic_block.start] = tuple(instructions)
+    return threaded_blocks
+
+
+# JIT
+#
+# Contracts that have run more than EVM.jit_threshold times are compiled to python source, one function per
+# basic block. Inside a block the words pushed by the block live in local variables and only the words left at
+# the end of the block are written back to the stack, constant operands are folded at compile time and
+# opcodes without an inline template call their interpreter handler. The compiled functions are kept on the
+# CodeAnalysis so every contract with the same code hash shares them.
+
+# (words popped, words pushed) of every implemented opcode
+STACK_EFFECTS = [(0, 0)] * 256
+for _opcodes, _effect in [
+    ((0x00, 0x5b, 0xfe), (0, 0)),
+    ((0x01, 0x02, 0x03, 0x04, 0x06, 0x0a, 0x10, 0x11, 0x14, 0x16, 0x17, 0x18, 0x1a, 0x1b, 0x1c, 0x20), (2, 1)),
+    ((0x08, 0x09), (3, 1)),
+    ((0x15, 0x19, 0x35, 0x3b, 0x51, 0x54), (1, 1)),
+    ((0x30, 0x32, 0x33, 0x34, 0x36, 0x38, 0x3d, 0x45, 0x46, 0x48, 0x58, 0x59, 0x5a, 0x5f), (0, 1)),
+    ((0x37, 0x39, 0x3e), (3, 0)),
+    ((0x3c,), (4, 0)),
+    ((0x50, 0x56), (1, 0)),
+    ((0x52, 0x53, 0x55, 0x57, 0xf3, 0xfd), (2, 0)),
+    ((0xf0,), (3, 1)),
+    ((0xf1,), (7, 1)),
+    ((0xf5,), (4, 1)),
+    ((0xfa,), (6, 1)),
+]:
+    for _opcode in _opcodes:
+        STACK_EFFECTS[_opcode] = _effect
+for _num_of_bytes in range(1, 33):
+    STACK_EFFECTS[0x5f + _num_of_bytes] = (0, 1)
+for _position in range(1, 17):
+    STACK_EFFECTS[0x7f + _position] = (_position, _position + 1)
+    STACK_EFFECTS[0x8f + _position] = (_position + 1, _position + 1)
+for _num_of_topics in range(5):
+    STACK_EFFECTS[0xa0 + _num_of_topics] = (_num_of_topics + 2, 0)
+
+# python expression of the pure opcodes, {0} is the word that was on top of the stack
+JIT_EXPRESSIONS = {
+    0x01: "({0} + {1}) & MAX_UINT256",
+    0x02: "({0} * {1}) & MAX_UINT256",
+    0x03: "({0} - {1}) & MAX_UINT256",
+    0x04: "{0} // {1} if {1} else 0",
+    0x06: "{0} % {1} if {1} else 0",
+    0x08: "({0} + {1}) % {2} if {2} else 0",
+    0x09: "({0} * {1}) % {2} if {2} else 0",
+    0x0a: "pow({0}, {1}, MAX_UINT256 + 1)",
+    0x10: "1 if {0} < {1} else 0",
+    0x11: "1 if {0} > {1} else 0",
+    0x14: "1 if {0} == {1} else 0",
+    0x15: "0 if {0} else 1",
+    0x16: "{0} & {1}",
+    0x17: "{0} | {1}",
+    0x18: "{0} ^ {1}",
+    0x19: "{0} ^ MAX_UINT256",
+    0x1a: "({1} >> (248 - {0} * 8)) & 0xff if {0} < 32 else 0",
+    0x1b: "({1} << {0}) & MAX_UINT256 if {0} < 256 else 0",
+    0x1c: "{1} >> {0}",
+}
+
+JIT_GLOBALS = {"MAX_UINT256": MAX_UINT256, "HALT": HALT}
+
+
+def interpret_block(operation, stack, instructions):
+    # runs a block on the interpreter handlers, used when the stack is too short or too tall for the compiled block
+    for program_counter, opcode in instructions:
+        program_counter = HANDLERS[opcode](operation, stack, program_counter)
+        if program_counter == HALT:
+            break
+    return program_counter
+
+
+class JitBlock:
+    """Python source of a single basic block, the stack words pushed inside the block are kept in locals."""
+
+    def __init__(self, code_analysis, basic_block, metered=False):
+        self.code_analysis = code_analysis
+        self.basic_block = basic_block
+        self.metered = metered
+        self.lines = []
+        # locals and constants above the real stack, top of the stack last
+        self.words = []
+        self.num_of_locals = 0
+        self.uses_memory = False
+
+    def emit(self, line):
+        self.lines.append("    " + line)
+
+    def new_local(self, expression):
+        name = f"v{self.num_of_locals}"
+        self.num_of_locals += 1
+        self.emit(f"{name} = {expression}")
+        return name
+
+    def push(self, expression):
+        self.words.append(expression)
+
+    def pop(self):
+        if self.words:
+            return self.words.pop()
+        return self.new_local("stack.pop()")
+
+    def flush(self):
+        # writes the words still held in locals back to the stack
+        if len(self.words) == 1:
+            self.emit(f"stack.append({self.words[0]})")
+        elif self.words:
+            self.emit(f"stack.extend(({', '.join(map(str, self.words))}))")
+        self.words = []
+
+    def exit(self, expression):
+        self.flush()
+        self.emit(f"return {expression}")
+
+    def extend_memory(self, offset, *operands):
+        # extend_memory can run out of gas, the words held in locals and the operands the interpreter handler only
+        # pops after growing memory go back on the stack while it runs so a failure leaves the interpreter's stack
+        words = [*self.words, *operands]
+        self.emit(f"if {offset} + 32 > len(memory):")
+        if words:
+            self.emit(f"    stack.extend(({', '.join(map(str, words))},))")
+        self.emit(f"    operation.extend_memory({offset}, 32)")
+        if words:
+            self.emit(f"    del stack[-{len(words)}:]")
+
+    def jump(self, target):
+        # a constant target is checked when the block is compiled
+        if isinstance(target, int):
+            if target < self.code_analysis.code_size and self.code_analysis.jumpdests[target]:
+                self.exit(target)
+            else:
+                self.exit('fail(operation, "invalid JUMP")')
         else:
-            print(f"OPCODE {opcode} not implemented")
-            self.rollback()
-            return
+            self.flush()
+            self.emit(f"if {target} < {self.code_analysis.code_size} and jumpdests[{target}]:")
+            self.emit(f"    return {target}")
+            self.emit('return fail(operation, "invalid JUMP")')
+
+    def compile_instruction(self, program_counter, opcode):
+        expression = JIT_EXPRESSIONS.get(opcode)
+        # EXP charges gas by the size of its exponent, metered blocks leave it to its handler
+        if expression and not (self.metered and opcode == 0x0a):
+            operands = [self.pop() for _ in range(STACK_EFFECTS[opcode][0])]
+            expression = expression.format(*[f"({operand})" if isinstance(operand, int) else operand for operand in operands])
+            if all(isinstance(operand, int) for operand in operands):
+                self.push(eval(expression, dict(JIT_GLOBALS)))
+            else:
+                self.push(self.new_local(expression))
+        elif 0x60 <= opcode <= 0x7f or opcode == 0x5f:
+            self.push(self.code_analysis.push_values[program_counter])
+        elif 0x80 <= opcode <= 0x8f:
+            position = opcode - 0x7f
+            if position <= len(self.words):
+                self.push(self.words[-position])
+            else:
+                self.push(self.new_local(f"stack[{len(self.words) - position}]"))
+        elif 0x90 <= opcode <= 0x9f:
+            position = opcode - 0x8f + 1
+            if position <= len(self.words):
+                self.words[-1], self.words[-position] = self.words[-position], self.words[-1]
+            elif self.words:
+                index = len(self.words) - position
+                other = self.new_local(f"stack[{index}]")
+                self.emit(f"stack[{index}] = {self.words[-1]}")
+                self.words[-1] = other
+            else:
+                self.emit(f"stack[-1], stack[{-position}] = stack[{-position}], stack[-1]")
+        elif opcode == 0x50:
+            if self.words:
+                self.words.pop()
+            else:
+                self.emit("del stack[-1]")
+        elif opcode == 0x51:
+            offset = self.pop()
+            self.uses_memory = True
+            self.extend_memory(offset)
+            self.push(self.new_local(f'int.from_bytes(memory[{offset}:{offset} + 32], "big")'))
+        elif opcode == 0x52:
+            offset = self.pop()
+            value = self.pop()
+            self.uses_memory = True
+            self.extend_memory(offset, value)
+            self.emit(f'memory[{offset}:{offset} + 32] = ({value}).to_bytes(32, "big")')
+        elif opcode == 0x58:
+            self.push(program_counter)
+        elif opcode == 0x5b:
+            pass
+        elif opcode == 0x56:
+            self.jump(self.pop())
+        elif opcode == 0x57:
+            target = self.pop()
+            condition = self.pop()
+            next_program_counter = program_counter + 1
+            if isinstance(condition, int):
+                if condition:
+                    self.jump(target)
+                else:
+                    self.exit(next_program_counter)
+            else:
+                self.flush()
+                self.emit(f"if {condition}:")
+                body, self.lines = self.lines, []
+                self.jump(target)
+                body.extend("    " + line for line in self.lines)
+                self.lines = body
+                self.emit(f"return {next_program_counter}")
+        else:
+            self.flush()
+            call = f"handler_{opcode:02x}(operation, stack, {program_counter})"
+            if opcode in BLOCK_TERMINATORS:
+                self.emit(f"return {call}")
+            else:
+                self.emit(f"if {call} == HALT:")
+                self.emit("    return HALT")
+
+    def source(self):
+        instructions = self.basic_block.instructions
+        for program_counter, opcode in instructions:
+            self.compile_instruction(program_counter, opcode)
+
+        # blocks that don't end on a terminator fall through into the next one
+        program_counter, opcode = instructions[-1]
+        if opcode not in BLOCK_TERMINATORS:
+            next_program_counter = program_counter + 1
+            if 0x60 <= opcode <= 0x7f:
+                next_program_counter += opcode - 0x5f
+            self.exit(next_program_counter)
+
+        # the stack height range where no opcode of the block can underflow or overflow, anything else runs on
+        # the interpreter handlers so failures happen at the same opcode with the same stack
+        height = required = growth = 0
+        for _, opcode in instructions:
+            pops, pushes = STACK_EFFECTS[opcode]
+            required = max(required, pops - height)
+            height += pushes - pops
+            growth = max(growth, height)
+
+        start = self.basic_block.start
+        lines = [f"def block_{start}(operation, stack):"]
+        # charged before the guard, interpret_block doesn't charge static gas
+        gas = self.code_analysis.block_gas[start]
+        if self.metered and gas:
+            lines.append(f"    operation.gas -= {gas}")
+            lines.append("    if operation.gas < 0:")
+            lines.append("        raise OutOfGas")
+        if required and growth:
+            lines.append(f"    if not {required} <= len(stack) <= {STACK_LIMIT - growth}:")
+        elif required:
+            lines.append(f"    if len(stack) < {required}:")
+        elif growth:
+            lines.append(f"    if len(stack) > {STACK_LIMIT - growth}:")
+        if required or growth:
+            lines.append(f"        return interpret_block(operation, stack, instructions[{start}])")
+        if self.uses_memory:
+            lines.append("    memory = operation.memory_bytes")
+        return "\n".join(lines + self.lines)
+
+
+def compile_jit(code_analysis, metered=False):
+    # list indexed by program counter, the compiled function of the block starting there or None
+    sources = [JitBlock(code_analysis, basic_block, metered).source() for basic_block in code_analysis.basic_blocks]
+    namespace = {
+        **JIT_GLOBALS,
+        **{f"handler_{opcode:02x}": handler for opcode, handler in enumerate(HANDLERS)},
+        "OutOfGas": OutOfGas,
+        "fail": fail,
+        "interpret_block": interpret_block,
+        "jumpdests": code_analysis.jumpdests,
+        "instructions": {basic_block.start: basic_block.instructions for basic_block in code_analysis.basic_blocks},
+    }
+    exec(compile("\n\n\n".join(sources), "<jit>", "exec"), namespace)
+
+    jit_blocks = [None] * code_analysis.code_size
+    for basic_block in code_analysis.basic_blocks:
+        op_dispatch = code_analysis.selector_dispatchers.get(basic_block.start)
+        if op_dispatch:
+            gas = code_analysis.block_gas[basic_block.start]
+            if metered and gas:
+                op_dispatch = metered_handler(op_dispatch, gas)
+            jit_blocks[basic_block.start] = thread_handler(op_dispatch, basic_block.start)
+        else:
+            jit_blocks[basic_block.start] = namespace[f"block_{basic_block.start}"]
+    return jit_blocks
 
-    def rollback(self):
-        for child_operation in reversed(self.child_operations):
-            child_operation.rollback()
 
-        for create_contract in self.create_contracts:
-            create_address = create_contract.address
-            del self.evm.address_to_contract[create_address]
+class StackView(Sequence):
+    """Read-only view of an operation stack that lazily formats each word as a hex string."""
+
+    def __init__(self, words):
+        self.words = words
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [hex(word)[2:] for word in self.words[index]]
+        return hex(self.words[index])[2:]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class MemoryView(Sequence):
+    """Read-only view of operation memory that lazily formats each byte as a 2 character hex string."""
+
+    def __init__(self, memory_bytes):
+        self.memory_bytes = memory_bytes
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [format(byte, "02x") for byte in self.memory_bytes[index]]
+        return format(self.memory_bytes[index], "02x")
+
+    def __len__(self):
+        return len(self.memory_bytes)
+
+    def __iter__(self):
+        return iter(self.memory_bytes.hex(" ").split())
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+# opcodes that end a basic block, the ones that stop the operation, jump or suspend it on a child operation
+BLOCK_TERMINATORS = {0x00, 0x56, 0x57, 0xf0, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xfa, 0xfd, 0xfe, 0xff}
+
+
+class BasicBlock:
+    def __init__(self, start):
+        self.start = start
+        # (program counter, opcode) of every opcode in the block
+        self.instructions = []
+
+
+class CodeAnalysis:
+    """Everything derived from a contract's code that stays the same between executions."""
+
+    def __init__(self, code):
+        self.code = code
+        self.code_size = len(code)
+
+        # blocks start at program counter 0, at every JUMPDEST and after every block terminator
+        self.basic_blocks = []
+        # handler to run at every program counter, the opcode handler or a superinstruction
+        self.handlers = [HANDLERS[opcode] for opcode in code]
+        # program counter to the number of opcodes fused there
+        self.superinstructions = {}
+        # program counter of every selector dispatcher entry to its handler
+        self.selector_dispatchers = {}
+        # compiled lazily by the threaded engine
+        self.threaded_blocks = None
+        # compiled by the jit engine once the code has run more than EVM.jit_threshold times
+        self.jit_blocks = None
+        self.call_count = 0
+        # static gas of the block starting at every program counter, 0 anywhere else
+        self.block_gas = [0] * self.code_size
+        # static gas of the rest of the block after every GAS and SSTORE, they see the gas left as if every opcode
+        # had been charged on its own
+        self.gas_after = {}
+        # built lazily by the engines when the EVM meters gas
+        self.metered_handlers = None
+        self.metered_jit_blocks = None
+        # single opcode handlers without superinstructions, built lazily by Operation.run_steps
+        self.step_handlers = None
+        self.metered_step_handlers = None
+
+        # 1 where a JUMP can land, JUMPDEST bytes inside PUSH data are not valid destinations
+        self.jumpdests = bytearray(self.code_size)
+        # decoded PUSH immediate at the PUSH program counter, immediate bytes missing at the end of the code are dropped
+        self.push_values = [0] * self.code_size
+
+        basic_block = None
+        program_counter = 0
+        while program_counter < self.code_size:
+            opcode = code[program_counter]
+            if opcode == 0x5b or basic_block is None:
+                basic_block = BasicBlock(program_counter)
+                self.basic_blocks.append(basic_block)
+            basic_block.instructions.append((program_counter, opcode))
+            if opcode in BLOCK_TERMINATORS:
+                basic_block = None
+
+            if opcode == 0x5b:
+                self.jumpdests[program_counter] = 1
+            elif 0x60 <= opcode <= 0x7f:
+                num_of_bytes = opcode - 0x5f
+                self.push_values[program_counter] = int.from_bytes(code[program_counter+1:program_counter+1+num_of_bytes], "big")
+                program_counter += num_of_bytes
+            program_counter += 1
+
+        for basic_block in self.basic_blocks:
+            gas = 0
+            for program_counter, opcode in reversed(basic_block.instructions):
+                if opcode in (0x55, 0x5a):
+                    self.gas_after[program_counter] = gas
+                gas += STATIC_GAS[opcode]
+            self.block_gas[basic_block.start] = gas
+
+        fuse_superinstructions(self)
+        find_selector_dispatchers(self)
+
+
+class CodeAnalysisCache:
+    """LRU cache of CodeAnalysis keyed by the keccak hash of the code, shared by every contract with the same code."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.code_hash_to_analysis = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, contract):
+        code_hash = contract.code_hash
+        code_analysis = self.code_hash_to_analysis.get(code_hash)
+        if code_analysis is not None:
+            self.hits += 1
+            self.code_hash_to_analysis.move_to_end(code_hash)
+            return code_analysis
+
+        self.misses += 1
+        code_analysis = CodeAnalysis(contract.code)
+        self.code_hash_to_analysis[code_hash] = code_analysis
+        if len(self.code_hash_to_analysis) > self.max_size:
+            self.code_hash_to_analysis.popitem(last=False)
+        return code_analysis
+
+    def clear(self):
+        self.code_hash_to_analysis.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# shared by every EVM unless one is given its own cache
+CODE_ANALYSIS_CACHE = CodeAnalysisCache()
+
+
+class KeccakCache:
+    """LRU memo of keccak256 digests keyed by the preimage, shared by SHA3 and the contract address helpers."""
+
+    def __init__(self, max_size=65536, max_preimage_size=128, max_code_hashes=256):
+        self.max_size = max_size
+        # longer preimages, e.g. hashes of large memory ranges, are hashed without being kept. Mapping slot and
+        # contract address preimages are all shorter
+        self.max_preimage_size = max_preimage_size
+        self.preimage_to_digest = OrderedDict()
+        # init code to its hash whatever its size, see code_hash
+        self.max_code_hashes = max_code_hashes
+        self.code_hashes = OrderedDict()
+        # digest of every 64 byte preimage to the preimage, solidity hashes key . slot for mapping slots
+        self.slot_preimages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def keccak256(self, data):
+        if len(data) > self.max_preimage_size:
+            self.misses += 1
+            return keccak.new(digest_bits=256, data=data).digest()
+
+        data = bytes(data)
+        digest = self.preimage_to_digest.get(data)
+        if digest is not None:
+            self.hits += 1
+            self.preimage_to_digest.move_to_end(data)
+            return digest
+
+        self.misses += 1
+        digest = keccak.new(digest_bits=256, data=data).digest()
+        self.preimage_to_digest[data] = digest
+        if len(self.preimage_to_digest) > self.max_size:
+            self.preimage_to_digest.popitem(last=False)
+        if len(data) == 64:
+            self.slot_preimages[digest] = data
+            if len(self.slot_preimages) > self.max_size:
+                self.slot_preimages.popitem(last=False)
+        return digest
+
+    def code_hash(self, code):
+        # keccak256 of code given as a hex string or bytes. CREATE2 hashes the same init code for every salt tried
+        # against it, keyed by the code object itself its hash is computed once and every later lookup is O(1)
+        digest = self.code_hashes.get(code)
+        if digest is not None:
+            self.hits += 1
+            self.code_hashes.move_to_end(code)
+            return digest
+
+        self.misses += 1
+        digest = keccak.new(digest_bits=256, data=bytes.fromhex(code) if isinstance(code, str) else code).digest()
+        self.code_hashes[code] = digest
+        if len(self.code_hashes) > self.max_code_hashes:
+            self.code_hashes.popitem(last=False)
+        return digest
+
+    def slot_origin(self, slot):
+        # (key, slot) a hashed storage slot was derived from, None if it wasn't hashed here or was evicted
+        preimage = self.slot_preimages.get(slot.to_bytes(32, "big"))
+        if preimage is None:
+            return None
+        return int.from_bytes(preimage[:32], "big"), int.from_bytes(preimage[32:], "big")
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        self.preimage_to_digest.clear()
+        self.slot_preimages.clear()
+        self.code_hashes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# shared by every EVM unless one is given its own cache
+KECCAK_CACHE = KeccakCache()
+
+
+# Forks
+#
+# A forked EVM reads through to its parent's state and keeps its own writes in overlays, so forking is O(1) and
+# a fork only grows with the contracts it writes. Looking a contract up hands out a ForkedContract that reads
+# through to the parent's, it is only kept in the fork once something on it is written. Code, nonce, logs and
+# storage follow the same rule: the parent is never written by its forks, and writes the parent makes after
+# forking show through in its forks wherever they haven't written.
+
+MISSING = object()
+DELETED = object()
+
+
+class Overlay(MutableMapping):
+    """Mapping that reads through to a parent mapping and keeps its own writes and deletes."""
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.writes = {}
+
+    def __getitem__(self, key):
+        value = self.writes.get(key, MISSING)
+        if value is MISSING:
+            return self.parent[key]
+        if value is DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.writes.get(key, MISSING)
+        if value is MISSING:
+            return self.parent.get(key, default)
+        if value is DELETED:
+            return default
+        return value
+
+    def __setitem__(self, key, value):
+        self.writes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.writes[key] = DELETED
+
+    def __contains__(self, key):
+        value = self.writes.get(key, MISSING)
+        if value is MISSING:
+            return key in self.parent
+        return value is not DELETED
+
+    def __iter__(self):
+        for key, value in self.writes.items():
+            if value is not DELETED:
+                yield key
+        for key in self.parent:
+            if key not in self.writes:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class ForkedContracts(Overlay):
+    """address_to_contract of a forked EVM, parent contracts are looked up as ForkedContracts kept once written."""
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        # ForkedContracts handed out and not written yet, dropped once nothing holds them
+        self.reads = weakref.WeakValueDictionary()
+
+    def commit(self):
+        # a fork's writes stay in its overlays, nothing reaches the parent's backend
+        pass
+
+    def __getitem__(self, address):
+        contract = self.get(address, MISSING)
+        if contract is MISSING:
+            raise KeyError(address)
+        return contract
+
+    def get(self, address, default=None):
+        value = self.writes.get(address, MISSING)
+        if value is MISSING:
+            # every lookup gets the same ForkedContract while one is held, so the frames of a transaction share
+            # what it writes
+            value = self.reads.get(address)
+            if value is None:
+                contract = self.parent.get(address)
+                if contract is None:
+                    return default
+                value = self.reads[address] = ForkedContract(self, contract)
+        if value is DELETED:
+            return default
+        return value
+
+    def __setitem__(self, address, contract):
+        self.reads.pop(address, None)
+        self.writes[address] = contract
+
+    def __delitem__(self, address):
+        super().__delitem__(address)
+        self.reads.pop(address, None)
+
+
+class Storage(MutableMapping):
+    """Contract storage keyed and valued by ints, zero valued slots are never stored."""
+
+    def __init__(self, slots=None):
+        self.slots = {}
+        if slots:
+            self.update(slots)
+
+    def get(self, key, default=None):
+        return self.slots.get(key, default)
+
+    def __getitem__(self, key):
+        return self.slots[key]
+
+    def __setitem__(self, key, value):
+        if value:
+            self.slots[key] = value
+        else:
+            self.slots.pop(key, None)
 
-        self.contract.nonce = self.old_nonce
-        self.contract.storage = self.old_storage
-        self.contract.logs = self.old_logs
-        self.status = OperationStatus.FAILURE
+    def __delitem__(self, key):
+        del self.slots[key]
 
-    def execute(self, debug=False):
-        try:
-            if debug:
-                self.debug()
-            while self.status == OperationStatus.EXECUTING:
-                self.step()
-                if debug:
-                    self.debug()
-        except Exception as e:
-            self.rollback()
-            raise e
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __repr__(self):
+        return repr(self.slots)
 
 
 class Contract:
     def __init__(self, bytecode, address):
-        self.bytecode = bytecode.lower()
+        self.bytecode = bytecode
         self.address = address.lower()
         self.nonce = 0
-        self.storage = {}
+        self.storage = Storage()
         self.logs = []
 
+    @property
+    def bytecode(self):
+        return self.code.hex()
+
+    @bytecode.setter
+    def bytecode(self, bytecode):
+        # hex string or the code itself
+        self.code = bytes.fromhex(bytecode) if isinstance(bytecode, str) else bytes(bytecode)
+        self.code_hash = keccak.new(digest_bits=256, data=self.code).digest()
+
     def __str__(self):
         return f"Contract(bytecode={self.bytecode}, address={self.address}, nonce={self.nonce} storage={self.storage}, logs={self.logs})"
 
 
+class ForkedStorage(Overlay):
+    """Storage of a ForkedContract, the first write keeps the contract in the fork."""
+
+    def __init__(self, parent, contract):
+        super().__init__(parent)
+        self.contract = contract
+
+    def __setitem__(self, key, value):
+        self.contract.write()
+        self.writes[key] = value
+
+    def __delitem__(self, key):
+        self.contract.write()
+        super().__delitem__(key)
+
+
+class ForkedLogs(Sequence):
+    """Logs of a ForkedContract, the parent's logs followed by the ones appended in the fork."""
+
+    def __init__(self, parent, contract):
+        self.parent = parent
+        self.contract = contract
+        self.appended = []
+
+    def append(self, log):
+        self.contract.write()
+        self.appended.append(log)
+
+    def pop(self):
+        # only undoes logs appended in the fork
+        return self.appended.pop()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        num_of_parent_logs = len(self.parent)
+        if index < 0:
+            index += num_of_parent_logs + len(self.appended)
+        if 0 <= index < num_of_parent_logs:
+            return self.parent[index]
+        if index < 0:
+            raise IndexError(index)
+        return self.appended[index - num_of_parent_logs]
+
+    def __len__(self):
+        return len(self.parent) + len(self.appended)
+
+    def __iter__(self):
+        yield from self.parent
+        yield from self.appended
+
+    def __eq__(self, other):
+        return isinstance(other, Sequence) and list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class ForkedContract:
+    """Contract of a forked EVM, reads through to the parent's contract until the fork writes it.
+
+    Code, nonce, logs and storage all follow the same rule: what the fork hasn't written shows the parent as it is
+    now, including writes the parent made after forking.
+    """
+
+    def __init__(self, forked_contracts, parent):
+        self.forked_contracts = forked_contracts
+        self.parent = parent
+        self.address = parent.address
+        self.storage = ForkedStorage(parent.storage, self)
+        self.logs = ForkedLogs(parent.logs, self)
+        # set once the fork writes them
+        self.written_nonce = None
+        self.written_code = None
+
+    def write(self):
+        # the first write keeps the contract in the fork's writes, reads never do
+        if self.forked_contracts.writes.get(self.address, MISSING) is MISSING:
+            self.forked_contracts.writes[self.address] = self
+
+    @property
+    def nonce(self):
+        return self.parent.nonce if self.written_nonce is None else self.written_nonce
+
+    @nonce.setter
+    def nonce(self, nonce):
+        self.write()
+        self.written_nonce = nonce
+
+    @property
+    def code(self):
+        return self.parent.code if self.written_code is None else self.written_code[0]
+
+    @property
+    def code_hash(self):
+        return self.parent.code_hash if self.written_code is None else self.written_code[1]
+
+    @property
+    def bytecode(self):
+        return self.code.hex()
+
+    @bytecode.setter
+    def bytecode(self, bytecode):
+        self.write()
+        code = bytes.fromhex(bytecode) if isinstance(bytecode, str) else bytes(bytecode)
+        self.written_code = (code, keccak.new(digest_bits=256, data=code).digest())
+
+    def __str__(self):
+        return f"ForkedContract(bytecode={self.bytecode}, address={self.address}, nonce={self.nonce} storage={self.storage}, logs={self.logs})"
+
+
 class TransactionMetadata:
-    def __init__(self, from_address, value="0", data="0x"):
-        # calldata has to be even length if present
-        if len(data) % 2 != 0:
-            raise Exception("Invalid calldata length")
+    def __init__(self, from_address, value="0", data="0x", gas=DEFAULT_GAS):
+        # calldata is a 0x prefixed hex string or bytes, decoded once here
+        if isinstance(data, str):
+            # calldata has to be even length if present
+            if len(data) % 2 != 0:
+                raise Exception("Invalid calldata length")
+            data = bytes.fromhex(data[2:])
 
         self.from_address = from_address.lower()
         self.value = value
-        self.data = data.lower()
+        self.calldata = bytes(data)
+        self.gas = gas
+
+    @property
+    def data(self):
+        return "0x" + self.calldata.hex()
 
     def __str__(self):
-        return f"TransactionMetadata(from={self.from_address} value={self.value}, data={self.data})"
+        return f"TransactionMetadata(from={self.from_address} value={self.value}, data={self.data}, gas={self.gas})"
 
 
 class OperationMetadata:
@@ -976,43 +2422,451 @@ class OperationMetadata:
         return f"OperationMetadata(is_static_call_context={self.is_static_call_context}, parent_operation={self.parent_operation})"
 
 
+# top level transactions all share the same metadata
+TRANSACTION_OPERATION_METADATA = OperationMetadata()
+
+
+def undo_storage(contract, key, value):
+    if value is None:
+        contract.storage.pop(key, None)
+    else:
+        contract.storage[key] = value
+
+
+def undo_log(contract):
+    contract.logs.pop()
+
+
+def undo_nonce(contract, nonce):
+    contract.nonce = nonce
+
+
+def undo_warm(accessed, item):
+    accessed.discard(item)
+
+
+def undo_create_contract(address_to_contract, address, contract):
+    if contract is None:
+        del address_to_contract[address]
+    else:
+        address_to_contract[address] = contract
+
+
+# State backends
+#
+# EVM.address_to_contract is the state backend, a mutable mapping of address to Contract with a commit() method
+# the EVM calls once a transaction is done (or the caller calls through EVM.commit() once a block is done). The
+# EVM reads and writes contracts, nonces, logs and storage through the mapping and the Contract objects it
+# returns, a backend that persists state has to write those changes on commit. See sqlite_backend.py.
+
+class DictBackend(dict):
+    """In-memory state backend, the default."""
+
+    def commit(self):
+        # every write is already in memory
+        pass
+
+
+# Batches
+#
+# EVM.execute_batch runs a list of transactions in order and streams each operation back as soon as it is done.
+# The code analysis cache, the keccak memo and the state backend's caches are the EVM's own and stay warm from one
+# transaction to the next, the EIP-2929 access lists still start cold for every transaction like they do on chain.
+
+class Batch:
+    """Transactions run in order by EVM.execute_batch, iterating it runs them and yields their operations."""
+
+    def __init__(self, evm, transactions, all_or_nothing=False, debug=False):
+        self.evm = evm
+        self.transactions = transactions
+        self.all_or_nothing = all_or_nothing
+        self.debug = debug
+
+        self.num_of_transactions = 0
+        self.num_of_failures = 0
+        self.gas_used = 0
+        # seconds spent executing, time the caller spends between operations isn't counted
+        self.elapsed = 0.0
+        # False once an all or nothing batch was reverted
+        self.committed = True
+
+    def __iter__(self):
+        evm = self.evm
+        if not self.all_or_nothing:
+            for address, transaction_metadata in self.transactions:
+                yield self.execute(address, transaction_metadata)
+            return
+
+        # the journal keeps every transaction of the batch until the batch is done, the first failure undoes them
+        # all and so does leaving the batch before its end
+        journal_checkpoint = len(evm.journal)
+        evm.batch_journal = True
+        try:
+            for address, transaction_metadata in self.transactions:
+                operation = self.execute(address, transaction_metadata)
+                yield operation
+                if operation.status != OperationStatus.SUCCESS:
+                    self.committed = False
+                    break
+        except BaseException:
+            self.committed = False
+            raise
+        finally:
+            evm.batch_journal = False
+            if self.committed:
+                evm.journal = []
+                evm.commit()
+            else:
+                evm.revert_journal(journal_checkpoint)
+                evm.journal = []
+
+    def execute(self, address, transaction_metadata):
+        start = time.perf_counter()
+        operation = self.evm.execute_transaction(address, transaction_metadata, TRANSACTION_OPERATION_METADATA, debug=self.debug)
+        self.elapsed += time.perf_counter() - start
+
+        self.num_of_transactions += 1
+        if operation.status != OperationStatus.SUCCESS:
+            self.num_of_failures += 1
+        self.gas_used += operation.gas_used
+        return operation
+
+    def run(self):
+        # runs every transaction and returns their operations
+        return list(self)
+
+    @property
+    def transactions_per_second(self):
+        return self.num_of_transactions / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def gas_per_second(self):
+        return self.gas_used / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f"Batch(transactions={self.num_of_transactions}, failures={self.num_of_failures}, gas_used={self.gas_used}, "
+            f"elapsed={self.elapsed:.3f}s, transactions_per_second={self.transactions_per_second:.0f}, "
+            f"gas_per_second={self.gas_per_second:.0f}, committed={self.committed})"
+        )
+
+
+# how an operation runs its code, see EVM(engine=...)
+ENGINES = {
+    "interpreter": Operation.run,
+    "threaded": Operation.run_threaded,
+    "jit": Operation.run_jit,
+}
+
+
 class EVM:
-    def __init__(self):
-        self.address_to_contract = {}
+    def __init__(
+        self, code_analysis_cache=None, max_call_depth=1024, engine="interpreter", jit_threshold=100, metering=True,
+        block_gas_limit=0xffffffffffff, keccak_cache=None, state=None, commit_per_transaction=True
+    ):
+        if engine not in ENGINES:
+            raise Exception(f"Unknown engine {engine}, use one of {', '.join(ENGINES)}")
+
+        # state backend, commit_per_transaction=False leaves the commits to EVM.commit(), e.g. once per block
+        self.address_to_contract = state if state is not None else DictBackend()
+        self.commit_per_transaction = commit_per_transaction
+        self.max_call_depth = max_call_depth
+        self.engine = engine
+        self.run_engine = ENGINES[engine]
+        self.jit_threshold = jit_threshold
+        self.code_analysis_cache = code_analysis_cache if code_analysis_cache is not None else CODE_ANALYSIS_CACHE
+        self.keccak_cache = keccak_cache if keccak_cache is not None else KECCAK_CACHE
+
+        # undo entries for every state write in the current transaction, (undo function, *args)
+        self.journal = []
+        # True while an all or nothing batch runs, the journal then keeps every transaction of the batch
+        self.batch_journal = False
+
+        # metering=False runs without charging any gas, operation.gas stays at the gas limit
+        self.metering = metering
+        self.block_gas_limit = block_gas_limit
+        # EIP-2929 access lists of the current transaction
+        self.accessed_addresses = set()
+        self.accessed_storage_keys = set()
+        # (address, key) to the value the slot had when the transaction started, for SSTORE refunds
+        self.original_storage = {}
+
+        # tries of the state as of the last state_root(), None until it is first called
+        self.state_trie = None
+        # address to the slots written since the last state_root(), None for accounts whose storage trie has to be
+        # rebuilt. Nothing is recorded before the first state_root()
+        self.touched_accounts = None
+
+    def fork(self):
+        # child EVM over this EVM's state, its writes never reach this EVM and it can be dropped at any time
+        evm = EVM(
+            code_analysis_cache=self.code_analysis_cache,
+            max_call_depth=self.max_call_depth,
+            engine=self.engine,
+            jit_threshold=self.jit_threshold,
+            metering=self.metering,
+            block_gas_limit=self.block_gas_limit,
+            keccak_cache=self.keccak_cache,
+            state=ForkedContracts(self.address_to_contract),
+        )
+        if self.state_trie is not None:
+            evm.state_trie = self.state_trie.copy()
+            evm.touched_accounts = {
+                address: None if slots is None else set(slots) for address, slots in self.touched_accounts.items()
+            }
+        return evm
+
+    def merge(self, fork):
+        # writes what fork wrote into this EVM's state. fork is a fork of this EVM, or a fork of a fork of it
+        # whose parents were all merged first, in the order they were made. Forks still reading through this EVM's
+        # state see the merged writes
+        state = self.address_to_contract
+        for address, contract in fork.address_to_contract.writes.items():
+            if contract is DELETED:
+                state.pop(address, None)
+                self.touch(address)
+                continue
+
+            target = state.get(address)
+            if target is None or not isinstance(contract, ForkedContract):
+                # created in the fork, its storage is its own
+                state[address] = contract
+                if self.touched_accounts is not None:
+                    self.touched_accounts[address] = None
+                continue
+
+            for key, value in contract.storage.writes.items():
+                if value is DELETED:
+                    target.storage.pop(key, None)
+                else:
+                    target.storage[key] = value
+                self.touch(address, key)
+            if contract.written_nonce is not None:
+                target.nonce = contract.written_nonce
+            if contract.written_code is not None:
+                target.bytecode = contract.written_code[0]
+            for log in contract.logs.appended:
+                target.logs.append(log)
+            self.touch(address)
+
+    def commit(self):
+        # writes everything changed since the last commit to the state backend
+        self.address_to_contract.commit()
+
+    def state_root(self, rebuild=False):
+        # root hash of the state trie. Only the accounts and slots written through the EVM since the last call are
+        # rehashed, the first call and rebuild=True build the tries from the whole state, e.g. after the state was
+        # changed directly
+        if self.state_trie is None or rebuild:
+            self.state_trie = StateTrie()
+            self.touched_accounts = dict.fromkeys(self.address_to_contract)
+        for address, slots in self.touched_accounts.items():
+            self.state_trie.update(address, self.address_to_contract.get(address), slots)
+        self.touched_accounts = {}
+        return self.state_trie.root_hash()
+
+    def touch(self, address, key=None):
+        # records a write to the account at address or to its slot key for the next state_root()
+        touched_accounts = self.touched_accounts
+        if touched_accounts is None:
+            return
+        slots = touched_accounts.get(address, MISSING)
+        if slots is MISSING:
+            slots = touched_accounts[address] = set()
+        if slots is not None and key is not None:
+            slots.add(key)
+
+    def precompile(self):
+        # analyses the code of every contract and compiles it for this EVM's engine up front, so the first call of
+        # each contract doesn't pay for it. Returns the number of contracts
+        num_of_contracts = 0
+        for contract in self.address_to_contract.values():
+            code_analysis = self.code_analysis_cache.get(contract)
+            if self.engine == "threaded" and code_analysis.threaded_blocks is None:
+                code_analysis.threaded_blocks = compile_threaded(code_analysis)
+            elif self.engine == "jit" and self.metering and code_analysis.metered_jit_blocks is None:
+                code_analysis.metered_jit_blocks = compile_jit(code_analysis, metered=True)
+            elif self.engine == "jit" and not self.metering and code_analysis.jit_blocks is None:
+                code_analysis.jit_blocks = compile_jit(code_analysis)
+            elif self.metering and code_analysis.metered_handlers is None:
+                code_analysis.metered_handlers = meter_handlers(code_analysis)
+            num_of_contracts += 1
+        return num_of_contracts
 
     def create_contract(self, bytecode, address):
         contract = Contract(bytecode=bytecode, address=address)
+        self.journal.append((undo_create_contract, self.address_to_contract, address, self.address_to_contract.get(address)))
         self.address_to_contract[address] = contract
+        if self.touched_accounts is not None:
+            # the new contract starts with empty storage, so does its storage trie
+            self.touched_accounts[address] = None
         return contract
 
+    def set_storage(self, contract, key, value):
+        # zero valued slots are deleted, forked storage keeps the delete in its overlay
+        self.touch(contract.address, key)
+        self.journal.append((undo_storage, contract, key, contract.storage.get(key)))
+        if value:
+            contract.storage[key] = value
+        else:
+            contract.storage.pop(key, None)
+
+    def append_log(self, contract, log):
+        self.journal.append((undo_log, contract))
+        contract.logs.append(log)
+
+    def increment_nonce(self, contract):
+        self.touch(contract.address)
+        self.journal.append((undo_nonce, contract, contract.nonce))
+        contract.nonce += 1
+
+    def warm(self, accessed, item):
+        # True when item was cold
+        if item in accessed:
+            return False
+        self.journal.append((undo_warm, accessed, item))
+        accessed.add(item)
+        return True
+
+    def revert_journal(self, journal_checkpoint):
+        journal = self.journal
+        while len(journal) > journal_checkpoint:
+            undo, *args = journal.pop()
+            undo(*args)
+
     def execute_transaction(self, address, transaction_metadata, operation_metadata=None, debug=False):
+        for operation in self.execute_transaction_steps(address, transaction_metadata, None, operation_metadata, debug=debug):
+            pass
+        return operation
+
+    def execute_transaction_steps(self, address, transaction_metadata, steps=1000, operation_metadata=None, debug=False):
+        # runs the transaction like execute_transaction, yielding its operation every time steps more opcodes ran
+        # and once more when it is done, with the status and gas_used set. The caller can do anything in between,
+        # e.g. run other transactions on forks of this EVM, transactions running at the same time need an EVM each.
+        # Closing the generator before the end rolls the transaction back. steps=None runs it in one go, debug
+        # output is only printed then
         if not operation_metadata:
             operation_metadata = OperationMetadata()
+        is_transaction = not operation_metadata.parent_operation
+
+        gas = transaction_metadata.gas
+        if is_transaction and self.metering:
+            gas -= intrinsic_gas(transaction_metadata.calldata)
+            if gas < 0:
+                raise Exception("Intrinsic gas too low")
+            self.accessed_addresses.update((transaction_metadata.from_address, address.lower()))
 
         operation = Operation(
             evm=self,
             address=address,
             transaction_metadata=transaction_metadata,
             operation_metadata=operation_metadata,
+            gas=gas,
         )
-        operation.execute(debug=debug)
-        return operation
+        try:
+            if steps is None:
+                self.run(operation, debug=debug)
+            else:
+                yield from self.run_steps(operation, steps)
+        finally:
+            # the transaction is done, nothing left that could roll it back unless an all or nothing batch runs it
+            if is_transaction:
+                self.accessed_addresses.clear()
+                self.accessed_storage_keys.clear()
+                self.original_storage.clear()
+                if not self.batch_journal:
+                    self.journal = []
+                    if self.commit_per_transaction:
+                        self.commit()
+
+        if is_transaction and self.metering:
+            gas_used = transaction_metadata.gas - operation.gas
+            # EIP-3529 caps the refund at a fifth of the gas used
+            if operation.status == OperationStatus.SUCCESS:
+                gas_used -= min(operation.gas_refund, gas_used // 5)
+            operation.gas_used = gas_used
+        yield operation
+
+    def execute_batch(self, transactions, all_or_nothing=False, debug=False):
+        # runs (address, TransactionMetadata) pairs in order, iterate the returned Batch to stream the operations.
+        # Every transaction is final and committed once it is done like in execute_transaction, unless
+        # all_or_nothing=True: then the batch stops at the first transaction that doesn't succeed and undoes every
+        # transaction before it, and the state backend is only committed once the whole batch succeeded
+        return Batch(self, transactions, all_or_nothing=all_or_nothing, debug=debug)
+
+    def simulate_many(self, address, calldatas, from_address, workers=None, chunk_size=None, gas=DEFAULT_GAS):
+        # runs address with every calldata against this EVM's state on a pool of workers and yields a
+        # parallel.TransactionResult per calldata in order, with its status, return bytes, logs and storage writes.
+        # The state is left as it was, see parallel.simulate_many
+        import parallel  # parallel imports vm
+
+        return parallel.simulate_many(self, address, calldatas, from_address, workers=workers, chunk_size=chunk_size, gas=gas)
+
+    def run(self, operation, debug=False):
+        # nested CALL and CREATE frames are driven from this loop instead of recursing, a suspended
+        # operation is resumed with the result of its child once the child is done
+        operations = [operation]
+        try:
+            while operations:
+                current_operation = operations[-1]
+                current_operation.execute(debug=debug)
+                if current_operation.pending_operation:
+                    operations.append(current_operation.pending_operation)
+                else:
+                    operations.pop()
+                    if operations:
+                        operations[-1].resume_pending_operation()
+        except Exception as e:
+            for current_operation in reversed(operations):
+                current_operation.rollback()
+            raise e
+
+    def run_steps(self, operation, steps):
+        # run as a generator that yields operation after every steps opcodes, counted over all of its frames. The
+        # frames keep their program counter, stack and memory on the operation, so running on is just another
+        # run_steps on the innermost one. The frames are rolled back when the generator is closed halfway
+        if steps < 1:
+            raise Exception("steps has to be at least 1")
+        operations = [operation]
+        steps_left = steps
+        try:
+            while operations:
+                current_operation = operations[-1]
+                steps_left -= current_operation.run_steps(steps_left)
+                if current_operation.pending_operation:
+                    operations.append(current_operation.pending_operation)
+                elif current_operation.status != OperationStatus.EXECUTING:
+                    operations.pop()
+                    if operations:
+                        operations[-1].resume_pending_operation()
+                if not steps_left and operations:
+                    yield operation
+                    steps_left = steps
+        except BaseException:
+            for current_operation in reversed(operations):
+                current_operation.rollback()
+            raise
 
     def __str__(self):
         return f"EVM(address_to_contract={self.address_to_contract})"
 
 
-def get_create_contract_address(sender_address: str, sender_nonce: int):
+def to_address(word: int):
+    return "0x" + format(word & (2**160 - 1), "040x")
+
+
+def get_create_contract_address(sender_address: str, sender_nonce: int, keccak_cache=KECCAK_CACHE):
     sender = bytes.fromhex(sender_address[2:])
-    contract_address = "0x" + keccak.new(digest_bits=256, data=rlp.encode([sender, sender_nonce])).hexdigest()[-40:]
+    contract_address = "0x" + keccak_cache.keccak256(rlp.encode([sender, sender_nonce]))[-20:].hex()
     return contract_address
 
 
-def get_create2_contract_address(origin_address: str, salt: int, initialisation_code: str):
-    contract_address = "0x" + keccak.new(digest_bits=256, data=(
+def get_create2_contract_address(origin_address: str, salt: int, initialisation_code: str, keccak_cache=KECCAK_CACHE):
+    # the init code hash is the same for every salt tried against it
+    contract_address = "0x" + keccak_cache.keccak256(
             bytes.fromhex("ff") +
             bytes.fromhex(origin_address[2:]) +
-            bytes.fromhex(hex(salt)[2:].rjust(64, "0")) +
-            bytes.fromhex(keccak.new(digest_bits=256, data=bytes.fromhex(initialisation_code)).hexdigest())
-    )).hexdigest()[-40:]
+            salt.to_bytes(32, "big") +
+            keccak_cache.code_hash(initialisation_code)
+    )[-20:].hex()
     return contract_address